@@ -44,7 +44,11 @@ if __name__ == "__main__":
     _receiver2._location = [4.0, 4.0, 1.2]
     _tracer.addReceiver(_receiver2)
 
+    # Listener plane over the floor of the room, at ear height
+    _tracer.addReceiver(listenerPlaneReceivers([0.25, 0.25], [1.75, 4.75], 1.2, 0.25, radius=0.1))
+
     _tracer.executeTracing()
+    _tracer.close()
     _log.stop()
 
 
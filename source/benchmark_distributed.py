@@ -0,0 +1,58 @@
+'''
+    Measures how the distributed tracing scales: a local task broker is
+    started and the example room is traced with 1, 2, 4, ... local nodes of
+    one worker process each. The node counts can be given as arguments.
+
+    Joe Simon 2018.
+'''
+
+
+import sys
+import time
+from geometry import *
+from ray_tracing import *
+from logger import *
+from distributed_tracing import *
+
+ROOM_GEOMETRY_FILENAME = 'examples/boxy_box_materials_colors.dae'
+
+
+def _makeTracer(geometry):
+    _tracer = RayTracer()
+    _tracer.addEnvironmentGeometry(geometry)
+    _source = SourceDefinition()
+    _source._location = [1.0, 1.0, 1.0]
+    _tracer.addSource(_source)
+    _tracer.addReceiver(listenerPlaneReceivers([0.25, 0.25], [1.75, 4.75], 1.2, 0.25, radius=0.1))
+    _tracer._rayTracerParameters = RayTracerParameters()
+    _tracer._rayTracerParameters._angularResolution = 1.0
+    return _tracer
+
+
+if __name__ == "__main__":
+
+    _log = Logger()
+    _log.start()
+
+    _nodeCounts = [int(_count) for _count in sys.argv[1:]] or [1, 2, 4]
+    _roomGeometry = LibraryGeometries()
+    _roomGeometry.loadGeometryFromFile(ROOM_GEOMETRY_FILENAME)
+
+    _broker = startBroker()
+    _tracer = _makeTracer(_roomGeometry)
+    _tracer.useBroker(_broker.address)
+    _nodes = []
+    _timings = []
+    for _nodeCount in _nodeCounts:
+        while len(_nodes) < _nodeCount:
+            _nodes += startNode(RayTracer.tracerEngine, _broker.address, processes=1, reduce=TracerEngineResults.add, nodeName="node%d" % len(_nodes))
+        _start = time.time()
+        _tracer.executeTracing()
+        _timings.append(time.time() - _start)
+        print("%d node(s): %.2f s, speed-up %.2f" % (_nodeCount, _timings[-1], _timings[0] / _timings[-1]))
+
+    _broker.TaskBroker().close()
+    for _node in _nodes:
+        _node.join()
+    _broker.shutdown()
+    _log.stop()
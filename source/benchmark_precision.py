@@ -0,0 +1,108 @@
+'''
+    Compares the float32 and float64 precisions: throughput and hit errors
+    of closest-hit queries of large ray packets on a finely tessellated room
+    (through its BVH), and time and echogram errors of a full tracing of
+    the example room.
+
+    Joe Simon 2018.
+'''
+
+
+import sys
+import time
+import numpy as np
+from geometry import *
+from ray_tracing import *
+from logger import *
+
+ROOM_GEOMETRY_FILENAME = 'examples/boxy_box_materials_colors.dae'
+
+
+def tessellatedBox(size, divisions):
+    # Vertices (F, 3, 3) of the faces of a box from the origin to 'size',
+    # every side split in divisions x divisions squares of two triangles
+    _faces = []
+    _grid = np.linspace(0.0, 1.0, divisions + 1)
+    _a, _b = np.meshgrid(_grid[:-1], _grid[:-1], indexing='ij')
+    _a, _b = _a.ravel(), _b.ravel()
+    _step = 1.0 / divisions
+    for _axis in range(3):
+        _u, _v = [_other for _other in range(3) if not _other == _axis]
+        for _side in (0.0, 1.0):
+            _corners = []
+            for _da, _db in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                _corner = np.zeros((len(_a), 3))
+                _corner[:, _axis] = _side
+                _corner[:, _u] = _a + _da * _step
+                _corner[:, _v] = _b + _db * _step
+                _corners.append(_corner * np.asarray(size, dtype=float)[None, :])
+            _faces.append(np.stack([_corners[0], _corners[1], _corners[2]], axis=1))
+            _faces.append(np.stack([_corners[0], _corners[2], _corners[3]], axis=1))
+    return np.concatenate(_faces)
+
+
+def benchmarkKernels(rays=200000, divisions=60):
+    _vertices = tessellatedBox([20.0, 30.0, 8.0], divisions)
+    _bvh = BVH().build(_vertices)
+    _origins = np.random.default_rng(0).uniform([1.0, 1.0, 1.0], [19.0, 29.0, 7.0], (rays, 3))
+    _directions = sphereDirections(rays)
+    print("Closest hits of %d rays on %d triangles (%s):" % (rays, len(_vertices), str(_bvh)))
+
+    _hits = {}
+    for _precision in ('float64', 'float32'):
+        _dtype = precisionType(_precision)
+        _triangles = TriangleArrays(_vertices, _dtype)
+        _arrays = _bvh.toArrays(_dtype)
+        _arrays.update(_triangles.toArrays())
+        _accelerator = bvhFromArrays(_arrays)
+        _packetOrigins = _origins.astype(_dtype)
+        _packetDirections = _directions.astype(_dtype)
+        _startTime = time.time()
+        _hits[_precision] = _accelerator.intersectClosest(_packetOrigins, _packetDirections, _triangles)[:2]
+        _elapsed = time.time() - _startTime
+        _bytes = sum([_array.nbytes for _array in _arrays.values()]) + _packetOrigins.nbytes + _packetDirections.nbytes
+        print("  %s: %.0f rays/s, scene and packet %d bytes" % (_precision, rays / _elapsed, _bytes))
+
+    _t64, _faces64 = _hits['float64']
+    _t32, _faces32 = _hits['float32']
+    _missed = np.count_nonzero((_faces64 >= 0) & (_faces32 < 0))
+    _error = np.abs(_t32.astype(float) - _t64)[(_faces64 >= 0) & (_faces32 >= 0)]
+    print("  float32 vs float64: %d ray(s) leaked, hit distance error max %.3g m, mean %.3g m" % (_missed, _error.max(), _error.mean()))
+
+
+def benchmarkTracing(angularResolution=1.0):
+    _roomGeometry = LibraryGeometries()
+    _roomGeometry.loadGeometryFromFile(ROOM_GEOMETRY_FILENAME)
+    _results = {}
+    print("Tracing of '%s' at %.1f degrees:" % (ROOM_GEOMETRY_FILENAME, angularResolution))
+    for _precision in ('float64', 'float32'):
+        _tracer = RayTracer()
+        _tracer.addEnvironmentGeometry(_roomGeometry)
+        _source = SourceDefinition()
+        _source._location = [1.0, 1.0, 1.0]
+        _tracer.addSource(_source)
+        _tracer.addReceiver(listenerPlaneReceivers([0.25, 0.25], [1.75, 4.75], 1.2, 0.25, radius=0.1))
+        _tracer._rayTracerParameters = RayTracerParameters()
+        _tracer._rayTracerParameters._angularResolution = angularResolution
+        _tracer._rayTracerParameters._precision = _precision
+        _startTime = time.time()
+        _results[_precision] = _tracer.executeTracing()
+        print("  %s: %.3f s, echogram %d bytes" % (_precision, time.time() - _startTime, _results[_precision]._echogram.nbytes))
+        _tracer.close()
+
+    _echogram64 = _results['float64']._echogram
+    _echogram32 = _results['float32']._echogram.astype(float)
+    _totals = np.abs(_echogram32.sum(axis=(0, 1, 3)) / _echogram64.sum(axis=(0, 1, 3)) - 1.0)
+    _decay = decayCurveChange(decayCurves(_echogram64, 30.0), decayCurves(_echogram32, 30.0))
+    print("  float32 vs float64: total energy error per band max %.3g, decay curves differ up to %.3g dB (mean %.3g dB)" % (_totals.max(), _decay.max(), _decay.mean()))
+
+
+if __name__ == "__main__":
+
+    _log = Logger()
+    _log.start()
+
+    benchmarkKernels()
+    benchmarkTracing()
+
+    _log.stop()
@@ -0,0 +1,270 @@
+'''
+    This module implements a bounding volume hierarchy over the formed
+    triangles of a scene. It is built with binned surface area heuristic
+    splits and stored flattened in contiguous node arrays (so it can be
+    published in shared memory and cached with the geometry), and it is
+    traversed with whole ray packets for closest-hit and any-hit queries.
+
+    Traversal is breadth first over (ray, node) pairs: every level of the
+    tree costs a handful of numpy calls for the whole packet, instead of
+    several calls per visited node.
+
+    Joe Simon 2018.
+'''
+
+
+import time
+import numpy as np
+from ray_intersection import *
+
+
+BVH_LEAF_SIZE = 8
+BVH_BINS = 16
+BVH_TRAVERSAL_COST = 1.0
+# Below this many triangles testing all of them at once is faster
+BVH_MIN_TRIANGLES = 64
+
+
+class BVH:
+    def __init__(self):
+        # Inner nodes have '_nodeChild' pointing to the first of their two
+        # adjacent children, leaves have -1 and own the faces
+        # _faceOrder[_nodeStart:_nodeStart + _nodeCount]
+        self._nodeMin = np.zeros((0, 3))
+        self._nodeMax = np.zeros((0, 3))
+        self._nodeChild = np.zeros(0, dtype=np.int32)
+        self._nodeStart = np.zeros(0, dtype=np.int32)
+        self._nodeCount = np.zeros(0, dtype=np.int32)
+        self._faceOrder = np.zeros(0, dtype=np.int32)
+        self._buildTime = 0.0
+        self._testsPerformed = 0
+
+    def __len__(self):
+        return len(self._nodeChild)
+
+    def __str__(self):
+        return "BVH with %d node(s) over %d triangle(s), built in %.3f s, %d bytes" % (len(self), len(self._faceOrder), self._buildTime, self.nbytes())
+
+    def nbytes(self):
+        return sum([_array.nbytes for _array in self.toArrays().values()])
+
+    def toArrays(self, dtype=None):
+        # With a 'dtype' the node bounds are rounded outwards to it, so the
+        # boxes still contain their faces
+        _nodeMin, _nodeMax = self._nodeMin, self._nodeMax
+        if dtype is not None and not np.dtype(dtype) == _nodeMin.dtype:
+            _nodeMin = _nodeMin.astype(dtype)
+            _nodeMin = np.where(_nodeMin > self._nodeMin, np.nextafter(_nodeMin, -np.inf), _nodeMin)
+            _nodeMax = _nodeMax.astype(dtype)
+            _nodeMax = np.where(_nodeMax < self._nodeMax, np.nextafter(_nodeMax, np.inf), _nodeMax)
+        return {'bvhNodeMin': _nodeMin,
+                'bvhNodeMax': _nodeMax,
+                'bvhNodeChild': self._nodeChild,
+                'bvhNodeStart': self._nodeStart,
+                'bvhNodeCount': self._nodeCount,
+                'bvhFaceOrder': self._faceOrder}
+
+    def build(self, vertices, leafSize=BVH_LEAF_SIZE, bins=BVH_BINS):
+        _startTime = time.time()
+        _vertices = np.asarray(vertices, dtype=float)
+        _faceMin = _vertices.min(axis=1)
+        _faceMax = _vertices.max(axis=1)
+        _centroids = _vertices.mean(axis=1)
+
+        _nodeMin = []
+        _nodeMax = []
+        _nodeChild = []
+        _nodeStart = []
+        _nodeCount = []
+        _faceOrder = []
+
+        def _newNode(faces):
+            _nodeMin.append(_faceMin[faces].min(axis=0) if len(faces) > 0 else np.zeros(3))
+            _nodeMax.append(_faceMax[faces].max(axis=0) if len(faces) > 0 else np.zeros(3))
+            _nodeChild.append(-1)
+            _nodeStart.append(0)
+            _nodeCount.append(0)
+            return len(_nodeChild) - 1
+
+        _stack = [(_newNode(np.arange(len(_vertices))), np.arange(len(_vertices)))]
+        while len(_stack) > 0:
+            _node, _faces = _stack.pop()
+            _split = None
+            if len(_faces) > leafSize:
+                _split = self._findSplit(_faces, _faceMin, _faceMax, _centroids, _nodeMin[_node], _nodeMax[_node], bins)
+
+            if _split is None:
+                _nodeStart[_node] = len(_faceOrder)
+                _nodeCount[_node] = len(_faces)
+                _faceOrder.extend(_faces.tolist())
+                continue
+
+            _leftMask = _split
+            _left = _newNode(_faces[_leftMask])
+            _right = _newNode(_faces[~_leftMask])
+            _nodeChild[_node] = _left
+            _stack.append((_right, _faces[~_leftMask]))
+            _stack.append((_left, _faces[_leftMask]))
+
+        self._nodeMin = np.array(_nodeMin, dtype=float).reshape(-1, 3)
+        self._nodeMax = np.array(_nodeMax, dtype=float).reshape(-1, 3)
+        self._nodeChild = np.array(_nodeChild, dtype=np.int32)
+        self._nodeStart = np.array(_nodeStart, dtype=np.int32)
+        self._nodeCount = np.array(_nodeCount, dtype=np.int32)
+        self._faceOrder = np.array(_faceOrder, dtype=np.int32)
+        self._buildTime = time.time() - _startTime
+        return self
+
+    def _findSplit(self, faces, faceMin, faceMax, centroids, nodeMin, nodeMax, bins):
+        # Binned SAH: the centroids are binned along each axis and every
+        # boundary between bins is evaluated with prefix sweeps of the bin bounds
+        _centroids = centroids[faces]
+        _centroidMin = _centroids.min(axis=0)
+        _extent = _centroids.max(axis=0) - _centroidMin
+        _bestCost = np.inf
+        _best = None
+
+        for _axis in range(3):
+            if not _extent[_axis] > 0.0:
+                continue
+            _binIds = ((_centroids[:, _axis] - _centroidMin[_axis]) * (bins / _extent[_axis])).astype(np.int64)
+            _binIds = np.minimum(_binIds, bins - 1)
+
+            _order = np.argsort(_binIds, kind='stable')
+            _present, _starts, _counts = np.unique(_binIds[_order], return_index=True, return_counts=True)
+            _binMin = np.full((bins, 3), np.inf)
+            _binMax = np.full((bins, 3), -np.inf)
+            _binCount = np.zeros(bins, dtype=np.int64)
+            _binMin[_present] = np.minimum.reduceat(faceMin[faces[_order]], _starts, axis=0)
+            _binMax[_present] = np.maximum.reduceat(faceMax[faces[_order]], _starts, axis=0)
+            _binCount[_present] = _counts
+
+            _leftArea = _surfaceArea(np.minimum.accumulate(_binMin, axis=0), np.maximum.accumulate(_binMax, axis=0))[:-1]
+            _rightArea = _surfaceArea(np.minimum.accumulate(_binMin[::-1], axis=0), np.maximum.accumulate(_binMax[::-1], axis=0))[::-1][1:]
+            _leftCount = np.cumsum(_binCount)[:-1]
+            _rightCount = len(faces) - _leftCount
+
+            _valid = (_leftCount > 0) & (_rightCount > 0)
+            if not np.any(_valid):
+                continue
+            _costs = np.where(_valid, _leftArea * _leftCount + _rightArea * _rightCount, np.inf)
+            _boundary = int(np.argmin(_costs))
+            if _costs[_boundary] < _bestCost:
+                _bestCost = _costs[_boundary]
+                _best = _binIds <= _boundary
+
+        if _best is None:
+            return None
+
+        # Splitting must be cheaper than intersecting all the faces of the node
+        _nodeArea = _surfaceArea(nodeMin[None, :], nodeMax[None, :])[0]
+        if _nodeArea > 0.0 and BVH_TRAVERSAL_COST + _bestCost / _nodeArea >= len(faces) and len(faces) <= 4 * BVH_LEAF_SIZE:
+            return None
+        return _best
+
+    def intersectClosest(self, origins, directions, triangles, ignoreFaces=None, tMax=None):
+        # Same results as 'intersectRays' over all the faces. Pairs are dropped
+        # as soon as the ray misses the node box or enters it behind its
+        # closest hit found so far.
+        _rays = len(origins)
+        _dtype = np.result_type(origins, triangles._v0)
+        _t = np.full(_rays, np.inf, dtype=_dtype) if tMax is None else np.array(tMax, dtype=_dtype)
+        _faceIndex = np.full(_rays, -1, dtype=np.int64)
+        _u = np.zeros(_rays, dtype=_dtype)
+        _v = np.zeros(_rays, dtype=_dtype)
+        if _rays == 0 or len(self) == 0:
+            return _t, _faceIndex, _u, _v
+
+        with np.errstate(divide='ignore'):
+            _inverseDirections = 1.0 / directions
+
+        _pairRays = np.arange(_rays)
+        _pairNodes = np.zeros(_rays, dtype=np.int64)
+        while len(_pairRays) > 0:
+            _enters = self._entersBoxes(_pairNodes, origins[_pairRays], _inverseDirections[_pairRays], _t[_pairRays])
+            _pairRays = _pairRays[_enters]
+            _pairNodes = _pairNodes[_enters]
+
+            _leaf = self._nodeChild[_pairNodes] < 0
+            _rayIds, _faces = self._leafFacePairs(_pairRays[_leaf], _pairNodes[_leaf])
+            if len(_faces) > 0:
+                self._testsPerformed += len(_faces)
+                _tPairs, _uPairs, _vPairs = intersectRayFacePairs(origins[_rayIds], directions[_rayIds], triangles, _faces,
+                                                                  None if ignoreFaces is None else ignoreFaces[_rayIds])
+                np.minimum.at(_t, _rayIds, _tPairs)
+                _closest = np.isfinite(_tPairs) & (_tPairs == _t[_rayIds])
+                _faceIndex[_rayIds[_closest]] = _faces[_closest]
+                _u[_rayIds[_closest]] = _uPairs[_closest]
+                _v[_rayIds[_closest]] = _vPairs[_closest]
+
+            _pairRays, _pairNodes = self._childPairs(_pairRays[~_leaf], _pairNodes[~_leaf])
+
+        return _t, _faceIndex, _u, _v
+
+    def intersectAny(self, origins, directions, triangles, tMax, ignoreFaces=None):
+        # True for the rays that hit any face closer than 'tMax' (occlusion)
+        _rays = len(origins)
+        _hit = np.zeros(_rays, dtype=bool)
+        _tMax = np.array(np.broadcast_to(np.asarray(tMax, dtype=float), (_rays,)))
+        if _rays == 0 or len(self) == 0:
+            return _hit
+
+        with np.errstate(divide='ignore'):
+            _inverseDirections = 1.0 / directions
+
+        _pairRays = np.arange(_rays)
+        _pairNodes = np.zeros(_rays, dtype=np.int64)
+        while len(_pairRays) > 0:
+            _enters = ~_hit[_pairRays]
+            _enters[_enters] = self._entersBoxes(_pairNodes[_enters], origins[_pairRays[_enters]], _inverseDirections[_pairRays[_enters]], _tMax[_pairRays[_enters]])
+            _pairRays = _pairRays[_enters]
+            _pairNodes = _pairNodes[_enters]
+
+            _leaf = self._nodeChild[_pairNodes] < 0
+            _rayIds, _faces = self._leafFacePairs(_pairRays[_leaf], _pairNodes[_leaf])
+            if len(_faces) > 0:
+                self._testsPerformed += len(_faces)
+                _tPairs, _, _ = intersectRayFacePairs(origins[_rayIds], directions[_rayIds], triangles, _faces,
+                                                      None if ignoreFaces is None else ignoreFaces[_rayIds])
+                _hit[_rayIds[_tPairs < _tMax[_rayIds]]] = True
+
+            _pairRays, _pairNodes = self._childPairs(_pairRays[~_leaf], _pairNodes[~_leaf])
+
+        return _hit
+
+    def _entersBoxes(self, nodes, origins, inverseDirections, tMax):
+        # Slab test of the pairs, true for the rays entering the box before tMax
+        with np.errstate(invalid='ignore'):
+            _t1 = (self._nodeMin[nodes] - origins) * inverseDirections
+            _t2 = (self._nodeMax[nodes] - origins) * inverseDirections
+            _tNear = np.fmax(np.fmax(np.fmin(_t1[:, 0], _t2[:, 0]), np.fmin(_t1[:, 1], _t2[:, 1])), np.fmin(_t1[:, 2], _t2[:, 2]))
+            _tFar = np.fmin(np.fmin(np.fmax(_t1[:, 0], _t2[:, 0]), np.fmax(_t1[:, 1], _t2[:, 1])), np.fmax(_t1[:, 2], _t2[:, 2]))
+        return (_tNear <= _tFar) & (_tFar >= 0.0) & (_tNear <= tMax)
+
+    def _leafFacePairs(self, rayIds, nodes):
+        # Expands (ray, leaf) pairs into one (ray, face) pair per face of the leaf
+        _counts = self._nodeCount[nodes].astype(np.int64)
+        _total = int(_counts.sum())
+        _firstPair = np.cumsum(_counts) - _counts
+        _positions = np.repeat(self._nodeStart[nodes].astype(np.int64) - _firstPair, _counts) + np.arange(_total)
+        return np.repeat(rayIds, _counts), self._faceOrder[_positions]
+
+    def _childPairs(self, rayIds, nodes):
+        _children = self._nodeChild[nodes].astype(np.int64)
+        return np.concatenate([rayIds, rayIds]), np.concatenate([_children, _children + 1])
+
+
+def bvhFromArrays(arrays):
+    _bvh = BVH()
+    _bvh._nodeMin = arrays['bvhNodeMin']
+    _bvh._nodeMax = arrays['bvhNodeMax']
+    _bvh._nodeChild = arrays['bvhNodeChild']
+    _bvh._nodeStart = arrays['bvhNodeStart']
+    _bvh._nodeCount = arrays['bvhNodeCount']
+    _bvh._faceOrder = arrays['bvhFaceOrder']
+    return _bvh
+
+
+def _surfaceArea(boxMin, boxMax):
+    _size = np.maximum(boxMax - boxMin, 0.0)
+    return 2.0 * (_size[:, 0] * _size[:, 1] + _size[:, 1] * _size[:, 2] + _size[:, 2] * _size[:, 0])
@@ -0,0 +1,155 @@
+'''
+    This module implements the checkpoints of long ray-tracing runs, so that
+    a run stopped half way (e.g. a pre-empted node) can be restarted without
+    tracing again the chunks of work it had already finished.
+
+    A checkpoint is a directory with a JSON header holding the key of the
+    run (geometry hash and parameters) and, for every worker process that
+    took part, a data file and a log named after its host and process ID
+    (nodes of a task broker can share one directory). When a worker finishes a chunk it
+    appends the non-zero cells of its echogram to its data file and, once
+    they are on disk, a line describing them to its log. Nothing is ever
+    rewritten, and a chunk cut short by a crash simply has no complete log
+    line. On resume the logged chunks are skipped and their cells are added
+    back from memory maps of the data files.
+
+    Joe Simon 2018.
+'''
+
+
+import os
+import re
+import json
+import socket
+import hashlib
+import numpy as np
+
+
+CHECKPOINT_EXTENSION = '.w3dcheckpoint'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_HEADER = 'checkpoint.json'
+
+# Counters of TracerEngineResults kept with every chunk
+CHECKPOINT_COUNTERS = ['_raysTraced', '_raysTerminated', '_segmentsTraced', '_intersectionTests', '_imageSources', '_imageSourcePaths', '_tracingTime']
+
+
+def checkpointKey(*parts):
+    # Hash of the given values; arrays count with their type, shape and content
+    _hash = hashlib.blake2b(digest_size=20)
+    for _part in parts:
+        if isinstance(_part, np.ndarray):
+            _array = np.ascontiguousarray(_part)
+            _hash.update(("%s%s" % (_array.dtype.str, str(_array.shape))).encode('utf-8'))
+            _hash.update(_array.tobytes())
+        else:
+            _hash.update(repr(_part).encode('utf-8'))
+        _hash.update(b'\0')
+    return _hash.hexdigest()
+
+
+def _processName():
+    # Host and process ID of the caller, usable in a file name
+    return "%s-%d" % (re.sub(r'[^A-Za-z0-9._-]', '_', socket.gethostname()), os.getpid())
+
+
+class TracingCheckpoint:
+    def __init__(self, directory, runKey):
+        self._directory = directory
+        self._runKey = runKey
+
+    def open(self):
+        # Returns True when resuming a checkpoint of the same run. A checkpoint
+        # of another run (or format version) is discarded.
+        _header = self._readHeader()
+        if _header is not None and _header['runKey'] == self._runKey and _header['version'] == CHECKPOINT_VERSION:
+            return True
+        if os.path.isdir(self._directory):
+            for _name in os.listdir(self._directory):
+                if _name == CHECKPOINT_HEADER or _name.startswith('chunks-') or _name.startswith('data-'):
+                    os.remove(os.path.join(self._directory, _name))
+        os.makedirs(self._directory, exist_ok=True)
+        with open(os.path.join(self._directory, CHECKPOINT_HEADER), 'w') as _file:
+            json.dump({'version': CHECKPOINT_VERSION, 'runKey': self._runKey}, _file)
+        return False
+
+    def _readHeader(self):
+        try:
+            with open(os.path.join(self._directory, CHECKPOINT_HEADER), 'r') as _file:
+                return json.load(_file)
+        except (OSError, ValueError):
+            return None
+
+    def _records(self):
+        # Complete log lines of all the processes, torn lines are skipped
+        if not os.path.isdir(self._directory):
+            return
+        for _name in sorted(os.listdir(self._directory)):
+            if not _name.startswith('chunks-'):
+                continue
+            with open(os.path.join(self._directory, _name), 'r') as _file:
+                for _line in _file:
+                    if not _line.endswith('\n'):
+                        continue
+                    try:
+                        yield json.loads(_line)
+                    except ValueError:
+                        continue
+
+    def completedChunks(self):
+        return set([_record['chunk'] for _record in self._records()])
+
+    def load(self, results, chunks=None):
+        # Adds the counters and echogram cells of the completed chunks (only
+        # those in 'chunks' if given, every one once) to 'results' (a
+        # TracerEngineResults with its echogram allocated)
+        _echogram = results._echogram
+        _cellShape = (_echogram.shape[0], _echogram.shape[1], _echogram.shape[3])
+        _bands = np.arange(_echogram.shape[2])
+        _loaded = set()
+        for _record in self._records():
+            if _record['chunk'] in _loaded or (chunks is not None and not _record['chunk'] in chunks):
+                continue
+            _loaded.add(_record['chunk'])
+            for _counter in CHECKPOINT_COUNTERS:
+                setattr(results, _counter, getattr(results, _counter) + _record['counters'][_counter])
+            if _record['count'] > 0:
+                _filename = os.path.join(self._directory, _record['data'])
+                _cells = np.memmap(_filename, dtype=np.int64, mode='r', offset=_record['offset'], shape=(_record['count'],))
+                _values = np.memmap(_filename, dtype=np.float64, mode='r', offset=_record['offset'] + 8 * _record['count'], shape=(_record['count'], len(_bands)))
+                _sources, _receivers, _bins = np.unravel_index(np.asarray(_cells), _cellShape)
+                np.add.at(_echogram, (_sources[:, None], _receivers[:, None], _bands[None, :], _bins[:, None]), np.asarray(_values))
+        return len(_loaded)
+
+    def record(self, chunkKey, results, pairs):
+        # Appends the results of one chunk, from the calling process. Its
+        # echogram blocks are stored as cells of the echogram of the run,
+        # with 'pairs' (sources, receivers).
+        _cells = [np.zeros(0, dtype=np.int64)]
+        _values = [np.zeros((0, len(results._frequencyBands)))]
+        for _sources, _receivers, _block in results._blocks.values():
+            _blockSources, _blockReceivers, _bins = np.nonzero(np.any(_block != 0.0, axis=2))
+            _cells.append(np.ravel_multi_index((_sources[_blockSources], _receivers[_blockReceivers], _bins), (pairs[0], pairs[1], _block.shape[3])))
+            _values.append(_block[_blockSources, _blockReceivers, :, _bins])
+        _cells = np.concatenate(_cells)
+        _values = np.concatenate(_values)
+
+        _dataName = 'data-%s.bin' % _processName()
+        with open(os.path.join(self._directory, _dataName), 'ab') as _file:
+            _offset = _file.tell()
+            _file.write(_cells.astype(np.int64).tobytes())
+            _file.write(np.ascontiguousarray(_values, dtype=np.float64).tobytes())
+            _file.flush()
+            os.fsync(_file.fileno())
+
+        _record = {'chunk': chunkKey, 'data': _dataName, 'offset': _offset, 'count': len(_cells),
+                   'counters': dict([(_counter, getattr(results, _counter)) for _counter in CHECKPOINT_COUNTERS])}
+        with open(os.path.join(self._directory, 'chunks-%s.log' % _processName()), 'ab+') as _file:
+            # A line torn by a crash of an earlier process with the same ID is ended first
+            _line = json.dumps(_record) + '\n'
+            if _file.tell() > 0:
+                _file.seek(-1, os.SEEK_END)
+                if not _file.read(1) == b'\n':
+                    _line = '\n' + _line
+            _file.write(_line.encode('utf-8'))
+            _file.flush()
+            os.fsync(_file.fileno())
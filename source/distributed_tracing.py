@@ -0,0 +1,405 @@
+'''
+    This module spreads the chunks of work of the ray-tracer over several
+    machines. A task broker (a "multiprocessing.managers" server listening on
+    TCP) holds a queue of jobs, every job being the list of chunks of one
+    run, and the compiled scenes of those jobs, stored by the hash of their
+    arrays while a tracer holds them or a job of theirs is not finished. Any number of nodes connect to it, each one running some worker
+    processes that keep pulling chunks, trace them and fold the results of
+    all their chunks of a job into a single one, pushed back to the broker
+    as soon as the queue has no more chunks of that job for them. A worker
+    fetches a scene from the broker the first time a chunk needs it and
+    keeps it for later jobs.
+
+    Every chunk taken is leased to the worker that took it until its results
+    are pushed. Workers renew their leases from a heartbeat thread, and the
+    chunks of a worker not heard of for CHUNK_LEASE_TIMEOUT seconds (one
+    that died or lost its connection) are queued again for the others.
+
+    The ray-tracer submits its chunks to the broker instead of the local
+    pool after "RayTracer.useBroker", and joins the partial results pushed
+    by the nodes. Broker and nodes can run on the same machine, which is
+    how scaling is measured:
+
+        python distributed_tracing.py broker 0.0.0.0:5000
+        python distributed_tracing.py node broker-host:5000 8
+
+    Joe Simon 2018.
+'''
+
+
+import sys
+import time
+import threading
+import collections
+import multiprocessing as mp
+from multiprocessing.managers import BaseManager
+from logger import *
+
+
+DEFAULT_BROKER_AUTHKEY = b'work3d'
+# Seconds an idle node waits for a chunk before checking the broker again
+NODE_POLL_INTERVAL = 1.0
+# Seconds a node worker may go without contacting the broker before the
+# chunks it took are queued again; workers renew every quarter of it
+CHUNK_LEASE_TIMEOUT = 30.0
+
+# Scenes fetched by this process, by hash
+_remoteScenes = {}
+# Broker of the node worker running in this process
+_nodeBroker = None
+
+
+class TaskBroker:
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._chunks = collections.deque()
+        self._jobs = {}
+        self._nextJob = 0
+        self._scenes = {}
+        # Tracers holding every scene
+        self._sceneHolders = collections.Counter()
+        self._closed = False
+        # Node workers by name: last contact and the (job ID, chunk) leased
+        self._nodes = {}
+
+
+    def hasScene(self, sceneHash):
+        with self._condition:
+            return sceneHash in self._scenes
+
+
+    def acquireScene(self, sceneHash):
+        # Holds the scene if the broker has it, otherwise it has to be published
+        with self._condition:
+            if not sceneHash in self._scenes:
+                return False
+            self._sceneHolders[sceneHash] += 1
+            return True
+
+
+    def publishScene(self, sceneHash, arrays):
+        # Stores and holds the scene, until releaseScene
+        with self._condition:
+            if not sceneHash in self._scenes:
+                self._scenes[sceneHash] = arrays
+            self._sceneHolders[sceneHash] += 1
+
+
+    def releaseScene(self, sceneHash):
+        # The scene is dropped once no tracer holds it and no job uses it
+        with self._condition:
+            if self._sceneHolders[sceneHash] > 0:
+                self._sceneHolders[sceneHash] -= 1
+            self._dropUnusedScene(sceneHash)
+
+
+    def scene(self, sceneHash):
+        with self._condition:
+            if not sceneHash in self._scenes:
+                raise Exception("Scene '%s' was never published to the broker!" % sceneHash)
+            return self._scenes[sceneHash]
+
+
+    def submit(self, chunks, sceneHash=None, sharedArgs=()):
+        # Queues the chunks of a new job on the scene and returns its ID. The
+        # shared arguments of the job are fetched once by every node worker.
+        with self._condition:
+            _jobId = self._nextJob
+            self._nextJob += 1
+            self._jobs[_jobId] = {'chunks': len(chunks), 'queued': len(chunks), 'done': 0, 'results': [], 'nodes': set(), 'expired': set(), 'scene': sceneHash,
+                                  'sharedArgs': tuple(sharedArgs)}
+            for _chunk in chunks:
+                self._chunks.append((_jobId, _chunk))
+            self._condition.notify_all()
+            return _jobId
+
+
+    def take(self, nodeName, timeout=None):
+        # Returns (job ID, chunk, chunks of the job still queued) or None if
+        # there was no work within 'timeout' seconds
+        with self._condition:
+            self._node(nodeName)
+            self._requeueExpired()
+            if not self._condition.wait_for(lambda: len(self._chunks) > 0 or self._closed, timeout):
+                return None
+            if len(self._chunks) == 0:
+                return None
+            _jobId, _chunk = self._chunks.popleft()
+            _job = self._jobs[_jobId]
+            _job['queued'] -= 1
+            _job['nodes'].add(nodeName)
+            self._node(nodeName)['leases'].append((_jobId, _chunk))
+            return _jobId, _chunk, _job['queued']
+
+
+    def sharedArgs(self, jobId):
+        with self._condition:
+            return self._jobs[jobId]['sharedArgs']
+
+
+    def pushResults(self, jobId, results, chunks, nodeName=None):
+        # List of results of 'chunks' chunks of the job, usually already
+        # reduced to one by the node, which acknowledges all its leases on
+        # the job. Results of a node whose leases expired are dropped, as
+        # its chunks were queued again.
+        with self._condition:
+            if not jobId in self._jobs:
+                return
+            _job = self._jobs[jobId]
+            if nodeName is not None:
+                if nodeName in _job['expired']:
+                    _job['expired'].discard(nodeName)
+                    self._requeue(nodeName, jobId)
+                    getLogger().log(LogLevel.Warn, "Dropped the results of node worker '%s' on job %d, its leases had expired." % (nodeName, jobId))
+                    return
+                _node = self._node(nodeName)
+                _node['leases'] = [_lease for _lease in _node['leases'] if not _lease[0] == jobId]
+            _job['results'].extend(results)
+            _job['done'] += chunks
+            self._condition.notify_all()
+
+
+    def renew(self, nodeName):
+        # Heartbeat of a node worker, keeps its leases
+        with self._condition:
+            self._node(nodeName)
+
+
+    def waitJob(self, jobId, timeout=None):
+        # True once the results of all the chunks of the job are in. Wakes up
+        # now and then to requeue expired leases, in case no node is polling.
+        _end = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while not self._jobs[jobId]['done'] >= self._jobs[jobId]['chunks']:
+                self._requeueExpired()
+                _wait = CHUNK_LEASE_TIMEOUT / 4
+                if _end is not None:
+                    _wait = min(_wait, _end - time.time())
+                    if _wait <= 0:
+                        return False
+                self._condition.wait(_wait)
+            return True
+
+
+    def jobResults(self, jobId):
+        # Partial results of a finished job and the nodes that took part; the job is forgotten
+        with self._condition:
+            _job = self._jobs.pop(jobId)
+            self._dropUnusedScene(_job['scene'])
+            return _job['results'], sorted(_job['nodes'])
+
+
+    def _dropUnusedScene(self, sceneHash):
+        if self._sceneHolders[sceneHash] > 0 or any([_job['scene'] == sceneHash for _job in self._jobs.values()]):
+            return
+        self._scenes.pop(sceneHash, None)
+        del self._sceneHolders[sceneHash]
+
+
+    def _node(self, nodeName):
+        # Entry of a node worker, marked as just heard of
+        _node = self._nodes.setdefault(nodeName, {'seen': 0.0, 'leases': []})
+        _node['seen'] = time.time()
+        return _node
+
+
+    def _requeue(self, nodeName, jobId=None):
+        # Puts the chunks leased to the node (of one job or all) back at the
+        # front of the queue
+        _node = self._nodes.get(nodeName, {'leases': []})
+        _kept = []
+        for _lease in _node['leases']:
+            if jobId is not None and not _lease[0] == jobId:
+                _kept.append(_lease)
+            elif _lease[0] in self._jobs:
+                self._chunks.appendleft(_lease)
+                self._jobs[_lease[0]]['queued'] += 1
+        _node['leases'] = _kept
+        self._condition.notify_all()
+
+
+    def _requeueExpired(self):
+        # Requeues the chunks of the node workers not heard of in a while
+        _now = time.time()
+        for _nodeName, _node in list(self._nodes.items()):
+            if _now - _node['seen'] < CHUNK_LEASE_TIMEOUT:
+                continue
+            _jobs = set([_lease[0] for _lease in _node['leases'] if _lease[0] in self._jobs])
+            if len(_jobs) > 0:
+                getLogger().log(LogLevel.Warn, "Node worker '%s' was not heard of for %.0f s, requeued its %d chunk(s)." % (_nodeName, _now - _node['seen'], len(_node['leases'])))
+            for _jobId in _jobs:
+                self._jobs[_jobId]['expired'].add(_nodeName)
+            self._requeue(_nodeName)
+            del self._nodes[_nodeName]
+
+
+    def isClosed(self):
+        with self._condition:
+            return self._closed
+
+
+    def close(self):
+        # Nodes stop once the queue is empty
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+_taskBroker = None
+
+
+def _getTaskBroker():
+    # One broker per server process, shared by all its clients
+    global _taskBroker
+    if _taskBroker is None:
+        _taskBroker = TaskBroker()
+    return _taskBroker
+
+
+class TaskBrokerManager(BaseManager):
+    pass
+
+
+TaskBrokerManager.register('TaskBroker', _getTaskBroker)
+
+
+def parseAddress(address):
+    # "host:port" or (host, port)
+    if isinstance(address, str):
+        _host, _, _port = address.rpartition(':')
+        return (_host, int(_port))
+    return tuple(address)
+
+
+def startBroker(address=('127.0.0.1', 0), authkey=DEFAULT_BROKER_AUTHKEY):
+    # Starts a broker in a child process and returns its manager; the address
+    # it listens on is in "manager.address" (port 0 picks a free one)
+    _manager = TaskBrokerManager(address=parseAddress(address), authkey=authkey)
+    _manager.start()
+    getLogger().log(LogLevel.Info, "Task broker listening on %s:%d." % tuple(_manager.address))
+    return _manager
+
+
+def serveBroker(address, authkey=DEFAULT_BROKER_AUTHKEY):
+    # Runs a broker in this process until it is killed
+    _manager = TaskBrokerManager(address=parseAddress(address), authkey=authkey)
+    _server = _manager.get_server()
+    getLogger().log(LogLevel.Info, "Task broker listening on %s:%d." % tuple(_server.address))
+    _server.serve_forever()
+
+
+def connectBroker(address, authkey=DEFAULT_BROKER_AUTHKEY):
+    # Returns a proxy of the broker at 'address'
+    _manager = TaskBrokerManager(address=parseAddress(address), authkey=authkey)
+    _manager.connect()
+    return _manager.TaskBroker()
+
+
+class RemoteSceneHandle:
+    # Stands for SharedSceneHandle in the chunks sent to nodes
+    def __init__(self, sceneHash):
+        self._sceneHash = sceneHash
+
+    def key(self):
+        return self._sceneHash
+
+    def attach(self):
+        if not self._sceneHash in _remoteScenes:
+            if _nodeBroker is None:
+                raise Exception("Remote scenes can only be attached by node workers!")
+            _remoteScenes[self._sceneHash] = _nodeBroker.scene(self._sceneHash)
+        return _remoteScenes[self._sceneHash]
+
+    def __str__(self):
+        return "Remote scene: %s" % self._sceneHash
+
+
+def workOnBroker(target, address, authkey=DEFAULT_BROKER_AUTHKEY, reduce=None, workerId=0, nodeName=None):
+    # Runs the target on chunks pulled from the broker until it is closed,
+    # with the shared arguments of their job. The results of the chunks of
+    # one job are folded with reduce(accumulated, new) and pushed when the
+    # worker gets no more chunks of that job, before it blocks waiting for
+    # new work.
+    global _nodeBroker
+    _nodeBroker = connectBroker(address, authkey)
+    if nodeName is None:
+        nodeName = mp.current_process().name
+    _log = getLogger()
+    _pending = {}
+    _chunks = collections.Counter()
+    _sharedArgs = {}
+    _stopped = threading.Event()
+
+    def _push(jobId):
+        _nodeBroker.pushResults(jobId, _pending.pop(jobId), _chunks.pop(jobId), nodeName)
+
+    def _heartbeat():
+        # The proxy opens a connection of its own for this thread
+        try:
+            while not _stopped.wait(CHUNK_LEASE_TIMEOUT / 4):
+                _nodeBroker.renew(nodeName)
+        except (EOFError, OSError):
+            pass
+    threading.Thread(target=_heartbeat, daemon=True).start()
+
+    while True:
+        _task = _nodeBroker.take(nodeName, 0)
+        if _task is None:
+            for _jobId in list(_pending.keys()):
+                _push(_jobId)
+            _task = _nodeBroker.take(nodeName, NODE_POLL_INTERVAL)
+        if _task is None:
+            if _nodeBroker.isClosed():
+                break
+            continue
+        _jobId, _chunk, _queued = _task
+        for _otherJob in [_other for _other in _pending.keys() if not _other == _jobId]:
+            _push(_otherJob)
+
+        if not _jobId in _sharedArgs:
+            _sharedArgs.clear()
+            _sharedArgs[_jobId] = _nodeBroker.sharedArgs(_jobId)
+        _result = target(_chunk, workerId, *_sharedArgs[_jobId])
+        _results = _pending.setdefault(_jobId, [])
+        if reduce is not None and len(_results) > 0:
+            _results[0] = reduce(_results[0], _result)
+        else:
+            _results.append(_result)
+        _chunks[_jobId] += 1
+        if _queued == 0:
+            _push(_jobId)
+    _stopped.set()
+    _log.log(LogLevel.Info, "Node worker '%s' stopped, the broker was closed." % nodeName)
+
+
+def startNode(target, address, authkey=DEFAULT_BROKER_AUTHKEY, processes=None, reduce=None, nodeName=None):
+    # Starts the worker processes of a node, returns them
+    if processes is None:
+        processes = mp.cpu_count()
+    if nodeName is None:
+        nodeName = "%s-%d" % (mp.current_process().name, int(time.time() * 1000) % 100000)
+    _processes = [mp.Process(target=workOnBroker, args=(target, parseAddress(address), authkey, reduce, i, "%s/%d" % (nodeName, i)), daemon=True) for i in range(processes)]
+    for _process in _processes:
+        _process.start()
+    getLogger().log(LogLevel.Info, "Node '%s' started %d worker process(es) on broker %s:%d." % ((nodeName, processes) + parseAddress(address)))
+    return _processes
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or not sys.argv[1] in ('broker', 'node'):
+        print("Usage: distributed_tracing.py broker HOST:PORT")
+        print("       distributed_tracing.py node BROKER_HOST:PORT [PROCESSES]")
+        sys.exit(1)
+
+    _log = Logger()
+    _log.start()
+    if sys.argv[1] == 'broker':
+        serveBroker(sys.argv[2])
+    else:
+        from ray_tracing import RayTracer
+        from ray_tracing_classes import TracerEngineResults
+        _processes = startNode(RayTracer.tracerEngine, sys.argv[2], processes=int(sys.argv[3]) if len(sys.argv) > 3 else None, reduce=TracerEngineResults.add)
+        for _process in _processes:
+            _process.join()
+    _log.stop()
@@ -8,9 +8,60 @@
 
 
 import numpy as np
+import bisect
+import warnings
 import xml.etree.ElementTree
 from logger import *
 from geometry_classes import *
+from geometry_cache import *
+from bvh import *
+
+
+# Scene caches are opt-in, here or per load with 'useCache'
+USE_SCENE_CACHE = False
+# Cache files next to the DAE files instead of in the user cache directory
+SCENE_CACHE_NEXT_TO_SOURCE = False
+
+
+# Index of all the elements of an XML tree by their local (namespace-stripped)
+# tag name, built in a single traversal. Every element gets its position in
+# document order and the size of its subtree, so looking for a tag inside any
+# subtree is a couple of bisections in the list of elements with that name.
+class TagIndex:
+    def __init__(self, root):
+        self._positions = {}
+        self._subtreeSizes = []
+        self._byName = {}
+        self._build(root)
+
+    def _build(self, root):
+        _elements = list(root.iter())
+        for _position, _element in enumerate(_elements):
+            self._positions[_element] = _position
+            if not isinstance(_element.tag, str):
+                continue
+            _name = _element.tag.split('}')[-1]
+            if _name not in self._byName:
+                self._byName[_name] = ([], [])
+            self._byName[_name][0].append(_position)
+            self._byName[_name][1].append(_element)
+
+        # Children always come after their parent, so a reverse pass is enough
+        self._subtreeSizes = [1] * len(_elements)
+        for _position in range(len(_elements) - 1, -1, -1):
+            for _child in _elements[_position]:
+                self._subtreeSizes[_position] += self._subtreeSizes[self._positions[_child]]
+
+    def contains(self, element):
+        return element in self._positions
+
+    def findAll(self, root, name):
+        if name not in self._byName:
+            return []
+        _start = self._positions[root]
+        _end = _start + self._subtreeSizes[_start]
+        _namePositions, _nameElements = self._byName[name]
+        return _nameElements[bisect.bisect_left(_namePositions, _start):bisect.bisect_left(_namePositions, _end)]
 
 
 class LibraryGeometries:
@@ -23,6 +74,17 @@ class LibraryGeometries:
         self._visualScenes = []
         self._materials = []
         self._effects = []
+        self._tagIndex = None
+        self._decodedArrays = {}
+        self._materialTable = MaterialTable()
+        self._contentHash = None
+        self._bvh = None
+        self._precision = 'float64'
+        # Only the compiled arrays are restored from a scene cache
+        self._restoredFromCache = False
+        # (DAE filename, content hash, next to source) of the scene cache the
+        # BVH is added to when it is built
+        self._cacheTarget = None
 
     def __str__(self):
         _meshesString = ""
@@ -33,132 +95,290 @@ class LibraryGeometries:
         self.loadGeometryFromString()
 
     def loadGeometryFromString(self, string, stopAtException=True):
-        _root = xml.etree.ElementTree.fromstring(_exampleXML)
+        _root = xml.etree.ElementTree.fromstring(string)
         self._loadFromXML(_root, stopAtException)
 
-    def loadGeometryFromFile(self, filename, stopAtException=True):
+    def loadGeometryFromFile(self, filename, stopAtException=True, streaming=False, useCache=None, precision=None, cacheNextToSource=None):
+        if useCache is None:
+            useCache = USE_SCENE_CACHE
+        if cacheNextToSource is None:
+            cacheNextToSource = SCENE_CACHE_NEXT_TO_SOURCE
+
+        _contentHash = None
+        self._cacheTarget = None
+        if useCache:
+            _loaded, _contentHash = self._loadFromCache(filename, cacheNextToSource)
+            if _loaded:
+                if precision is not None:
+                    self.setPrecision(precision)
+                return True
+            if _contentHash is None:
+                _contentHash = fileContentHash(filename)
+
+        if streaming:
+            self._loadFromXMLStream(filename, stopAtException)
+        else:
+            try:
+                self._log.log(LogLevel.Info, "Trying to load data from file '%s'." % filename)
+                _root = xml.etree.ElementTree.parse(filename).getroot()
+            except Exception as ex:
+                self._log.log(LogLevel.Ex, "The file '%s' cannot be parsed as XML." % filename)
+                self._log.log(LogLevel.Ex, "Exception message: %s" % str(ex))
+                raise ex
+                return False
+
+            self._loadFromXML(_root, stopAtException)
+
+        if useCache:
+            self._writeCache(filename, _contentHash, cacheNextToSource)
+        # The cache always keeps the parsed precision
+        if precision is not None:
+            self.setPrecision(precision)
+        return True
+
+    def setPrecision(self, precision):
+        # Stores the points and vertices of the formed triangles and lines as
+        # 'float64' or 'float32'; the acceleration structure is built from them
+        _dtype = precisionType(precision)
+        self._precision = precision
+        if self._formedTriangles is not None and not self._formedTriangles._vertices.dtype == _dtype:
+            self._formedTriangles._points = self._formedTriangles._points.astype(_dtype)
+            self._formedTriangles._vertices = self._formedTriangles._vertices.astype(_dtype)
+            self._bvh = None
+            # The scene cache keeps the parsed precision
+            self._cacheTarget = None
+        if self._formedLines is not None:
+            self._formedLines._points = self._formedLines._points.astype(_dtype)
+
+    def _loadFromCache(self, filename, nextToSource=False, contentHash=None):
+        # Returns (loaded, content hash of the file if it was computed)
+        _cacheFilename = sceneCacheFilename(filename, nextToSource)
         try:
-            self._log.log(LogLevel.Info, "Trying to load data from file '%s'." % filename)
-            _root = xml.etree.ElementTree.parse(filename).getroot()
+            _arrays, _metadata, contentHash = readSceneCache(_cacheFilename, filename, contentHash)
         except Exception as ex:
-            self._log.log(LogLevel.Ex, "The file '%s' cannot be parsed as XML." % filename)
-            self._log.log(LogLevel.Ex, "Exception message: %s" % str(ex))
-            raise ex
-            return False
+            self._log.log(LogLevel.Warn, "The scene cache '%s' cannot be read: %s" % (_cacheFilename, str(ex)))
+            return False, contentHash
+        if _arrays is None:
+            return False, contentHash
+
+        self._contentHash = contentHash
+        self._restoreCompiled(_arrays, _metadata)
+        if self._bvh is None:
+            self._cacheTarget = (filename, contentHash, nextToSource)
+        self._log.log(LogLevel.Info, "Loaded %d triangle(s) and %d line(s) from scene cache '%s'." % (len(self._formedTriangles), len(self._formedLines), _cacheFilename))
+        return True, contentHash
+
+    def _writeCache(self, filename, contentHash, nextToSource=False):
+        _cacheFilename = sceneCacheFilename(filename, nextToSource)
+        try:
+            _arrays, _metadata = self._compiledData()
+            writeSceneCache(_cacheFilename, filename, contentHash, _arrays, _metadata)
+            self._contentHash = contentHash
+            self._cacheTarget = None if self._bvh is not None else (filename, contentHash, nextToSource)
+            self._log.log(LogLevel.Info, "Wrote scene cache '%s'." % _cacheFilename)
+        except Exception as ex:
+            self._log.log(LogLevel.Warn, "The scene cache '%s' cannot be written: %s" % (_cacheFilename, str(ex)))
+
+    def getAccelerationStructure(self):
+        # Built on first use and kept; the scene cache of the geometry, if
+        # any, is written again with it
+        if self._bvh is None:
+            self._bvh = BVH().build(self._formedTriangles._vertices)
+            self._log.log(LogLevel.Info, "Built %s." % str(self._bvh))
+            if self._cacheTarget is not None:
+                self._writeCache(*self._cacheTarget)
+        return self._bvh
+
+    def _compiledData(self):
+        # Everything the tracer needs, as arrays plus a small JSON-able header
+        _arrays = {'trianglePoints': self._formedTriangles._points,
+                   'triangleVertices': self._formedTriangles._vertices,
+                   'triangleIndices': self._formedTriangles._indices,
+                   'triangleMaterialIds': self._formedTriangles._materialIds,
+                   'triangleColorIds': self._formedTriangles._colorIds,
+                   'linePoints': self._formedLines._points,
+                   'lineEdges': self._formedLines._edges,
+                   'lineIndices': self._formedLines._indices}
+        if self._bvh is not None:
+            _arrays.update(self._bvh.toArrays())
+
+        _table = self._materialTable
+        _metadata = {'asset': None if self._asset is None else vars(self._asset),
+                     'materials': [[_material._id, _material._name, _material._url] for _material in _table._materials],
+                     'colors': [None if _color is None else [float(_c) for _c in _color] for _color in _table._colors],
+                     'colorIndexByMaterial': _table._colorIndexByMaterial,
+                     'bindings': [[_url, _symbol, _index] for (_url, _symbol), _index in _table._bindings.items()]}
+        return _arrays, _metadata
+
+    def _restoreCompiled(self, arrays, metadata):
+        if metadata['asset'] is not None:
+            self._asset = Asset()
+            for _key, _value in metadata['asset'].items():
+                setattr(self._asset, _key, _value)
 
-        self._loadFromXML(_root, stopAtException)
+        self._materials = []
+        for _id, _name, _url in metadata['materials']:
+            _material = Material()
+            _material._id = _id
+            _material._name = _name
+            _material._url = _url
+            self._materials.append(_material)
+
+        self._materialTable = MaterialTable()
+        self._materialTable._materials = self._materials
+        self._materialTable._colors = [None if _color is None else np.array(_color) for _color in metadata['colors']]
+        self._materialTable._colorIndexByMaterial = metadata['colorIndexByMaterial']
+        self._materialTable._materialIndexById = {"#%s" % _material._id: i for i, _material in reversed(list(enumerate(self._materials)))}
+        self._materialTable._bindings = {(_url, _symbol): _index for _url, _symbol, _index in metadata['bindings']}
+
+        self._formedTriangles = TriangleMesh()
+        self._formedTriangles._points = arrays['trianglePoints']
+        self._formedTriangles._vertices = arrays['triangleVertices']
+        self._formedTriangles._indices = arrays['triangleIndices']
+        self._formedTriangles._materialIds = arrays['triangleMaterialIds']
+        self._formedTriangles._colorIds = arrays['triangleColorIds']
+        self._formedTriangles._materials = self._materialTable._materials
+        self._formedTriangles._colors = self._materialTable._colors
+
+        self._formedLines = LineMesh()
+        self._formedLines._points = arrays['linePoints']
+        self._formedLines._edges = arrays['lineEdges']
+        self._formedLines._indices = arrays['lineIndices']
+
+        self._bvh = bvhFromArrays(arrays) if 'bvhNodeMin' in arrays else None
+        self._geometries = []
+        self._visualScenes = []
+        self._effects = []
+        self._restoredFromCache = True
+
+    def _requireParsedData(self, action):
+        # The DAE data of a geometry restored from a scene cache is not kept
+        if self._restoredFromCache:
+            raise Exception("Cannot %s, the geometry was restored from a scene cache without its DAE data (load it with 'useCache=False')!" % action)
 
     def _loadFromXML(self, _root, stopAtException=True):
+        self._restoredFromCache = False
 
         self._log.log(LogLevel.Info, "File open. Loading geometries ...")
         logDepth = 0
+        self._tagIndex = TagIndex(_root)
 
         # Load asset (general info)
-        try:
-            _asset = self._findAll(_root, "asset", logDepth + 1)[0]
-            _contributor = self._findAll(_asset, "contributor", logDepth + 1)[0]
-            self._asset = Asset()
-            self._asset.authoringTool = self._findAll(_contributor, "authoring_tool", logDepth + 1)
-
-            self._asset.created = self._findAll(_asset, "created", logDepth + 1)[0].text
-            self._asset.modified = self._findAll(_asset, "modified", logDepth + 1)[0].text
-            self._asset.created = self._findAll(_asset, "created", logDepth + 1)[0].text
-
-            _unit = self._findAll(_asset, "unit", logDepth + 1)[0]
-            self._asset.unitMeter = _unit.attrib.get('meter')
-            self._asset.unitName = _unit.attrib.get('name')
-
-        except Exception as ex:
-            self._log.log(LogLevel.Err, "An exception ocurred while parsing the file header (asset).")
-            self._log.log(LogLevel.Err, "Exception message: %s" % ex)
-            if stopAtException:
-                raise ex
+        _assets = self._findAll(_root, "asset", logDepth + 1)
+        self._loadSection("asset", _assets[0] if len(_assets) > 0 else None, stopAtException, logDepth)
 
         # Load the visual scenes
-        try:
-            _readVisualScenesLib = self._findAll(_root, "library_visual_scenes")
-            self._log.log(LogLevel.Info, "Found %d visual scenes libraries." % len(_readVisualScenesLib))
-            for _lib in _readVisualScenesLib:
+        _readVisualScenesLib = self._findAll(_root, "library_visual_scenes")
+        self._log.log(LogLevel.Info, "Found %d visual scenes libraries." % len(_readVisualScenesLib))
+        for _lib in _readVisualScenesLib:
+            self._loadSection("library_visual_scenes", _lib, stopAtException, logDepth)
 
-                _visualScenes = self._findAll(_lib, "visual_scene")
-                self._log.log(LogLevel.Info, "Found %d visual scene(s) in library." % len(_visualScenes))
+        # Load the materials
+        for _lib in self._findAll(_root, "library_materials", logDepth + 1):
+            self._loadSection("library_materials", _lib, stopAtException, logDepth)
 
-                for _visualScene in _visualScenes:
-                    _newVisualScene = VisualScene()
-                    _newVisualScene._id = _visualScene.attrib.get('id')
+        # Load the effects
+        _readEffectsLibrary = self._findAll(_root, "library_effects", logDepth + 1)
+        self._log.log(LogLevel.Info, "Found %d effects libraries." % len(_readEffectsLibrary))
+        for _lib in _readEffectsLibrary:
+            self._loadSection("library_effects", _lib, stopAtException, logDepth)
 
-                    _instanceGeometries = self._findAll(_visualScene, "instance_geometry", logDepth + 1)
-                    _newVisualScene._instanceGeometries = [(self._parseInstanceGeometry(_inst, logDepth + 1)) for _inst in _instanceGeometries]
-                    self._visualScenes.append(_newVisualScene)
+        # Load geometries
+        _readGeometries = self._findAll(_root, "geometry", logDepth + 1)
+        self._log.log(LogLevel.Info, "Found %d geometries." % len(_readGeometries))
+        for _geometry in _readGeometries:
+            self._loadSection("geometry", _geometry, stopAtException, logDepth)
 
-        except Exception as ex:
-            self._log.log(LogLevel.Err, "An exception ocurred while parsing the file (library_visual_scenes). Stopping.")
-            self._log.log(LogLevel.Err, "Exception message: %s" % ex)
-            if stopAtException:
-                raise ex
+        self._tagIndex = None
+        self._formGeometry(stopAtException)
+        return True
 
-        # Load the materials
+    def _loadFromXMLStream(self, filename, stopAtException=True):
+        # Incremental version of '_loadFromXML': every top-level block is parsed
+        # as soon as it closes and then dropped from the tree, number arrays in
+        # geometries are decoded as they close, so only the object model and
+        # the DOM of the geometry being read are in memory at any time.
+        self._log.log(LogLevel.Info, "Trying to stream data from file '%s'." % filename)
+        self._restoredFromCache = False
+        logDepth = 0
+        _parents = []
         try:
-            _readMaterialsLibrary = self._findAll(_root, "library_materials", logDepth + 1)
-            for _lib in _readMaterialsLibrary:
-                _materials = self._findAll(_lib, "material", logDepth + 1)
-
-                for _material in _materials:
-                    _newMaterial = Material()
-                    _newMaterial._id = _material.attrib.get('id')
-                    _newMaterial._name = _material.attrib.get('name')
-
-                    _instanceEffects = self._findAll(_material, 'instance_effect', logDepth + 1)
-                    if len(_instanceEffects) > 0:
-                        _newMaterial._url = []
-                        for _eff in _instanceEffects:
-                            _newMaterial._url.append(_eff.attrib.get('url'))
+            for _event, _element in xml.etree.ElementTree.iterparse(filename, events=("start", "end")):
+                if _event == "start":
+                    _parents.append(_element)
+                    continue
+
+                _parents.pop()
+                _name = _element.tag.split('}')[-1] if isinstance(_element.tag, str) else None
+                _parentName = _parents[-1].tag.split('}')[-1] if len(_parents) > 0 else None
+
+                if _name in ("float_array", "p") and "geometry" in [_parent.tag.split('}')[-1] for _parent in _parents]:
+                    self._decodeStreamedNumbers(_name, _element, _parents[-1], stopAtException, logDepth + 1)
+
+                elif _name == "geometry" and _parentName == "library_geometries":
+                    self._tagIndex = TagIndex(_element)
+                    self._loadSection("geometry", _element, stopAtException, logDepth)
+                    self._tagIndex = None
+                    self._decodedArrays = {}
+                    _element.clear()
+                    _parents[-1].remove(_element)
+
+                elif len(_parents) == 1:
+                    if _name in ("asset", "library_visual_scenes", "library_materials", "library_effects"):
+                        self._tagIndex = TagIndex(_element)
+                        self._loadSection(_name, _element, stopAtException, logDepth)
+                        self._tagIndex = None
+                    _element.clear()
+                    _parents[-1].remove(_element)
+
+        except xml.etree.ElementTree.ParseError as ex:
+            self._log.log(LogLevel.Ex, "The file '%s' cannot be parsed as XML." % filename)
+            self._log.log(LogLevel.Ex, "Exception message: %s" % str(ex))
+            raise ex
 
-                    self._materials.append(_newMaterial)
+        self._log.log(LogLevel.Info, "Streamed %d geometries." % len(self._geometries))
+        self._formGeometry(stopAtException)
+        return True
 
+    def _decodeStreamedNumbers(self, name, element, parent, stopAtException=True, logDepth=0):
+        try:
+            self._decodedArrays[element] = self._parseNumbersArray(element.text, logDepth, asInts=(name == "p"), applyScaling=(name == "float_array"),
+                                                                   expectedCount=self._expectedNumbersCount(element, parent))
+            element.text = None
         except Exception as ex:
-            self._log.log(LogLevel.Err, "An exception ocurred while parsing the file (library_materials). Stopping.")
+            self._log.log(LogLevel.Err, "An exception ocurred while decoding a '%s' array (library_geometries). Stopping." % name)
             self._log.log(LogLevel.Err, "Exception message: %s" % ex)
             if stopAtException:
                 raise ex
 
-        # Load the effects
+    def _loadSection(self, name, element, stopAtException=True, logDepth=0):
         try:
-            _readEffectsLibrary = self._findAll(_root, "library_effects", logDepth + 1)
-            self._log.log(LogLevel.Info, "Found %d effects libraries." % len(_readEffectsLibrary))
-
-            for _lib in _readEffectsLibrary:
-                self._log.log(LogLevel.Info, "  Found %d effects(s) in library." % len(_lib))
-                _effects = self._findAll(_lib, "effect", logDepth + 1)
-                for _effect in _effects:
-                    _newEffect = Effect()
-                    _newEffect._id = _effect.attrib.get('id')
-                    _colors = self._findAll(_effect, "color", logDepth + 1)
-                    if len(_colors) > 0:
-                        _newEffect._color = self._parseNumbersArray(_colors[0].text, logDepth + 4, applyScaling=False)
-
-                    self._log.log(LogLevel.Info, "    Found effect with ID '%s' and color '%s'." % (_newEffect._id, _newEffect._color))
-                    self._effects.append(_newEffect)
+            if name == "asset":
+                self._parseAsset(element, logDepth + 1)
+            elif name == "library_visual_scenes":
+                self._parseVisualScenesLibrary(element, logDepth)
+            elif name == "library_materials":
+                self._parseMaterialsLibrary(element, logDepth)
+            elif name == "library_effects":
+                self._parseEffectsLibrary(element, logDepth)
+            elif name == "geometry":
+                self._geometries.append(self._parseGeometry(element, logDepth))
 
         except Exception as ex:
-            self._log.log(LogLevel.Err, "An exception ocurred while parsing the file (library_materials). Stopping.")
+            if name == "asset":
+                self._log.log(LogLevel.Err, "An exception ocurred while parsing the file header (asset).")
+            else:
+                self._log.log(LogLevel.Err, "An exception ocurred while parsing the file (%s). Stopping." % ("library_geometries" if name == "geometry" else name))
             self._log.log(LogLevel.Err, "Exception message: %s" % ex)
             if stopAtException:
                 raise ex
 
-        # Load geometries
+    def _formGeometry(self, stopAtException=True):
+        # Resolve the material bindings once, then form triangles and lines
         try:
-            _readGeometries = self._findAll(_root, "geometry", logDepth + 1)
-            self._log.log(LogLevel.Info, "Found %d geometries." % len(_readGeometries))
-            for _geometry in _readGeometries:
-                _newGeometry = Geometry()
-                _newGeometry._id = _geometry.attrib.get('id')
-                _meshes = self._findAll(_geometry, "mesh", logDepth + 1)
-                self._log.log(LogLevel.Info, "Found %d mesh item(s)." % len(_meshes))
-                _newGeometry._meshes = [self._parseMesh(_meshes[i], logDepth + 1) for i in range(len(_meshes))]
-                self._geometries.append(_newGeometry)
-
-            # Form triangles and lines
+            self._materialTable = MaterialTable()
+            self._materialTable.build(self._visualScenes, self._materials, self._effects)
+            self._log.log(LogLevel.Info, "Resolved %d material binding(s) for %d material(s)." % (len(self._materialTable._bindings), len(self._materialTable)))
             self._formedTriangles = self.formTriangles()
             self._formedLines = self.formLines()
 
@@ -168,7 +388,69 @@ class LibraryGeometries:
             if stopAtException:
                 raise ex
 
-        return True
+    def _parseAsset(self, asset, logDepth=0):
+        if asset is None:
+            raise Exception("No 'asset' block found.")
+        _contributor = self._findAll(asset, "contributor", logDepth)[0]
+        self._asset = Asset()
+        _authoringTools = self._findAll(_contributor, "authoring_tool", logDepth)
+        self._asset.authoringTool = _authoringTools[0].text if len(_authoringTools) > 0 else None
+
+        self._asset.created = self._findAll(asset, "created", logDepth)[0].text
+        self._asset.modified = self._findAll(asset, "modified", logDepth)[0].text
+
+        _unit = self._findAll(asset, "unit", logDepth)[0]
+        self._asset.unitMeter = _unit.attrib.get('meter')
+        self._asset.unitName = _unit.attrib.get('name')
+
+    def _parseVisualScenesLibrary(self, library, logDepth=0):
+        _visualScenes = self._findAll(library, "visual_scene")
+        self._log.log(LogLevel.Info, "Found %d visual scene(s) in library." % len(_visualScenes))
+
+        for _visualScene in _visualScenes:
+            _newVisualScene = VisualScene()
+            _newVisualScene._id = _visualScene.attrib.get('id')
+
+            _instanceGeometries = self._findAll(_visualScene, "instance_geometry", logDepth + 1)
+            _newVisualScene._instanceGeometries = [(self._parseInstanceGeometry(_inst, logDepth + 1)) for _inst in _instanceGeometries]
+            self._visualScenes.append(_newVisualScene)
+
+    def _parseMaterialsLibrary(self, library, logDepth=0):
+        _materials = self._findAll(library, "material", logDepth + 1)
+
+        for _material in _materials:
+            _newMaterial = Material()
+            _newMaterial._id = _material.attrib.get('id')
+            _newMaterial._name = _material.attrib.get('name')
+
+            _instanceEffects = self._findAll(_material, 'instance_effect', logDepth + 1)
+            if len(_instanceEffects) > 0:
+                _newMaterial._url = []
+                for _eff in _instanceEffects:
+                    _newMaterial._url.append(_eff.attrib.get('url'))
+
+            self._materials.append(_newMaterial)
+
+    def _parseEffectsLibrary(self, library, logDepth=0):
+        self._log.log(LogLevel.Info, "  Found %d effects(s) in library." % len(library))
+        _effects = self._findAll(library, "effect", logDepth + 1)
+        for _effect in _effects:
+            _newEffect = Effect()
+            _newEffect._id = _effect.attrib.get('id')
+            _colors = self._findAll(_effect, "color", logDepth + 1)
+            if len(_colors) > 0:
+                _newEffect._color = self._parseNumbersArray(_colors[0].text, logDepth + 4, applyScaling=False)
+
+            self._log.log(LogLevel.Info, "    Found effect with ID '%s' and color '%s'." % (_newEffect._id, _newEffect._color))
+            self._effects.append(_newEffect)
+
+    def _parseGeometry(self, geometry, logDepth=0):
+        _newGeometry = Geometry()
+        _newGeometry._id = geometry.attrib.get('id')
+        _meshes = self._findAll(geometry, "mesh", logDepth + 1)
+        self._log.log(LogLevel.Info, "Found %d mesh item(s)." % len(_meshes))
+        _newGeometry._meshes = [self._parseMesh(_meshes[i], logDepth + 1) for i in range(len(_meshes))]
+        return _newGeometry
 
     def _parseInstanceGeometry(self, inst, logDepth=0):
         self._log.log(LogLevel.Info, "%sParsing instance geometry." % (' ' * logDepth))
@@ -224,7 +506,7 @@ class LibraryGeometries:
             _source._floatArray = []
         else:
             self._log.log(LogLevel.Info, "%s  Found associated floats array." % (' ' * logDepth))
-            _source._floatArray = self._parseNumbersArray(_floats[0].text, logDepth + 1, applyScaling=True)
+            _source._floatArray = self._parseNumbersElement(_floats[0], logDepth + 1, applyScaling=True)
 
         # Parse technique common
         _techniqueCommonElement = self._findAll(source, 'technique_common')
@@ -286,7 +568,7 @@ class LibraryGeometries:
 
         _ints = self._findAll(source, 'p')[0]
         self._log.log(LogLevel.Info, "%sFound p vector." % (' ' * logDepth))
-        _triangles._p = self._parseNumbersArray(_ints.text, asInts=True, logDepth=logDepth + 1, applyScaling=False)
+        _triangles._p = self._parseNumbersElement(_ints, asInts=True, logDepth=logDepth + 1, applyScaling=False, parent=source)
 
         return _triangles
 
@@ -301,18 +583,42 @@ class LibraryGeometries:
 
         _ints = self._findAll(source, 'p')[0]
         self._log.log(LogLevel.Info, "%sFound p vector." % (' ' * logDepth))
-        _lines._p = self._parseNumbersArray(_ints.text, asInts=True, logDepth=logDepth + 1, applyScaling=False)
+        _lines._p = self._parseNumbersElement(_ints, asInts=True, logDepth=logDepth + 1, applyScaling=False, parent=source)
 
         return _lines
 
     def _findAll(self, root, name, logDepth=0):
-        _found = []
-        for _item in root.getiterator():
-            if _item.tag.split('}')[-1] == name:
-                _found.append(_item)
-        return _found
-
-    def _parseNumbersArray(self, text, logDepth=0, asInts=False, applyScaling=False):
+        # Only index again when asked about an element outside the indexed tree
+        if self._tagIndex is None or not self._tagIndex.contains(root):
+            self._tagIndex = TagIndex(root)
+        return self._tagIndex.findAll(root, name)
+
+    def _parseNumbersElement(self, element, logDepth=0, asInts=False, applyScaling=False, parent=None):
+        # Arrays already decoded while streaming are handed over only once
+        if element in self._decodedArrays:
+            return self._decodedArrays.pop(element)
+        return self._parseNumbersArray(element.text, logDepth, asInts=asInts, applyScaling=applyScaling,
+                                       expectedCount=self._expectedNumbersCount(element, parent))
+
+    def _expectedNumbersCount(self, element, parent=None):
+        # A <float_array> declares its length, a <p> holds one index per input
+        # for every corner of the 'count' primitives declared by its parent
+        _name = element.tag.split('}')[-1]
+        if _name == "float_array":
+            _count = element.attrib.get('count')
+            return int(_count) if _count is not None else None
+
+        if _name == "p" and parent is not None:
+            _corners = {"triangles": 3, "lines": 2}.get(parent.tag.split('}')[-1])
+            _count = parent.attrib.get('count')
+            if _corners is None or _count is None:
+                return None
+            _offsets = [int(_child.attrib.get('offset', 0)) for _child in parent if _child.tag.split('}')[-1] == "input"]
+            return int(_count) * _corners * (max(_offsets) + 1 if len(_offsets) > 0 else 1)
+
+        return None
+
+    def _parseNumbersArray(self, text, logDepth=0, asInts=False, applyScaling=False, expectedCount=None):
 
         if not applyScaling:
             _scalingFactor = 1.0
@@ -324,16 +630,22 @@ class LibraryGeometries:
                 self._log.log(LogLevel.Err, "%sCould not parse '%s' into a float for the scaling factor." % (' ' * logDepth, self._asset.unitMeter))
                 raise ex
 
+        # Decode the whole text at once. Numpy only warns when it finds a token it
+        # cannot parse and returns what it read so far, so make that an error.
         try:
-            _split = text.split()
-            if asInts:
-                _parsed = [int(_scalingFactor * int(_split[i])) for i in range(len(_split))]
-            else:
-                _parsed = [_scalingFactor * float(_split[i]) for i in range(len(_split))]
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", DeprecationWarning)
+                _parsed = np.fromstring(text if text is not None else "", dtype=np.int64 if asInts else np.float64, sep=' ')
+            if applyScaling:
+                _parsed = (_parsed * _scalingFactor).astype(np.int64) if asInts else _parsed * _scalingFactor
         except Exception as ex:
-            self._log.log(LogLevel.Err, "%sCould not parse '%s' into a float array." % (' ' * logDepth, text))
+            self._log.log(LogLevel.Err, "%sCould not parse '%s' into a %s array." % (' ' * logDepth, str(text)[:80] + ("..." if len(str(text)) > 80 else ""), "int" if asInts else "float"))
             raise ex
 
+        if expectedCount is not None and not len(_parsed) == expectedCount:
+            self._log.log(LogLevel.Err, "%sExpected %d values but found %d." % (' ' * logDepth, expectedCount, len(_parsed)))
+            raise Exception("Parsed %d values where the 'count' attribute declares %d." % (len(_parsed), expectedCount))
+
         if asInts:
             self._log.log(LogLevel.Info, "%sParsed %d integers." % (' ' * logDepth, len(_parsed)))
         else:
@@ -345,191 +657,157 @@ class LibraryGeometries:
             if _floatArray.tag.split('}')[-1] == 'float_array':
                 return _floatArray
 
+    def _findPositionSource(self, mesh, logDepth=0):
+        # Find sources that correspond to vertices
+        _inputID = None
+        _verticesID = None
+        for _input in mesh._vertices[0]._inputs:
+            if _input._semantic.lower() == "position":
+                _inputID = _input._source
+                _verticesID = mesh._vertices[0]._id
+                self._log.log(LogLevel.Info, "%sFound source-ID in vertices list: '%s'." % (' ' * logDepth, _inputID))
+                break
+        if _inputID is None:
+            self._log.log(LogLevel.Err, "%sCannot find the source-ID in the vertices list." % (' ' * logDepth))
+            return None, None
+
+        # Find the source that matches the ID found
+        for _source in mesh._sources:
+            if _source._id == _inputID or ("#%s" % _source._id) == _inputID:
+                self._log.log(LogLevel.Info, "%sFound source with ID: '%s'." % (' ' * logDepth, _inputID))
+                return _source, _verticesID
+
+        self._log.log(LogLevel.Err, "%sCannot find the source with ID '%s'." % (' ' * logDepth, _inputID))
+        return None, None
+
+    def _primitiveIndices(self, primitives, verticesID, cornersPerPrimitive):
+        # The <p> vector interleaves one index per input, so pick the column of
+        # the input bound to the vertices and drop any incomplete primitive
+        _offsets = [int(_input._offset) if _input._offset is not None else 0 for _input in primitives._inputs]
+        _stride = max(_offsets) + 1 if len(_offsets) > 0 else 1
+        _vertexOffset = 0
+        for _input in primitives._inputs:
+            if _input._source == verticesID or ("#%s" % verticesID) == _input._source:
+                _vertexOffset = int(_input._offset) if _input._offset is not None else 0
+                break
+
+        _p = np.asarray(primitives._p, dtype=np.int64)
+        _complete = len(_p) // (_stride * cornersPerPrimitive)
+        _incomplete = 1 if len(_p) % (_stride * cornersPerPrimitive) > 0 else 0
+        _p = _p[:_complete * _stride * cornersPerPrimitive].reshape(_complete, cornersPerPrimitive, _stride)
+        return _p[:, :, _vertexOffset], _incomplete
+
     def formLines(self, logDepth=0):
+        self._requireParsedData("form lines")
+        _formedLines = LineMesh()
         if len(self._geometries) == 0:
             self._log.log(LogLevel.Err, "%sThere are no geometries loaded." % (' ' * logDepth))
-            return []
+            return _formedLines
 
-        _lines = []
+        _points = []
+        _indices = []
+        _pointsOffset = 0
         _impossibleLines = 0
         for _geometry in self._geometries:
-            for i in range(len(_geometry._meshes)):
-                # Find sources that correspond to vertices
-                _inputID = None
-                _verticesID = None
-                for _input in _geometry._meshes[i]._vertices[0]._inputs:
-                    if _input._semantic.lower() == "position":
-                        _inputID = _input._source
-                        _verticesID = _geometry._meshes[i]._vertices[0]._id
-                        self._log.log(LogLevel.Info, "%sFound source-ID in vertices list: '%s'." % (' ' * logDepth, _inputID))
-                        break
-                if _inputID is None:
-                    self._log.log(LogLevel.Err, "%sCannot find the source-ID in the vertices list." % (' ' * logDepth))
-                    break
-
-                # Find the source that matches the ID found
-                _foundSource = None
-                for _source in _geometry._meshes[i]._sources:
-                    if _source._id == _inputID or ("#%s" % _source._id) == _inputID:
-                        _foundSource = _source
-                        self._log.log(LogLevel.Info, "%sFound source with ID: '%s'." % (' ' * logDepth, _inputID))
-                        break
+            for _mesh in _geometry._meshes:
+                _foundSource, _verticesID = self._findPositionSource(_mesh, logDepth)
                 if _foundSource is None:
-                    self._log.log(LogLevel.Err, "%sCannot find the source with ID '%s'." % (' ' * logDepth, _inputID))
-                    break
-
-                # Find the triangles data
-                _linesData = None
-                for _linesList in _geometry._meshes[i]._lines:
-                    for _input in _linesList._inputs:
-                        if _input._source == _verticesID or ("#%s" % _verticesID) == _input._source:
-                            _linesData = _linesList
-                            self._log.log(LogLevel.Info, "%sFound lines with ID: '%s'." % (' ' * logDepth, _verticesID))
-                            break
-                if _linesData is None:
-                    self._log.log(LogLevel.Err, "%sCannot find the triangles with ID '%s'." % (' ' * logDepth, _verticesID))
-                    break
-
-                try:
-                    for i in range(int(len(_linesData._p) / 2)):
-                        _lineIndexes = _linesData._p[i * 2 : (i * 2) + 2]
-
-                        _p1 = [_foundSource._floatArray[(_lineIndexes[0] * 3) + 0],
-                               _foundSource._floatArray[(_lineIndexes[0] * 3) + 1],
-                               _foundSource._floatArray[(_lineIndexes[0] * 3) + 2], ]
-                        _p2 = [_foundSource._floatArray[(_lineIndexes[1] * 3) + 0],
-                               _foundSource._floatArray[(_lineIndexes[1] * 3) + 1],
-                               _foundSource._floatArray[(_lineIndexes[1] * 3) + 2], ]
-
-                        _newLine = Line()
-                        _newLine.p1.x = _p1[0]
-                        _newLine.p1.y = _p1[1]
-                        _newLine.p1.z = _p1[2]
-                        _newLine.p2.x = _p2[0]
-                        _newLine.p2.y = _p2[1]
-                        _newLine.p2.z = _p2[2]
-
-                        _lines.append(_newLine)
-                        self._log.log(LogLevel.Debug, "%s  Formed line %s." % (' ' * logDepth, str(_newLine)))
-
-                except Exception as ex:
-                    _impossibleLines += 1
-
-        self._log.log(LogLevel.Info, "%s  Formed %d line(s) in total." % (' ' * logDepth, len(_lines)))
+                    continue
+                _positions = np.asarray(_foundSource._floatArray, dtype=float)
+                _positions = _positions[:(len(_positions) // 3) * 3].reshape(-1, 3)
+
+                # Find the lines data
+                _foundLines = False
+                for _linesData in _mesh._lines:
+                    if not any([_input._source == _verticesID or ("#%s" % _verticesID) == _input._source for _input in _linesData._inputs]):
+                        continue
+                    _foundLines = True
+                    self._log.log(LogLevel.Info, "%sFound lines with ID: '%s'." % (' ' * logDepth, _verticesID))
+
+                    _lineIndexes, _incomplete = self._primitiveIndices(_linesData, _verticesID, 2)
+                    _valid = np.all((_lineIndexes >= 0) & (_lineIndexes < len(_positions)), axis=1)
+                    _impossibleLines += _incomplete + int(np.count_nonzero(~_valid))
+                    _indices.append(_lineIndexes[_valid] + _pointsOffset)
+
+                if not _foundLines:
+                    self._log.log(LogLevel.Err, "%sCannot find the lines with ID '%s'." % (' ' * logDepth, _verticesID))
+                _points.append(_positions)
+                _pointsOffset += len(_positions)
+
+        if len(_points) > 0:
+            _formedLines._points = np.concatenate(_points)
+        if len(_indices) > 0:
+            _formedLines._indices = np.concatenate(_indices)
+        _formedLines._edges = _formedLines._points[_formedLines._indices]
+
+        self._log.log(LogLevel.Info, "%s  Formed %d line(s) in total." % (' ' * logDepth, len(_formedLines)))
         if _impossibleLines > 0:
             self._log.log(LogLevel.Err, "%s  %d line(s) could not be formed!" % (' ' * logDepth, _impossibleLines))
-        return _lines
+        return _formedLines
 
     def formTriangles(self, logDepth=0):
+        self._requireParsedData("form triangles")
+        _formedTriangles = TriangleMesh()
+        _formedTriangles._materials = self._materialTable._materials
+        _formedTriangles._colors = self._materialTable._colors
         if len(self._geometries) == 0:
             self._log.log(LogLevel.Err, "%sThere are no geometries loaded." % (' ' * logDepth))
-            return []
+            return _formedTriangles
 
-        _triangles = []
+        _points = []
+        _indices = []
+        _materialIds = []
+        _colorIds = []
+        _pointsOffset = 0
         _impossibleTriangles = 0
         for _geometry in self._geometries:
-            for i in range(len(_geometry._meshes)):
-                # Find sources that correspond to vertices
-                _inputID = None
-                _verticesID = None
-                for _input in _geometry._meshes[i]._vertices[0]._inputs:
-                    if _input._semantic.lower() == "position":
-                        _inputID = _input._source
-                        _verticesID = _geometry._meshes[i]._vertices[0]._id
-                        self._log.log(LogLevel.Info, "%sFound source-ID in vertices list: '%s'." % (' ' * logDepth, _inputID))
-                        break
-                if _inputID is None:
-                    self._log.log(LogLevel.Err, "%sCannot find the source-ID in the vertices list." % (' ' * logDepth))
-                    break
-
-                # Find the source that matches the ID found
-                _foundSource = None
-                for _source in _geometry._meshes[i]._sources:
-                    if _source._id == _inputID or ("#%s" % _source._id) == _inputID:
-                        _foundSource = _source
-                        self._log.log(LogLevel.Info, "%sFound source with ID: '%s'." % (' ' * logDepth, _inputID))
-                        break
+            for _mesh in _geometry._meshes:
+                _foundSource, _verticesID = self._findPositionSource(_mesh, logDepth)
                 if _foundSource is None:
-                    self._log.log(LogLevel.Err, "%sCannot find the source with ID '%s'." % (' ' * logDepth, _inputID))
-                    break
+                    continue
+                _positions = np.asarray(_foundSource._floatArray, dtype=float)
+                _positions = _positions[:(len(_positions) // 3) * 3].reshape(-1, 3)
 
                 # Find the triangles data
-                _trianglesData = None
-                for _triangleList in _geometry._meshes[i]._triangles:
-                    for _input in _triangleList._inputs:
-                        if _input._source == _verticesID or ("#%s" % _verticesID) == _input._source:
-                            _trianglesData = _triangleList
-                            self._log.log(LogLevel.Info, "%sFound triangles with ID: '%s'." % (' ' * logDepth, _verticesID))
-                            break
-                if _trianglesData is None:
+                _foundTriangles = False
+                for _trianglesData in _mesh._triangles:
+                    if not any([_input._source == _verticesID or ("#%s" % _verticesID) == _input._source for _input in _trianglesData._inputs]):
+                        continue
+                    _foundTriangles = True
+                    self._log.log(LogLevel.Info, "%sFound triangles with ID: '%s'." % (' ' * logDepth, _verticesID))
+
+                    _triangleIndexes, _incomplete = self._primitiveIndices(_trianglesData, _verticesID, 3)
+                    _valid = np.all((_triangleIndexes >= 0) & (_triangleIndexes < len(_positions)), axis=1)
+                    _impossibleTriangles += _incomplete + int(np.count_nonzero(~_valid))
+                    _triangleIndexes = _triangleIndexes[_valid]
+
+                    # The whole block shares the same material and color
+                    _materialIndex, _colorIndex = self._materialTable.lookup(_geometry._id, _trianglesData._material)
+                    _indices.append(_triangleIndexes + _pointsOffset)
+                    _materialIds.append(np.full(len(_triangleIndexes), _materialIndex, dtype=np.int32))
+                    _colorIds.append(np.full(len(_triangleIndexes), _colorIndex, dtype=np.int32))
+
+                if not _foundTriangles:
                     self._log.log(LogLevel.Err, "%sCannot find the triangles with ID '%s'." % (' ' * logDepth, _verticesID))
-                    break
-
-                try:
-                    for i in range(int(len(_trianglesData._p) / 3)):
-                        _triangleIndexes = _trianglesData._p[i * 3 : (i * 3) + 3]
-
-                        _p1 = [_foundSource._floatArray[(_triangleIndexes[0] * 3) + 0],
-                               _foundSource._floatArray[(_triangleIndexes[0] * 3) + 1],
-                               _foundSource._floatArray[(_triangleIndexes[0] * 3) + 2], ]
-                        _p2 = [_foundSource._floatArray[(_triangleIndexes[1] * 3) + 0],
-                               _foundSource._floatArray[(_triangleIndexes[1] * 3) + 1],
-                               _foundSource._floatArray[(_triangleIndexes[1] * 3) + 2], ]
-                        _p3 = [_foundSource._floatArray[(_triangleIndexes[2] * 3) + 0],
-                               _foundSource._floatArray[(_triangleIndexes[2] * 3) + 1],
-                               _foundSource._floatArray[(_triangleIndexes[2] * 3) + 2], ]
-                        _newTriangle = Triangle()
-                        _newTriangle.p1.x = _p1[0]
-                        _newTriangle.p1.y = _p1[1]
-                        _newTriangle.p1.z = _p1[2]
-                        _newTriangle.p2.x = _p2[0]
-                        _newTriangle.p2.y = _p2[1]
-                        _newTriangle.p2.z = _p2[2]
-                        _newTriangle.p3.x = _p3[0]
-                        _newTriangle.p3.y = _p3[1]
-                        _newTriangle.p3.z = _p3[2]
-
-                        # Find material and associated effect
-                        _instanceGeometryID = _geometry._id
-                        _foundMatAndColor = False
-                        for _visualScene in self._visualScenes:
-                            if _foundMatAndColor:
-                                break
-                            for _instanceGeometry in _visualScene._instanceGeometries:
-                                if _foundMatAndColor:
-                                    break
-                                if "#%s" % (_instanceGeometryID) == _instanceGeometry._url:
-                                    for _mat in _instanceGeometry._instanceMaterials:
-                                        if _foundMatAndColor:
-                                            break
-                                        if _trianglesData._material == _mat._symbol:
-                                            for _material in self._materials:
-                                                if _foundMatAndColor:
-                                                    break
-                                                if "#%s" % (_material._id) == _mat._target:
-                                                    for _effect in self._effects:
-                                                        for _url in _material._url:
-                                                            if _foundMatAndColor:
-                                                                break
-                                                            if "#%s" % (_effect._id) == _url:
-                                                                _newTriangle._material = _material
-                                                                _newTriangle._color = _effect._color
-                                                                _foundMatAndColor = True
-                                                                break
-
-                        _triangles.append(_newTriangle)
-                        self._log.log(LogLevel.Debug, "%s  Formed triangle %s." % (' ' * logDepth, str(_newTriangle)))
-                except Exception as ex:
-                    _impossibleTriangles += 1
-
-        self._log.log(LogLevel.Info, "%s  Formed %d triangle(s) in total." % (' ' * logDepth, len(_triangles)))
+                _points.append(_positions)
+                _pointsOffset += len(_positions)
+
+        if len(_points) > 0:
+            _formedTriangles._points = np.concatenate(_points)
+        if len(_indices) > 0:
+            _formedTriangles._indices = np.concatenate(_indices)
+            _formedTriangles._materialIds = np.concatenate(_materialIds)
+            _formedTriangles._colorIds = np.concatenate(_colorIds)
+        _formedTriangles._vertices = _formedTriangles._points[_formedTriangles._indices]
+
+        self._log.log(LogLevel.Info, "%s  Formed %d triangle(s) in total." % (' ' * logDepth, len(_formedTriangles)))
         if _impossibleTriangles > 0:
             self._log.log(LogLevel.Err, "%s  %d triangle(s) could not be formed!" % (' ' * logDepth, _impossibleTriangles))
-        return _triangles
+        return _formedTriangles
 
     def displayGeometry(self, solid=True, logDepth=0, transparent=True):
         from mpl_toolkits.mplot3d import Axes3D
-        from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+        from mpl_toolkits.mplot3d.art3d import Poly3DCollection, Line3DCollection
         import matplotlib.pyplot as plt
 
         fig = plt.figure()
@@ -537,30 +815,29 @@ class LibraryGeometries:
 
         _somethingToShow = False
         if len(self._formedTriangles) > 0:
+            _somethingToShow = True
+            _colors = self._formedTriangles.faceColors()[:, 0:3]
 
             # -- Plot the triangles
-            for index, _triangle in enumerate(self._formedTriangles):
-                _somethingToShow = True
-                if solid:
-                    _collection = Poly3DCollection([list(zip([_triangle.p1.x, _triangle.p2.x, _triangle.p3.x], \
-                                                             [_triangle.p1.y, _triangle.p2.y, _triangle.p3.y], \
-                                                             [_triangle.p1.z, _triangle.p2.z, _triangle.p3.z]))],
-                                                   linewidths=0.1,
-                                                   alpha=0.5 if transparent else 1.0)
-                    _collection.set_facecolor(_triangle._color[0:3])
-                    _collection.set_edgecolor(_triangle._color[0:3])
-                    ax.add_collection3d(_collection, zs='z')
-                else:
-                    plt.plot([_triangle.p1.x, _triangle.p2.x, _triangle.p3.x, _triangle.p1.x],
-                             [_triangle.p1.y, _triangle.p2.y, _triangle.p3.y, _triangle.p1.y],
-                             [_triangle.p1.z, _triangle.p2.z, _triangle.p3.z, _triangle.p1.z], color=_triangle._color[0:3], linewidth=0.25)
+            if solid:
+                _collection = Poly3DCollection(self._formedTriangles._vertices,
+                                               linewidths=0.1,
+                                               alpha=0.5 if transparent else 1.0)
+                _collection.set_facecolor(_colors)
+                _collection.set_edgecolor(_colors)
+                ax.add_collection3d(_collection, zs='z')
+            else:
+                _closed = self._formedTriangles._vertices[:, [0, 1, 2, 0], :]
+                ax.add_collection3d(Line3DCollection(_closed, colors=_colors, linewidths=0.25))
 
             # -- Plot the contour lines
-            for _line in self._formedLines:
-                _somethingToShow = True
-                plt.plot([_line.p1.x, _line.p2.x], \
-                         [_line.p1.y, _line.p2.y], \
-                         [_line.p1.z, _line.p2.z], color='k', linewidth=2.0)
+            if len(self._formedLines) > 0:
+                ax.add_collection3d(Line3DCollection(self._formedLines._edges, colors='k', linewidths=2.0))
+
+            _allPoints = self._formedTriangles._vertices.reshape(-1, 3)
+            ax.set_xlim(_allPoints[:, 0].min(), _allPoints[:, 0].max())
+            ax.set_ylim(_allPoints[:, 1].min(), _allPoints[:, 1].max())
+            ax.set_zlim(_allPoints[:, 2].min(), _allPoints[:, 2].max())
 
         if _somethingToShow:
             plt.show()
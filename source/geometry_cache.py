@@ -0,0 +1,124 @@
+'''
+    This module stores the compiled geometry of a DAE file (formed triangles
+    and lines, material table, asset units and, once built, the flattened
+    BVH) in a binary
+    cache file, so that later loads of the unchanged file can map the arrays
+    straight from disk instead of parsing the XML again. Cache files go to
+    the user cache directory ($XDG_CACHE_HOME/work3d or ~/.cache/work3d),
+    named after the path of the DAE file, or next to it if asked to.
+
+    File layout: magic, format version, header length, a JSON header and the
+    raw arrays, each aligned so it can be viewed from a single memory map.
+
+    Joe Simon 2018.
+'''
+
+
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+
+
+SCENE_CACHE_EXTENSION = '.w3dcache'
+SCENE_CACHE_MAGIC = b'W3DCACHE'
+SCENE_CACHE_VERSION = 2
+SCENE_CACHE_ALIGNMENT = 64
+
+
+def sceneCacheDirectory():
+    _base = os.environ.get('XDG_CACHE_HOME', '') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(_base, 'work3d')
+
+
+def sceneCacheFilename(sourceFilename, nextToSource=False):
+    if nextToSource:
+        return sourceFilename + SCENE_CACHE_EXTENSION
+    _sourcePath = os.path.abspath(sourceFilename)
+    _pathHash = hashlib.blake2b(_sourcePath.encode('utf-8'), digest_size=8).hexdigest()
+    return os.path.join(sceneCacheDirectory(), "%s-%s%s" % (os.path.basename(_sourcePath), _pathHash, SCENE_CACHE_EXTENSION))
+
+
+def fileContentHash(filename, blockSize=1 << 20):
+    _hash = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as _file:
+        _block = _file.read(blockSize)
+        while len(_block) > 0:
+            _hash.update(_block)
+            _block = _file.read(blockSize)
+    return _hash.hexdigest()
+
+
+def writeSceneCache(cacheFilename, sourceFilename, contentHash, arrays, metadata):
+    _stat = os.stat(sourceFilename)
+    _header = {'contentHash': contentHash,
+               'sourceSize': _stat.st_size,
+               'sourceModified': _stat.st_mtime_ns,
+               'metadata': metadata,
+               'arrays': {}}
+
+    # Offsets are relative to the start of the data section
+    _offset = 0
+    for _name, _array in arrays.items():
+        _array = np.ascontiguousarray(_array)
+        _header['arrays'][_name] = {'dtype': _array.dtype.str, 'shape': list(_array.shape), 'offset': _offset}
+        _offset += _alignedSize(_array.nbytes)
+
+    _headerBytes = json.dumps(_header).encode('utf-8')
+    _dataStart = _alignedSize(len(SCENE_CACHE_MAGIC) + 16 + len(_headerBytes))
+
+    # Write to a temporary file first so a crash never leaves a broken cache
+    os.makedirs(os.path.dirname(os.path.abspath(cacheFilename)), exist_ok=True)
+    _temporaryFilename = cacheFilename + '.tmp'
+    with open(_temporaryFilename, 'wb') as _file:
+        _file.write(SCENE_CACHE_MAGIC)
+        _file.write(struct.pack('<QQ', SCENE_CACHE_VERSION, len(_headerBytes)))
+        _file.write(_headerBytes)
+        _file.write(b'\0' * (_dataStart - _file.tell()))
+        for _name, _array in arrays.items():
+            _array = np.ascontiguousarray(_array)
+            _file.write(_array.tobytes())
+            _file.write(b'\0' * (_alignedSize(_array.nbytes) - _array.nbytes))
+    os.replace(_temporaryFilename, cacheFilename)
+
+
+def readSceneCache(cacheFilename, sourceFilename, contentHash=None):
+    # Returns (arrays, metadata, contentHash). If the cache is missing, has
+    # another format version or was made from a different file content,
+    # arrays and metadata are None and contentHash is the hash of the source
+    # if it had to be computed (None otherwise), so it is not hashed twice
+    if not os.path.isfile(cacheFilename):
+        return None, None, contentHash
+
+    with open(cacheFilename, 'rb') as _file:
+        if not _file.read(len(SCENE_CACHE_MAGIC)) == SCENE_CACHE_MAGIC:
+            return None, None, contentHash
+        _version, _headerLength = struct.unpack('<QQ', _file.read(16))
+        if not _version == SCENE_CACHE_VERSION:
+            return None, None, contentHash
+        _header = json.loads(_file.read(_headerLength).decode('utf-8'))
+    _dataStart = _alignedSize(len(SCENE_CACHE_MAGIC) + 16 + _headerLength)
+
+    # Hashing a big file is the slowest part, so skip it when size and
+    # modification time are the ones the cache was made with
+    _stat = os.stat(sourceFilename)
+    if not (_stat.st_size == _header['sourceSize'] and _stat.st_mtime_ns == _header['sourceModified']):
+        if contentHash is None:
+            contentHash = fileContentHash(sourceFilename)
+        if not contentHash == _header['contentHash']:
+            return None, None, contentHash
+
+    _map = np.memmap(cacheFilename, dtype=np.uint8, mode='r')
+    _arrays = {}
+    for _name, _description in _header['arrays'].items():
+        _dtype = np.dtype(_description['dtype'])
+        _shape = tuple(_description['shape'])
+        _start = _dataStart + _description['offset']
+        _size = int(np.prod(_shape)) * _dtype.itemsize
+        _arrays[_name] = _map[_start:_start + _size].view(_dtype).reshape(_shape)
+    return _arrays, _header['metadata'], _header['contentHash']
+
+
+def _alignedSize(size):
+    return ((size + SCENE_CACHE_ALIGNMENT - 1) // SCENE_CACHE_ALIGNMENT) * SCENE_CACHE_ALIGNMENT
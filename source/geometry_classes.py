@@ -6,6 +6,9 @@
 '''
 
 
+import numpy as np
+
+
 class Asset:
     def __init__(self):
         self.authoringTool = None
@@ -47,6 +50,73 @@ class Line:
         return "[%f, %f, %f --> %f, %f, %f]" % (self.p1.x, self.p1.y, self.p1.z, self.p2.x, self.p2.y, self.p2.z)
 
 
+# Struct-of-arrays storage of all formed triangles. '_vertices' holds the
+# coordinates of each face as (N, 3, 3), '_indices' points each corner into
+# the shared '_points' (V, 3) array and the per-face ids index '_materials'
+# and '_colors' (-1 when nothing could be resolved). Triangle objects are
+# only built when a caller indexes or iterates the mesh.
+class TriangleMesh:
+    def __init__(self):
+        self._points = np.zeros((0, 3))
+        self._vertices = np.zeros((0, 3, 3))
+        self._indices = np.zeros((0, 3), dtype=np.int64)
+        self._materialIds = np.zeros(0, dtype=np.int32)
+        self._colorIds = np.zeros(0, dtype=np.int32)
+        self._materials = []
+        self._colors = []
+
+    def __len__(self):
+        return len(self._vertices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        _triangle = Triangle()
+        _face = self._vertices[index]
+        _triangle.p1.x, _triangle.p1.y, _triangle.p1.z = [float(_c) for _c in _face[0]]
+        _triangle.p2.x, _triangle.p2.y, _triangle.p2.z = [float(_c) for _c in _face[1]]
+        _triangle.p3.x, _triangle.p3.y, _triangle.p3.z = [float(_c) for _c in _face[2]]
+        if self._materialIds[index] >= 0:
+            _triangle._material = self._materials[self._materialIds[index]]
+        if self._colorIds[index] >= 0:
+            _triangle._color = self._colors[self._colorIds[index]]
+        return _triangle
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def faceColors(self, defaultColor=(0.0, 0.0, 0.0, 1.0)):
+        _palette = np.array([defaultColor] + [list(_c)[0:4] if _c is not None else defaultColor for _c in self._colors], dtype=float)
+        return _palette[self._colorIds + 1]
+
+
+# Same layout as TriangleMesh for the contour lines, with '_edges' as (M, 2, 3).
+class LineMesh:
+    def __init__(self):
+        self._points = np.zeros((0, 3))
+        self._edges = np.zeros((0, 2, 3))
+        self._indices = np.zeros((0, 2), dtype=np.int64)
+
+    def __len__(self):
+        return len(self._edges)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        _line = Line()
+        _edge = self._edges[index]
+        _line.p1.x, _line.p1.y, _line.p1.z = [float(_c) for _c in _edge[0]]
+        _line.p2.x, _line.p2.y, _line.p2.z = [float(_c) for _c in _edge[1]]
+        return _line
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class Lines:
     def __init__(self):
         self._count = None
@@ -172,3 +242,59 @@ class Effect:
     def __init__(self,):
         self._id = None
         self._color = None
+
+
+# Geometry -> symbol -> material -> effect bindings resolved once after
+# loading. Material and color ids are indexes into '_materials' and '_colors',
+# -1 meaning "not bound", and are the ids stored per face in TriangleMesh.
+class MaterialTable:
+    def __init__(self):
+        self._materials = []
+        self._colors = []
+        self._materialIndexById = {}
+        self._colorIndexByMaterial = []
+        self._bindings = {}
+
+    def __len__(self):
+        return len(self._materials)
+
+    def build(self, visualScenes, materials, effects):
+        self._materials = list(materials)
+        self._colors = [_effect._color for _effect in effects]
+
+        _effectIndexById = {}
+        for _effectIndex, _effect in enumerate(effects):
+            _effectIndexById.setdefault("#%s" % _effect._id, _effectIndex)
+
+        # The first effect (in library order) referenced by a material gives its color
+        self._materialIndexById = {}
+        self._colorIndexByMaterial = []
+        for _materialIndex, _material in enumerate(self._materials):
+            self._materialIndexById.setdefault("#%s" % _material._id, _materialIndex)
+            _effectIndexes = [_effectIndexById[_url] for _url in (_material._url or []) if _url in _effectIndexById]
+            self._colorIndexByMaterial.append(min(_effectIndexes) if len(_effectIndexes) > 0 else -1)
+
+        # The first instance that binds a symbol of a geometry wins
+        self._bindings = {}
+        for _visualScene in visualScenes:
+            for _instanceGeometry in _visualScene._instanceGeometries:
+                for _mat in _instanceGeometry._instanceMaterials:
+                    if _mat._target in self._materialIndexById:
+                        self._bindings.setdefault((_instanceGeometry._url, _mat._symbol), self._materialIndexById[_mat._target])
+
+    def lookup(self, geometryId, symbol):
+        _materialIndex = self._bindings.get(("#%s" % geometryId, symbol), -1)
+        if _materialIndex < 0:
+            return -1, -1
+        return _materialIndex, self._colorIndexByMaterial[_materialIndex]
+
+    def materialIndex(self, material):
+        # Accepts a material ID (with or without '#') or a material name
+        if material in self._materialIndexById:
+            return self._materialIndexById[material]
+        if "#%s" % material in self._materialIndexById:
+            return self._materialIndexById["#%s" % material]
+        for _materialIndex, _material in enumerate(self._materials):
+            if _material._name == material:
+                return _materialIndex
+        return -1
@@ -0,0 +1,289 @@
+'''
+    This module implements the image-source method used for the early part
+    of the response: the source is mirrored on the planes of the formed
+    triangles up to a given reflection order, and every image whose path to
+    a receiver really bounces on those planes (and is not occluded) adds an
+    exact specular reflection. Rays then only need to cover the late tail.
+
+    Coplanar triangles are merged into planes. A wave reflected on a plane
+    only travels on the side of the image it came from, so while the image
+    tree is built only the planes with a vertex on that side are tried; the
+    planes on each side of a plane are found the first time it is needed and
+    kept for the scene. The wave of an image also only leaves through the
+    plane it was mirrored on, so a plane is only tried if it can be in that
+    beam: seen from the image, its bounding sphere must overlap the cone
+    through the bounding sphere of the image's plane. Both tests only prune
+    images that cannot give any path. The trees are kept per scene and
+    source, as they do not depend on the receivers.
+
+    Paths are validated backwards from the receivers with closest-hit
+    queries (through the BVH when the scene has one), which test both that
+    the reflection point lies on a face of the plane and that nothing is in
+    the way. Every tree keeps the valid paths of the receiver locations it
+    was asked for, so chunks of other rays with the same receivers do not
+    test them again.
+
+    The number of images grows with the power of the reflection order of
+    the number of planes, so they are only worth it at low orders and on
+    models without many planes, and are off by default.
+
+    Joe Simon 2018.
+'''
+
+
+import numpy as np
+from ray_intersection import *
+
+
+# Tolerances, in metres, to tell apart planes and to match hit distances
+IMAGE_SOURCE_PLANE_TOLERANCE = 1e-6
+IMAGE_SOURCE_DISTANCE_TOLERANCE = 1e-6
+# Same, by the precision of the triangle arrays
+IMAGE_SOURCE_TOLERANCES = {np.dtype(np.float64): (IMAGE_SOURCE_PLANE_TOLERANCE, IMAGE_SOURCE_DISTANCE_TOLERANCE),
+                           np.dtype(np.float32): (1e-4, 1e-4)}
+# Receiver locations whose paths a tree keeps, it forgets them all past that
+IMAGE_SOURCE_CACHED_RECEIVERS = 4096
+
+# Planes and image trees of the last scene, in the process that computed
+# them; the trees by (scene key, source location, order)
+_scenePlanes = {}
+_imageSourceTrees = {}
+
+
+class ScenePlanes:
+    def __init__(self, triangles, precision=np.float64):
+        # _facePlanes holds the plane of every face (-1 for degenerate faces)
+        self._planeTolerance, self._distanceTolerance = IMAGE_SOURCE_TOLERANCES[np.dtype(precision)]
+        _normals = triangles._normals
+        _offsets = (_normals * triangles._v0).sum(axis=1)
+        _valid = np.linalg.norm(_normals, axis=1) > 0.5
+
+        # Same orientation for both sides of a plane before merging them
+        _flip = np.sign(_normals[np.arange(len(_normals)), np.argmax(np.abs(_normals), axis=1)])
+        _flip[_flip == 0.0] = 1.0
+        _keys = np.round(np.column_stack([_normals * _flip[:, None], _offsets * _flip]) / self._planeTolerance)
+        _, _firstFace, _facePlanes = np.unique(_keys[_valid], axis=0, return_index=True, return_inverse=True)
+        _validFaces = np.nonzero(_valid)[0]
+        self._facePlanes = np.full(len(_normals), -1, dtype=np.int64)
+        self._facePlanes[_validFaces] = _facePlanes.reshape(-1)
+        self._normals = (_normals * _flip[:, None])[_validFaces[_firstFace]]
+        self._offsets = (_offsets * _flip)[_validFaces[_firstFace]]
+
+        _vertices = np.concatenate([triangles._v0, triangles._v0 + triangles._e1, triangles._v0 + triangles._e2])
+        _vertexPlanes = np.tile(self._facePlanes, 3)
+        self._vertices = _vertices[_vertexPlanes >= 0]
+        self._vertexPlanes = _vertexPlanes[_vertexPlanes >= 0]
+        # Bounding sphere of every plane (around its bounding box)
+        _boundsMin = np.full((len(self), 3), np.inf)
+        _boundsMax = np.full((len(self), 3), -np.inf)
+        np.minimum.at(_boundsMin, self._vertexPlanes, self._vertices)
+        np.maximum.at(_boundsMax, self._vertexPlanes, self._vertices)
+        self._centres = 0.5 * (_boundsMin + _boundsMax)
+        self._radii = 0.5 * np.linalg.norm(_boundsMax - _boundsMin, axis=1)
+        # Planes with a vertex strictly above / below every plane, as they are needed
+        self._sides = {}
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def heights(self, points, planes):
+        return (points * self._normals[planes]).sum(axis=1) - self._offsets[planes]
+
+    def planesOnSide(self, plane, side):
+        # Planes with a vertex strictly on the positive (side > 0) or negative side of 'plane'
+        if not plane in self._sides:
+            _heights = self._vertices @ self._normals[plane] - self._offsets[plane]
+            self._sides[plane] = (np.unique(self._vertexPlanes[_heights > self._planeTolerance]),
+                                  np.unique(self._vertexPlanes[_heights < -self._planeTolerance]))
+        return self._sides[plane][0 if side > 0 else 1]
+
+
+def scenePlanes(triangles, sceneKey=None, precision=np.float64):
+    # Plane analysis of a scene, kept for the next calls with the same key
+    # (only that of the last scene is kept)
+    if sceneKey is not None and sceneKey in _scenePlanes:
+        return _scenePlanes[sceneKey]
+    _planes = ScenePlanes(triangles, precision)
+    if sceneKey is not None:
+        _scenePlanes.clear()
+        _scenePlanes[sceneKey] = _planes
+    return _planes
+
+
+def imageSourceTree(planes, source, maxOrder, sceneKey=None):
+    # Image tree of a source, kept for the next calls with the same scene
+    # key, source location and order (only those of the last scene are kept)
+    _key = (sceneKey, tuple([float(_value) for _value in source]), maxOrder)
+    if sceneKey is not None and _key in _imageSourceTrees:
+        return _imageSourceTrees[_key]
+    _tree = ImageSourceTree(planes, source, maxOrder)
+    if sceneKey is not None:
+        for _otherKey in [_otherKey for _otherKey in _imageSourceTrees.keys() if not _otherKey[0] == sceneKey]:
+            del _imageSourceTrees[_otherKey]
+        _imageSourceTrees[_key] = _tree
+    return _tree
+
+
+class ImageSourceTree:
+    # Images of one source, one level per reflection order. Every level holds
+    # the image positions, the plane they were mirrored on, their parent in
+    # the previous level and the side of that plane the wave travels on.
+    def __init__(self, planes, source, maxOrder):
+        self._planes = planes
+        self._source = np.asarray(source, dtype=float)
+        self._positions = [self._source.reshape(1, 3)]
+        self._imagePlanes = [np.full(1, -1, dtype=np.int64)]
+        self._parents = [np.full(1, -1, dtype=np.int64)]
+        self._sides = [np.zeros(1)]
+        # Valid paths (lengths, faces, emissions) by receiver location and first order
+        self._paths = {}
+        for _order in range(1, maxOrder + 1):
+            if not self._addLevel():
+                break
+
+    def __len__(self):
+        return sum([len(_positions) for _positions in self._positions])
+
+    def maxOrder(self):
+        return len(self._positions) - 1
+
+    def _addLevel(self):
+        # The wave leaving the last plane only reaches planes on its side of it
+        _positions = self._positions[-1]
+        _candidates = []
+        for _image in range(len(_positions)):
+            _lastPlane = self._imagePlanes[-1][_image]
+            if _lastPlane < 0:
+                _candidates.append(np.arange(len(self._planes)))
+            else:
+                _candidates.append(self._planes.planesOnSide(_lastPlane, self._sides[-1][_image]))
+        _images = np.repeat(np.arange(len(_positions)), [len(_planes) for _planes in _candidates])
+        _planes = np.concatenate(_candidates).astype(np.int64)
+
+        # Never mirror twice on the same plane, nor on planes the image lies on
+        _heights = self._planes.heights(_positions[_images], _planes)
+        _valid = (_planes != self._imagePlanes[-1][_images]) & (np.abs(_heights) > self._planes._planeTolerance)
+        _valid[_valid] = self._inBeams(_images[_valid], _planes[_valid])
+        _images, _planes, _heights = _images[_valid], _planes[_valid], _heights[_valid]
+        if len(_images) == 0:
+            return False
+        self._positions.append(_positions[_images] - 2.0 * _heights[:, None] * self._planes._normals[_planes])
+        self._imagePlanes.append(_planes)
+        self._parents.append(_images)
+        self._sides.append(np.sign(_heights))
+        return True
+
+    def _inBeams(self, images, planes):
+        # Whether every plane paired with an image of the last level can be
+        # in the beam of that image: seen from the image, its bounding sphere
+        # must overlap the cone through the bounding sphere of the plane the
+        # image was mirrored on (the wave only leaves through that plane)
+        _level = len(self._positions) - 1
+        if _level == 0:
+            return np.ones(len(images), dtype=bool)
+        _positions = self._positions[_level][images]
+        _imagePlanes = self._imagePlanes[_level][images]
+        _toWindow = self._planes._centres[_imagePlanes] - _positions
+        _toPlane = self._planes._centres[planes] - _positions
+        _windowDistances = np.linalg.norm(_toWindow, axis=1)
+        _planeDistances = np.linalg.norm(_toPlane, axis=1)
+        # Half angles of both spheres, all directions from inside a sphere
+        _windowAngles = np.full(len(images), np.pi)
+        _inside = self._planes._radii[_imagePlanes] >= _windowDistances
+        _windowAngles[~_inside] = np.arcsin(self._planes._radii[_imagePlanes][~_inside] / _windowDistances[~_inside])
+        _planeAngles = np.full(len(images), np.pi)
+        _inside = self._planes._radii[planes] >= _planeDistances
+        _planeAngles[~_inside] = np.arcsin(self._planes._radii[planes][~_inside] / _planeDistances[~_inside])
+        _cosines = (_toWindow * _toPlane).sum(axis=1) / np.maximum(_windowDistances * _planeDistances, DISTANCE_EPSILON)
+        _angles = np.arccos(np.clip(_cosines, -1.0, 1.0))
+        return _angles <= _windowAngles + _planeAngles + self._planes._planeTolerance
+
+    def findPaths(self, receivers, triangles, accelerator=None, minOrder=0):
+        # Valid specular paths from the source to the receivers. Returns the
+        # receiver index, the path length, the faces reflected on (one row
+        # per path, padded with -1 up to the maximum order) and the direction
+        # it leaves the source in of every path. Only receiver locations not
+        # asked for before are validated.
+        _receivers = np.asarray(receivers, dtype=float).reshape(-1, 3)
+        _keys = [(tuple(_receiver), minOrder) for _receiver in _receivers.tolist()]
+        _missing = list(dict.fromkeys([_key for _key in _keys if not _key in self._paths]).keys())
+        if len(self._paths) + len(_missing) > IMAGE_SOURCE_CACHED_RECEIVERS:
+            self._paths = {}
+            _missing = list(dict.fromkeys(_keys).keys())
+        if len(_missing) > 0:
+            _receiverIds, _lengths, _faces, _emissions = self._findPaths(np.array([_key[0] for _key in _missing]), triangles, accelerator, minOrder)
+            _sorted = np.argsort(_receiverIds, kind='stable')
+            _bounds = np.searchsorted(_receiverIds[_sorted], np.arange(len(_missing) + 1))
+            for i, _key in enumerate(_missing):
+                _paths = _sorted[_bounds[i]:_bounds[i + 1]]
+                self._paths[_key] = (_lengths[_paths], _faces[_paths], _emissions[_paths])
+
+        _cached = [self._paths[_key] for _key in _keys]
+        if len(_cached) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, self.maxOrder()), dtype=np.int64), np.zeros((0, 3))
+        return (np.repeat(np.arange(len(_cached)), [len(_paths[0]) for _paths in _cached]),
+                np.concatenate([_paths[0] for _paths in _cached]),
+                np.concatenate([_paths[1] for _paths in _cached]),
+                np.concatenate([_paths[2] for _paths in _cached]))
+
+    def _findPaths(self, receivers, triangles, accelerator, minOrder):
+        # Validates the paths of all the images to the receivers, same
+        # results as findPaths
+        _receivers = receivers
+        _found = ([], [], [], [])
+        for _order in range(minOrder, self.maxOrder() + 1):
+            _count = len(self._positions[_order])
+            _blockSize = max(1, MAX_ELEMENTS_PER_BLOCK // 16)
+            _pairs = len(_receivers) * _count
+            for _start in range(0, _pairs, _blockSize):
+                _pairIds = np.arange(_start, min(_start + _blockSize, _pairs))
+                _receiverIds, _faces, _lengths, _emissions = self._validatePaths(_receivers, _pairIds // _count, _pairIds % _count, _order, triangles, accelerator)
+                _found[0].append(_receiverIds)
+                _found[1].append(_lengths)
+                _found[2].append(np.pad(_faces, ((0, 0), (0, self.maxOrder() - _faces.shape[1])), constant_values=-1))
+                _found[3].append(_emissions)
+        if len(_found[0]) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, self.maxOrder()), dtype=np.int64), np.zeros((0, 3))
+        return tuple(np.concatenate(_part) for _part in _found)
+
+    def _validatePaths(self, receivers, receiverIds, images, order, triangles, accelerator):
+        _points = receivers[receiverIds]
+        _lengths = np.linalg.norm(self._positions[order][images] - _points, axis=1)
+
+        # The receiver must be on the side the last reflection sends the wave to
+        if order > 0:
+            _heights = self._planes.heights(_points, self._imagePlanes[order][images])
+            _valid = _heights * self._sides[order][images] > self._planes._planeTolerance
+            receiverIds, images, _points, _lengths = receiverIds[_valid], images[_valid], _points[_valid], _lengths[_valid]
+
+        # Walk back from the receiver: the first face hit towards every image
+        # must lie on the plane of that image
+        _faces = np.zeros((len(receiverIds), order), dtype=np.int64)
+        _lastFaces = np.full(len(receiverIds), -1, dtype=np.int64)
+        for _level in range(order, 0, -1):
+            _directions = self._positions[_level][images] - _points
+            _directions /= np.linalg.norm(_directions, axis=1)[:, None]
+            if accelerator is None:
+                _t, _hitFaces, _, _ = intersectRays(_points, _directions, triangles, ignoreFaces=_lastFaces)
+            else:
+                _t, _hitFaces, _, _ = accelerator.intersectClosest(_points, _directions, triangles, ignoreFaces=_lastFaces)
+            _planes = self._imagePlanes[_level][images]
+            _planeDistances = -self._planes.heights(_points, _planes) / (_directions * self._planes._normals[_planes]).sum(axis=1)
+            _valid = (_hitFaces >= 0) & (self._planes._facePlanes[np.maximum(_hitFaces, 0)] == _planes) & (np.abs(_t - _planeDistances) <= self._planes._distanceTolerance * np.maximum(1.0, _t))
+
+            receiverIds, images, _lengths = receiverIds[_valid], self._parents[_level][images[_valid]], _lengths[_valid]
+            _points = _points[_valid] + _t[_valid, None] * _directions[_valid]
+            _faces = _faces[_valid]
+            _faces[:, _level - 1] = _hitFaces[_valid]
+            _lastFaces = _hitFaces[_valid]
+
+        # Last leg, from the first reflection point (or the receiver) to the source
+        _directions = self._source[None, :] - _points
+        _distances = np.linalg.norm(_directions, axis=1)
+        _directions /= np.maximum(_distances, DISTANCE_EPSILON)[:, None]
+        if accelerator is None:
+            _, _hitFaces, _, _ = intersectRays(_points, _directions, triangles, ignoreFaces=_lastFaces, tMax=_distances)
+            _visible = _hitFaces < 0
+        else:
+            _visible = ~accelerator.intersectAny(_points, _directions, triangles, _distances, ignoreFaces=_lastFaces)
+        return receiverIds[_visible], _faces[_visible], _lengths[_visible], -_directions[_visible]
@@ -1,7 +1,24 @@
 '''
     This module implements a class "Worker" that is used to encapsulate the
     process of realising individual tasks. The target function receives two
-    parameters: 'tasks' and 'workerID'.
+    parameters: 'tasks' and 'workerID', followed by the shared arguments of
+    the worker (data common to all its tasks, sent once per worker and not
+    with every chunk).
+
+    Workers can also be fed dynamically from a "WorkStealingQueue": each
+    worker keeps taking chunks of work from its own queue and, once it runs
+    dry, steals from the fullest queue of the others, so fast workers end up
+    doing more chunks. The queue lives in a manager process and is shared
+    with the workers through a proxy.
+
+    All workers run in one long-lived process pool (and one queue manager)
+    kept at module level, so repeated runs in the same session reuse warm
+    processes instead of forking new ones every time.
+
+    Completion is reported through callbacks: "startWorkers" returns a
+    future that is resolved with the results of all workers as soon as the
+    last one finishes, so callers can block on it, chain on it or await it
+    from asyncio without polling.
 
     Joe Simon 2018.
 '''
@@ -9,29 +26,204 @@
 
 from logger import *
 import numpy
+import atexit
+import threading
+import collections
+import concurrent.futures
 import multiprocessing as mp
+from multiprocessing.managers import BaseManager
+
+
+_workerPool = None
+_workerPoolSize = 0
+_workQueueManager = None
+_workerPoolLock = threading.RLock()
+# Pools replaced by a bigger one, joined in the background once their work is done
+_retiredPools = []
+
+
+class WorkStealingQueue:
+
+    def __init__(self, workers=1):
+        self._lock = threading.Lock()
+        self._queues = [collections.deque() for i in range(workers)]
+        self._taken = 0
+        self._stolen = 0
+
+
+    def distribute(self, chunks):
+        # Round-robin, so every worker starts with a similar mix of chunks
+        with self._lock:
+            for i, _chunk in enumerate(chunks):
+                self._queues[i % len(self._queues)].append(_chunk)
+
+
+    def take(self, workerId):
+        # Returns the next chunk for the worker, or None when all work is done
+        with self._lock:
+            _own = self._queues[workerId]
+            if len(_own) == 0:
+                _victim = max(self._queues, key=len)
+                if len(_victim) == 0:
+                    return None
+                # Steal half of the victim's remaining chunks, from the back
+                for i in range((len(_victim) + 1) // 2):
+                    _own.appendleft(_victim.pop())
+                    self._stolen += 1
+            self._taken += 1
+            return _own.popleft()
+
+
+    def statistics(self):
+        with self._lock:
+            return self._taken, self._stolen
+
+
+class WorkQueueManager(BaseManager):
+    pass
+
+
+WorkQueueManager.register('WorkStealingQueue', WorkStealingQueue)
+
+
+def getWorkerPool(size=None):
+    # The pool is only recreated when more processes are requested, so runs
+    # asking for fewer workers can share it with runs still in progress
+    global _workerPool, _workerPoolSize
+    if size is None:
+        size = mp.cpu_count()
+    with _workerPoolLock:
+        if _workerPool is not None and _workerPoolSize < size:
+            _retirePool()
+        if _workerPool is None:
+            getLogger().log(LogLevel.Info, "Starting pool of %d worker process(es)." % size)
+            _workerPool = mp.Pool(processes=size)
+            _workerPoolSize = size
+        return _workerPool
+
+
+def getWorkQueueManager():
+    global _workQueueManager
+    with _workerPoolLock:
+        if _workQueueManager is None:
+            _workQueueManager = WorkQueueManager()
+            _workQueueManager.start()
+        return _workQueueManager
+
+
+def _retirePool():
+    # The current pool takes no more tasks and is joined by a background
+    # thread once the runs still using it are done; the queue manager stays up
+    global _workerPool, _workerPoolSize
+    with _workerPoolLock:
+        if _workerPool is not None:
+            _pool = _workerPool
+            _pool.close()
+            _thread = threading.Thread(target=_pool.join, daemon=True)
+            _thread.start()
+            _retiredPools.append(_thread)
+            _workerPool = None
+            _workerPoolSize = 0
+
+
+def closeWorkerPool():
+    global _workerPool, _workerPoolSize, _workQueueManager
+    with _workerPoolLock:
+        if _workerPool is not None:
+            _workerPool.close()
+            _workerPool.join()
+            _workerPool = None
+            _workerPoolSize = 0
+        while len(_retiredPools) > 0:
+            _retiredPools.pop().join()
+        if _workQueueManager is not None:
+            _workQueueManager.shutdown()
+            _workQueueManager = None
+
+
+atexit.register(closeWorkerPool)
+
+
+def workOnQueue(target, queue, workerId, reduce=None, sharedArgs=()):
+    # Runs the target on chunks taken from the queue until there are none left.
+    # With 'reduce', the results of all chunks are folded into a single one
+    # with reduce(accumulated, new) before they leave the worker process.
+    _results = []
+    _chunk = queue.take(workerId)
+    while _chunk is not None:
+        _result = target(_chunk, workerId, *sharedArgs)
+        if reduce is not None and len(_results) > 0:
+            _results[0] = reduce(_results[0], _result)
+        else:
+            _results.append(_result)
+        _chunk = queue.take(workerId)
+    return _results
+
+
+def startWorkers(workers):
+    # Starts all workers and returns a future with the list of their results
+    # (in the same order), set from the pool's callbacks when the last one is done
+    _future = concurrent.futures.Future()
+    _results = [None] * len(workers)
+    _pending = [len(workers)]
+    _lock = threading.Lock()
+
+    def _onDone(index, result):
+        with _lock:
+            _results[index] = result
+            _pending[0] -= 1
+            if _pending[0] == 0 and not _future.done():
+                _future.set_result(_results)
+
+    def _onError(error):
+        with _lock:
+            if not _future.done():
+                _future.set_exception(error)
+
+    if len(workers) == 0:
+        _future.set_result(_results)
+    for i, _worker in enumerate(workers):
+        _worker.startWorking(onDone=lambda result, index=i: _onDone(index, result), onError=_onError)
+    return _future
 
 
 class Worker:
 
-    def __init__(self, workerId=0):
+    def __init__(self, workerId=0, target=None, poolSize=None, reduce=None, sharedArgs=()):
         self._log = getLogger() #Logger()
         self._tasks = None
+        self._queue = None
         self._worker = None
         self._workerId = workerId
+        self._target = target
+        self._poolSize = poolSize
+        self._reduce = reduce
+        self._sharedArgs = tuple(sharedArgs)
 
 
     def assignTasks(self, newTasks):
         self._tasks = newTasks
 
 
-    def startWorking(self):
-        if self._tasks is None:
+    def assignQueue(self, newQueue):
+        self._queue = newQueue
+
+
+    def startWorking(self, onDone=None, onError=None):
+        if self._tasks is None and self._queue is None:
             raise Exception("No tasks assigned to this worker!")
+        if self._target is None:
+            raise Exception("No target function set for this worker!")
 
-        self._pool = mp.Pool()
-        self._worker = self._pool.apply_async(func=self._tasks._rayTracerData.tracerEngine,
-                                              args=(self._tasks, self._workerId))
+        self._pool = getWorkerPool(self._poolSize)
+        if self._queue is not None:
+            self._worker = self._pool.apply_async(func=workOnQueue,
+                                                  args=(self._target, self._queue, self._workerId, self._reduce, self._sharedArgs),
+                                                  callback=onDone, error_callback=onError)
+        else:
+            self._worker = self._pool.apply_async(func=self._target,
+                                                  args=(self._tasks, self._workerId) + self._sharedArgs,
+                                                  callback=onDone, error_callback=onError)
 
 
     def isDone(self):
@@ -39,8 +231,7 @@ class Worker:
 
 
     def waitForWorker(self):
-        self._pool.close()
-        self._pool.join()
+        self._worker.wait()
 
 
     def getWorkerResults(self):
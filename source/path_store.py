@@ -0,0 +1,131 @@
+'''
+    This module keeps the ray segments traced from every source, so that a
+    run where only the receivers changed (e.g. a listener moved around the
+    room) detects the receivers on the stored segments instead of tracing
+    the rays again.
+
+    A store is a directory with one sub-directory per source, named after a
+    key of everything the rays depend on (geometry, parameters, environment,
+    materials and the source itself) but not the receivers. Every chunk of
+    rays is kept in its own file: start, direction, length, distance
+    travelled and energies of the segments that can reach a receiver within
+    the echogram, i.e. those after the image-source orders and starting
+    before its end, cut at that end. Directions and energies are kept in
+    single precision.
+
+    Chunks of the same rays with other receivers run at the same time, so a
+    worker claims the rays of a source (an exclusive marker file) before
+    tracing them. The others wait for the file and replay it.
+
+    Joe Simon 2018.
+'''
+
+
+import os
+import time
+import numpy as np
+
+
+PATH_STORE_EXTENSION = '.w3dpaths'
+# Segments replayed at once through the receiver detection
+PATH_STORE_REPLAY_BLOCK = 65536
+# Seconds after which a claim is taken as left by a crashed worker
+PATH_STORE_CLAIM_TIMEOUT = 600.0
+# Seconds between checks of a worker waiting for rays claimed by another
+PATH_STORE_POLL_INTERVAL = 0.05
+
+
+class PathStore:
+    def __init__(self, directory, sourceKey):
+        self._directory = os.path.join(directory, sourceKey)
+
+    def _filename(self, rayRange):
+        return os.path.join(self._directory, "rays-%d-%d-%d.npz" % tuple(rayRange))
+
+    def _claimFilename(self, rayRange):
+        return self._filename(rayRange)[:-4] + '.claim'
+
+    def has(self, rayRange):
+        return os.path.isfile(self._filename(rayRange))
+
+    def claim(self, rayRange):
+        # True if the caller has to trace the rays, and release them once
+        # saved; False once they are in the store, traced by whoever claimed
+        # them first
+        os.makedirs(self._directory, exist_ok=True)
+        _claim = self._claimFilename(rayRange)
+        while not self.has(rayRange):
+            try:
+                os.close(os.open(_claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(_claim) > PATH_STORE_CLAIM_TIMEOUT:
+                        os.remove(_claim)
+                except OSError:
+                    pass
+                time.sleep(PATH_STORE_POLL_INTERVAL)
+                continue
+            # They may have been saved before the claim was made
+            if self.has(rayRange):
+                self.release(rayRange)
+                return False
+            return True
+        return False
+
+    def release(self, rayRange):
+        try:
+            os.remove(self._claimFilename(rayRange))
+        except OSError:
+            pass
+
+    def save(self, rayRange, segments):
+        # Written under a temporary name and renamed, so a file is either
+        # complete or missing, also when several workers save the same chunk
+        os.makedirs(self._directory, exist_ok=True)
+        _temporary = "%s.%d.tmp.npz" % (self._filename(rayRange)[:-4], os.getpid())
+        np.savez(_temporary, **segments)
+        os.replace(_temporary, self._filename(rayRange))
+
+    def load(self, rayRange):
+        with np.load(self._filename(rayRange)) as _file:
+            return dict([(_name, _file[_name]) for _name in _file.files])
+
+
+class SegmentRecorder:
+    # Segment callback for traceRayPacket that keeps the segments from
+    # 'firstBounce' on that start before 'maxDistance', and passes all the
+    # segments on to 'onSegment'
+    def __init__(self, firstBounce, maxDistance, onSegment=None):
+        self._firstBounce = firstBounce
+        self._maxDistance = maxDistance
+        self._onSegment = onSegment
+        self._segments = dict([(_name, []) for _name in ('starts', 'directions', 'lengths', 'pathLengths', 'energies')])
+
+    def __call__(self, bounce, rayIds, starts, directions, lengths, pathLengths, faces, energies):
+        if self._onSegment is not None:
+            self._onSegment(bounce, rayIds, starts, directions, lengths, pathLengths, faces, energies)
+        if bounce < self._firstBounce:
+            return
+        _kept = pathLengths < self._maxDistance
+        self._segments['starts'].append(starts[_kept])
+        self._segments['directions'].append(directions[_kept].astype(np.float32))
+        self._segments['lengths'].append(np.minimum(lengths[_kept], self._maxDistance - pathLengths[_kept]))
+        self._segments['pathLengths'].append(pathLengths[_kept])
+        self._segments['energies'].append(energies[_kept].astype(np.float32))
+
+    def segments(self):
+        _empty = {'starts': np.zeros((0, 3)), 'directions': np.zeros((0, 3), dtype=np.float32), 'lengths': np.zeros(0), 'pathLengths': np.zeros(0), 'energies': np.zeros((0, 1), dtype=np.float32)}
+        return dict([(_name, np.concatenate(_parts) if len(_parts) > 0 else _empty[_name]) for _name, _parts in self._segments.items()])
+
+
+def replaySegments(segments, onSegment, bounce):
+    # Reports stored segments to a segment callback (as bounce 'bounce'),
+    # in blocks; returns the number of segments
+    _count = len(segments['lengths'])
+    for _start in range(0, _count, PATH_STORE_REPLAY_BLOCK):
+        _block = slice(_start, min(_start + PATH_STORE_REPLAY_BLOCK, _count))
+        _starts = segments['starts'][_block]
+        _directions = segments['directions'][_block].astype(float)
+        onSegment(bounce, np.arange(len(_starts)), _starts, _directions, segments['lengths'][_block], segments['pathLengths'][_block],
+                  np.full(len(_starts), -1, dtype=np.int64), segments['energies'][_block].astype(float))
+    return _count
@@ -0,0 +1,162 @@
+'''
+    This module implements the vectorised geometric kernels of the ray-tracer:
+    a batched Moller-Trumbore ray-triangle intersection that tests whole ray
+    packets against the formed triangle arrays at once, and the specular
+    reflection of ray directions.
+
+    The epsilons of the kernels follow the precision of the triangle arrays
+    (float64 or float32): in float32 the shortest hit distance is well above
+    the rounding of hit points, and hits slightly outside the edges of a face
+    still count, so rays through the edge shared by two faces cannot slip
+    between them.
+
+    Joe Simon 2018.
+'''
+
+
+import numpy as np
+
+
+# Bound for the size of the (rays x triangles) temporaries of one numpy call
+MAX_ELEMENTS_PER_BLOCK = 1 << 20
+DETERMINANT_EPSILON = 1e-12
+DISTANCE_EPSILON = 1e-9
+
+# Floating point types of the scene and the ray packets
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+# Determinant below which a ray is parallel to a face, shortest hit distance
+# (metres) and barycentric tolerance at the edges, per precision
+INTERSECTION_EPSILONS = {np.dtype(np.float64): (DETERMINANT_EPSILON, DISTANCE_EPSILON, 0.0),
+                         np.dtype(np.float32): (1e-7, 1e-4, 1e-6)}
+
+
+def precisionType(precision):
+    if not precision in PRECISIONS:
+        raise Exception("The precision must be one of: %s!" % ", ".join(sorted(PRECISIONS.keys())))
+    return np.dtype(PRECISIONS[precision])
+
+
+def intersectionEpsilons(dtype):
+    return INTERSECTION_EPSILONS[np.dtype(dtype)]
+
+
+# Per-face data of the Moller-Trumbore test: first vertex, both edges and the
+# unit normal, precomputed once per scene (in float64, then stored in 'dtype').
+class TriangleArrays:
+    def __init__(self, vertices=None, dtype=np.float64):
+        self._v0 = np.zeros((0, 3), dtype=dtype)
+        self._e1 = np.zeros((0, 3), dtype=dtype)
+        self._e2 = np.zeros((0, 3), dtype=dtype)
+        self._normals = np.zeros((0, 3), dtype=dtype)
+        if vertices is not None:
+            self._fromVertices(vertices, dtype)
+
+    def _fromVertices(self, vertices, dtype=np.float64):
+        _vertices = np.asarray(vertices, dtype=float)
+        _e1 = _vertices[:, 1, :] - _vertices[:, 0, :]
+        _e2 = _vertices[:, 2, :] - _vertices[:, 0, :]
+        _normals = np.cross(_e1, _e2)
+        _lengths = np.linalg.norm(_normals, axis=1)
+        _lengths[_lengths == 0.0] = 1.0
+        self._v0 = np.ascontiguousarray(_vertices[:, 0, :], dtype=dtype)
+        self._e1 = np.ascontiguousarray(_e1, dtype=dtype)
+        self._e2 = np.ascontiguousarray(_e2, dtype=dtype)
+        self._normals = np.ascontiguousarray(_normals / _lengths[:, None], dtype=dtype)
+
+    def __len__(self):
+        return len(self._v0)
+
+    def toArrays(self):
+        return {'v0': self._v0, 'e1': self._e1, 'e2': self._e2, 'normals': self._normals}
+
+
+def triangleArraysFromScene(scene):
+    _triangles = TriangleArrays()
+    _triangles._v0 = scene['v0']
+    _triangles._e1 = scene['e1']
+    _triangles._e2 = scene['e2']
+    _triangles._normals = scene['normals']
+    return _triangles
+
+
+def intersectRays(origins, directions, triangles, faces=None, ignoreFaces=None, tMax=None):
+    # Nearest hit of every ray against the given faces (all by default).
+    # Returns the distance (inf when nothing is hit), the face index (-1) and
+    # the barycentric coordinates (u, v) of the hit point.
+    _rays = len(origins)
+    _dtype = np.result_type(origins, triangles._v0)
+    _detEpsilon, _distanceEpsilon, _edgeEpsilon = intersectionEpsilons(triangles._v0.dtype)
+    _t = np.full(_rays, np.inf, dtype=_dtype) if tMax is None else np.array(tMax, dtype=_dtype)
+    _faceIndex = np.full(_rays, -1, dtype=np.int64)
+    _u = np.zeros(_rays, dtype=_dtype)
+    _v = np.zeros(_rays, dtype=_dtype)
+
+    if faces is None:
+        faces = np.arange(len(triangles))
+    if _rays == 0 or len(faces) == 0:
+        return _t, _faceIndex, _u, _v
+
+    _blockSize = max(1, MAX_ELEMENTS_PER_BLOCK // _rays)
+    for _blockStart in range(0, len(faces), _blockSize):
+        _block = faces[_blockStart:_blockStart + _blockSize]
+        _v0 = triangles._v0[_block][None, :, :]
+        _e1 = triangles._e1[_block][None, :, :]
+        _e2 = triangles._e2[_block][None, :, :]
+        _d = directions[:, None, :]
+
+        _pvec = np.cross(_d, _e2)
+        _det = (_e1 * _pvec).sum(axis=2)
+        _parallel = np.abs(_det) < _detEpsilon
+        _invDet = 1.0 / np.where(_parallel, 1.0, _det)
+
+        _tvec = origins[:, None, :] - _v0
+        _uBlock = (_tvec * _pvec).sum(axis=2) * _invDet
+        _qvec = np.cross(_tvec, _e1)
+        _vBlock = (_d * _qvec).sum(axis=2) * _invDet
+        _tBlock = (_e2 * _qvec).sum(axis=2) * _invDet
+
+        _valid = (~_parallel) & (_uBlock >= -_edgeEpsilon) & (_vBlock >= -_edgeEpsilon) & (_uBlock + _vBlock <= 1.0 + _edgeEpsilon) & (_tBlock > _distanceEpsilon)
+        if ignoreFaces is not None:
+            _valid &= ~(_block[None, :] == ignoreFaces[:, None])
+        _tBlock = np.where(_valid, _tBlock, np.inf)
+
+        _nearest = np.argmin(_tBlock, axis=1)
+        _rows = np.arange(_rays)
+        _tNearest = _tBlock[_rows, _nearest]
+        _closer = _tNearest < _t
+        _t[_closer] = _tNearest[_closer]
+        _faceIndex[_closer] = _block[_nearest[_closer]]
+        _u[_closer] = _uBlock[_rows, _nearest][_closer]
+        _v[_closer] = _vBlock[_rows, _nearest][_closer]
+
+    return _t, _faceIndex, _u, _v
+
+
+def intersectRayFacePairs(origins, directions, triangles, faces, ignoreFaces=None):
+    # Moller-Trumbore for independent (ray, face) pairs, all arrays having one
+    # row per pair. Returns the distance (inf when missed) and (u, v).
+    _detEpsilon, _distanceEpsilon, _edgeEpsilon = intersectionEpsilons(triangles._v0.dtype)
+    _v0 = triangles._v0[faces]
+    _e1 = triangles._e1[faces]
+    _e2 = triangles._e2[faces]
+
+    _pvec = np.cross(directions, _e2)
+    _det = (_e1 * _pvec).sum(axis=1)
+    _parallel = np.abs(_det) < _detEpsilon
+    _invDet = 1.0 / np.where(_parallel, 1.0, _det)
+
+    _tvec = origins - _v0
+    _u = (_tvec * _pvec).sum(axis=1) * _invDet
+    _qvec = np.cross(_tvec, _e1)
+    _v = (directions * _qvec).sum(axis=1) * _invDet
+    _t = (_e2 * _qvec).sum(axis=1) * _invDet
+
+    _valid = (~_parallel) & (_u >= -_edgeEpsilon) & (_v >= -_edgeEpsilon) & (_u + _v <= 1.0 + _edgeEpsilon) & (_t > _distanceEpsilon)
+    if ignoreFaces is not None:
+        _valid &= ~(faces == ignoreFaces)
+    return np.where(_valid, _t, np.inf), _u, _v
+
+
+def reflectDirections(directions, normals):
+    _projection = (directions * normals).sum(axis=1)
+    return directions - 2.0 * _projection[:, None] * normals
@@ -4,7 +4,16 @@ from logger import *
 from multithread_workers import *
 import time
 import os
+import asyncio
+import threading
+import concurrent.futures
 from ray_tracing_classes import *
+from ray_tracing_engine import *
+from shared_scene import *
+from image_source import *
+from checkpoint import *
+from distributed_tracing import *
+from path_store import *
 
 
 class RayTracer:
@@ -17,6 +26,15 @@ class RayTracer:
         self._log = getLogger() #Logger()
         self._rayTracerParameters = None
         self._outputFilename = None
+        self._sharedScene = None
+        self._sharedSceneKey = None
+        self._sharedSceneLock = threading.Lock()
+        self._materialAbsorption = {}
+        self._checkpointFilename = None
+        self._broker = None
+        self._remoteScene = None
+        self._sceneOwner = None
+        self._pathStoreDirectory = None
 
 
     def addSource(self, newSource):
@@ -30,6 +48,7 @@ class RayTracer:
             raise Exception("A new environment geometry for the ray-tracer must be of type LibraryGeometries!")
         if not self._environmentGeometry is None:
             self._log.log(LogLevel.Warn, "Discarding previously loaded environment geometry!")
+            self._unpublishScene()
         self._environmentGeometry = newEnvironmentGeometry
 
 
@@ -41,13 +60,228 @@ class RayTracer:
         self._environmentParameters = newEnvironmentParameters
 
 
+    def addMaterialAbsorption(self, material, absorption):
+        # Absorption coefficient(s) of a material, by ID or name: one per
+        # frequency band, or a single one for all bands
+        _coefficients = numpy.asarray(absorption, dtype=float)
+        if not numpy.all((_coefficients >= 0.0) & (_coefficients <= 1.0)):
+            raise Exception("Absorption coefficients must be between 0 and 1!")
+        self._materialAbsorption[material] = absorption
+
+
+    def materialReflectance(self):
+        # (materials + 1) x bands array of reflectances, in the order of the
+        # material ids of the formed triangles, the last row for faces without
+        # material
+        _bands = len(self._rayTracerParameters._frequencyBands)
+        _table = self._environmentGeometry._materialTable
+        _absorption = numpy.full((len(_table) + 1, _bands), float(self._rayTracerParameters._defaultAbsorption))
+        for _material, _coefficients in self._materialAbsorption.items():
+            _materialIndex = _table.materialIndex(_material)
+            if _materialIndex < 0:
+                self._log.log(LogLevel.Warn, "Absorption set for unknown material '%s'!" % str(_material))
+                continue
+            _coefficients = numpy.asarray(_coefficients, dtype=float).reshape(-1)
+            if not len(_coefficients) in (1, _bands):
+                raise Exception("Material '%s' needs one absorption coefficient per frequency band (%d)!" % (str(_material), _bands))
+            _absorption[_materialIndex] = _coefficients
+        return 1.0 - _absorption
+
+
     def addReceiver(self, newReceiverDefinition):
-        if not isinstance(newReceiverDefinition, ReceiverDefinition):
-            raise Exception("A new receiver for the ray-tracer must be of type ReceiverDefinition!")
+        if not isinstance(newReceiverDefinition, (ReceiverDefinition, ReceiverArrayDefinition)):
+            raise Exception("A new receiver for the ray-tracer must be of type ReceiverDefinition or ReceiverArrayDefinition!")
         self._receivers.append(newReceiverDefinition)
 
 
+    def clearReceivers(self):
+        self._receivers = []
+
+
+    def receiverArrays(self):
+        # Locations (R, 3) and radii (R,) of all receivers, in the order they
+        # were added; these index the receivers of the results
+        return receiverArrays(self._receivers)
+
+
     def executeTracing(self):
+        # Blocks until the last chunk is traced
+        return self.startTracing().result()
+
+
+    async def executeTracingAsync(self):
+        # Same as executeTracing, awaitable from asyncio. Preparing the scene may
+        # build the acceleration structure, so it runs off the event loop too.
+        # Several simulations can be awaited at once, they share the worker pool.
+        _loop = asyncio.get_running_loop()
+        _future = await _loop.run_in_executor(None, self.startTracing)
+        return await asyncio.wrap_future(_future)
+
+
+    def startTracing(self, enabledPairs=None):
+        # Starts the simulation and returns a concurrent.futures.Future with its
+        # results. 'enabledPairs' (sources x receivers) restricts the pairs traced.
+        self._prepareTracing()
+        return self._runChunks(self._divideWorkInParts(enabledPairs=enabledPairs))
+
+
+    def enableCheckpoint(self, filename=None):
+        # Completed chunks are saved to the checkpoint (next to the output file
+        # by default), and a run of the same scene and parameters resumes it
+        if filename is None:
+            if self._outputFilename is None:
+                raise Exception("A checkpoint needs a filename or an output filename to be placed next to!")
+            filename = self._outputFilename + CHECKPOINT_EXTENSION
+        self._checkpointFilename = filename
+
+
+    def retainPaths(self, directory=None):
+        # The ray segments of every source are kept in a path store (next to
+        # the output file by default); later runs that only change the
+        # receivers detect them on the stored segments instead of tracing
+        if directory is None:
+            if self._outputFilename is None:
+                raise Exception("A path store needs a directory or an output filename to be placed next to!")
+            directory = self._outputFilename + PATH_STORE_EXTENSION
+        self._pathStoreDirectory = directory
+
+
+    def _geometryHash(self):
+        _geometryHash = self._environmentGeometry._contentHash
+        if _geometryHash is None:
+            _triangles = self._environmentGeometry._formedTriangles
+            _geometryHash = checkpointKey(_triangles._vertices, _triangles._materialIds)
+        elif not self._environmentGeometry._precision == 'float64':
+            _geometryHash = checkpointKey(_geometryHash, self._environmentGeometry._precision)
+        return _geometryHash
+
+
+    def _pathStoreKey(self, source):
+        # Everything the rays of the source depend on, but not the receivers
+        _receiverParameters = ('_parallelThreads', '_receiversPerChunk', '_receiverGridCellSize', '_progressiveRounds', '_convergenceTolerance', '_convergenceRange')
+        _parameters = sorted([(_name, _value) for _name, _value in vars(self._rayTracerParameters).items() if not _name in _receiverParameters])
+        _directivity = source._directivity
+        return checkpointKey(self._geometryHash(), _parameters, sorted(vars(self._environmentParameters).items()), self.materialReflectance(),
+                             source._type, source._location, _directivity._type, _directivity._elevations, _directivity._azimuths, _directivity._gains)
+
+
+    def _checkpointKey(self):
+        # Everything the results depend on; the number of workers does not count
+        _geometryHash = self._geometryHash()
+        _parameters = sorted([(_name, _value) for _name, _value in vars(self._rayTracerParameters).items() if not _name == '_parallelThreads'])
+        _sources = [(_source._type, _source._location, _source._directivity._type) for _source in self._sources]
+        _balloons = [_table for _source in self._sources for _table in (_source._directivity._elevations, _source._directivity._azimuths, _source._directivity._gains)]
+        _receiverLocations, _receiverRadii = self.receiverArrays()
+        return checkpointKey(_geometryHash, _parameters, sorted(vars(self._environmentParameters).items()), _sources, *_balloons,
+                             _receiverLocations, _receiverRadii, self.materialReflectance())
+
+
+    def _runChunks(self, work):
+        # Runs the chunks through the checkpoint when there is one
+        if self._checkpointFilename is not None:
+            return self._runWorkersWithCheckpoint(work)
+        return self._runWorkers(work)
+
+
+    def _runWorkersWithCheckpoint(self, work):
+        # Skips the chunks of 'work' found in the checkpoint and adds their
+        # results back (chunks of other work, e.g. other progressive rounds,
+        # are left alone)
+        _checkpoint = TracingCheckpoint(self._checkpointFilename, self._checkpointKey())
+        _resumed = TracerEngineResults()
+        _resumed.allocateEchogram(len(self._sources), len(self.receiverArrays()[1]), self._rayTracerParameters._frequencyBands,
+                                  self._rayTracerParameters._echogramTimeStep, self._rayTracerParameters._echogramDuration,
+                                  precisionType(self._rayTracerParameters._precision))
+        if _checkpoint.open():
+            _completed = _checkpoint.completedChunks() & set([_work._key for _work in work])
+            work = [_work for _work in work if not _work._key in _completed]
+            _checkpoint.load(_resumed, _completed)
+            self._log.log(LogLevel.Info, "Resuming from checkpoint '%s': %d chunk(s) done, %d left." % (self._checkpointFilename, len(_completed), len(work)))
+        else:
+            self._log.log(LogLevel.Info, "Started checkpoint '%s'." % self._checkpointFilename)
+
+        _future = concurrent.futures.Future()
+        def _onWorkersDone(workersDone):
+            try:
+                _future.set_result(_resumed.add(workersDone.result()))
+            except Exception as error:
+                _future.set_exception(error)
+        self._runWorkers(work).add_done_callback(_onWorkersDone)
+        return _future
+
+
+    def executeTracingProgressive(self, callback=None, rounds=None, tolerance=None):
+        # Runs traceProgressively to the end, handing every partial result to
+        # 'callback', and returns the last results
+        _progress = None
+        for _progress in self.traceProgressively(rounds, tolerance):
+            if callback is not None:
+                callback(_progress)
+        return _progress._results
+
+
+    def traceProgressively(self, rounds=None, tolerance=None):
+        # Generator of ProgressiveTracingResults. The image sources are found
+        # first, then the rays are traced in rounds, every round an evenly
+        # spread subset of them. After each round the echograms traced so far
+        # are scaled up to a full run and the decay curves of every (source,
+        # receiver) pair compared with those of the previous round; pairs that
+        # changed less than 'tolerance' dB are converged and not traced again.
+        # Stops when all pairs have converged or all the rays are traced.
+        self._prepareTracing()
+        if rounds is None:
+            rounds = self._rayTracerParameters._progressiveRounds
+        if tolerance is None:
+            tolerance = self._rayTracerParameters._convergenceTolerance
+        rounds = max(1, min(rounds, rayCountForResolution(self._rayTracerParameters._angularResolution)))
+
+        _pairs = (len(self._sources), len(self.receiverArrays()[1]))
+        _imageSources = None
+        if self._rayTracerParameters._imageSourceOrder >= 0:
+            _imageSources = self._runChunks(self._divideWorkInParts(rays=False)).result()
+
+        _rays = None
+        _roundsTraced = numpy.zeros(_pairs, dtype=numpy.int64)
+        _converged = numpy.zeros(_pairs, dtype=bool)
+        _decay = None
+        for _round in range(rounds):
+            _tracing = ~_converged
+            _roundResults = self._runChunks(self._divideWorkInParts(imageSources=False, rayRound=_round, rayRounds=rounds, enabledPairs=_tracing)).result()
+            _rays = _roundResults if _rays is None else _rays.add(_roundResults)
+            _roundsTraced[_tracing] += 1
+
+            _estimate = self._progressiveEstimate(_imageSources, _rays, _roundsTraced, rounds)
+            _previousDecay, _decay = _decay, decayCurves(_estimate._echogram, self._rayTracerParameters._convergenceRange)
+            _change = numpy.full(_pairs, numpy.inf)
+            if _previousDecay is not None:
+                _change = decayCurveChange(_previousDecay, _decay)
+                _converged |= _tracing & (_change <= tolerance)
+            self._log.log(LogLevel.Info, "Progressive round %d of %d: %d of %d pair(s) converged." % (_round + 1, rounds, numpy.count_nonzero(_converged), _converged.size))
+
+            _progress = ProgressiveTracingResults()
+            _progress._results = _estimate
+            _progress._round = _round + 1
+            _progress._rounds = rounds
+            _progress._change = _change
+            _progress._converged = _converged.copy()
+            yield _progress
+            if numpy.all(_converged):
+                break
+
+
+    def _progressiveEstimate(self, imageSources, rays, roundsTraced, rounds):
+        # Ray echograms scaled to all the rounds, plus the image sources
+        _estimate = TracerEngineResults().add(rays)
+        _scale = rounds / numpy.maximum(roundsTraced, 1)
+        _estimate._echogram = rays._echogram * _scale[:, :, None, None]
+        if imageSources is not None:
+            _estimate._echogram += imageSources._echogram
+            _estimate._imageSources = imageSources._imageSources
+            _estimate._imageSourcePaths = imageSources._imageSourcePaths
+        return _estimate
+
+
+    def _prepareTracing(self):
         # Check that all needed data is available
         if self._environmentGeometry is None:
             raise Exception("Cannot execute a ray-tracing without an environment geometry definition!")
@@ -61,112 +295,375 @@ class RayTracer:
         if self._rayTracerParameters is None:
             self._rayTracerParameters = RayTracerParameters()
             self._log.log(LogLevel.Warn, "No ray-tracer parameters set. Using default values!")
+        for _source in self._sources:
+            if not _source._directivity.bands() in (1, len(self._rayTracerParameters._frequencyBands)):
+                raise Exception("The directivity of a source needs gains for one or all (%d) frequency bands!" % len(self._rayTracerParameters._frequencyBands))
         self._log.log(LogLevel.Info, "All data ready.\nRay-tracing simulation started.")
         if self._outputFilename is None:
             self._log.log(LogLevel.Warn, "No output filename set! The results will not be saved!")
 
         # --- Conduct ray-tracing
 
-        # Divide the total work in multiple packages for the workers
-        if not self._rayTracerParameters._parallelThreads >= 1:
-            raise Exception("The parameter 'parallelThreads' must be set to 1 (single thread) or higher.")
-        self._log.log(LogLevel.Info, "Dividing work in parts for %d worker(s)." % self._rayTracerParameters._parallelThreads)
-        _work = self._divideWorkInParts()
+        # Publish the scene arrays once, the workers attach to them by name and
+        # keep them attached for the next runs on the same scene
+        self._publishScene()
 
-        # Create workers
-        self._log.log(LogLevel.Info, "Creating %d worker(s)." % self._rayTracerParameters._parallelThreads)
-        _workers = [Worker(workerId=i) for i in range(self._rayTracerParameters._parallelThreads)]
-
-        # Assign tasks to workers
-        self._log.log(LogLevel.Info, "Assigning tasks to %d worker(s)." % self._rayTracerParameters._parallelThreads)
-        for i in range(self._rayTracerParameters._parallelThreads):
-            _workers[i].assignTasks(_work[i])
 
-        # Start workers
-        self._log.log(LogLevel.Info, "Starting %d worker(s)." % self._rayTracerParameters._parallelThreads)
-        for i in range(self._rayTracerParameters._parallelThreads):
-            _workers[i].startWorking()
+    def close(self):
+        # Releases the shared scene, the worker pool is shared and stays warm
+        self._unpublishScene()
 
-        # Wait for workers to finish
-        time.sleep(1.0)
-        self._log.log(LogLevel.Info, "Waiting for all worker(s) to finish.")
-        _unfinishedWorkers = [i for i in range(self._rayTracerParameters._parallelThreads)]
-        while(not len(_unfinishedWorkers) == 0):
-            for i in _unfinishedWorkers:
-                if _workers[i].isDone():
-                    self._log.log(LogLevel.Info, "Worker with ID %d (%d total) finished." % (i, self._rayTracerParameters._parallelThreads))
-                    _unfinishedWorkers.remove(i)
-            if not len(_unfinishedWorkers) == 0:
-                time.sleep(0.20)
 
-        # Gather results
-        self._log.log(LogLevel.Info, "Gathering results.")
-        _results = [_workers[i].getWorkerResults() for i in range(self._rayTracerParameters._parallelThreads)]
+    def shareSceneWith(self, other):
+        # Traces on the geometry of another tracer and on the scene it already
+        # published (in shared memory or to its broker), which stays its own
+        if other._rayTracerParameters is None:
+            raise Exception("The tracer sharing its scene needs its ray-tracer parameters set!")
+        other._publishScene()
+        self._unpublishScene()
+        self._environmentGeometry = other._environmentGeometry
+        self._broker = other._broker
+        self._sharedScene, self._sharedSceneKey = other._sharedScene, other._sharedSceneKey
+        self._remoteScene = other._remoteScene
+        self._sceneOwner = other
 
-        # Return results
-        self._log.log(LogLevel.Info, "Ray-tracing simulation completed.")
-        return self._joinTracerEngineResults(_results)
 
+    def useBroker(self, address, authkey=DEFAULT_BROKER_AUTHKEY):
+        # The chunks of work are sent to the nodes of the task broker at
+        # 'address' instead of the local pool ('None' goes back to it). A
+        # checkpoint is written by the nodes, so it needs a shared filesystem.
+        self._releaseRemoteScene()
+        self._broker = None if address is None else connectBroker(address, authkey)
 
-    def _joinTracerEngineResults(self, individualResultsArray):
-        # TODO: complete this
-        print(individualResultsArray)
-        return individualResultsArray
 
+    def _runWorkers(self, work):
+        # Runs the chunks of work on the workers, returns a future with the results
+        if self._broker is not None:
+            return self._runWorkersOnBroker(work)
+        if not self._rayTracerParameters._parallelThreads >= 1:
+            raise Exception("The parameter 'parallelThreads' must be set to 1 (single thread) or higher.")
+        _work = work
+        self._log.log(LogLevel.Info, "Divided work in %d chunk(s) for %d worker(s)." % (len(_work), self._rayTracerParameters._parallelThreads))
+
+        # The chunks are handed out dynamically from a shared work-stealing
+        # queue, the data they share goes once to every worker
+        _queue = getWorkQueueManager().WorkStealingQueue(self._rayTracerParameters._parallelThreads)
+        _queue.distribute(_work)
+        _workersDone = self._runWorkersOnQueue(_queue, self._workerData())
+
+        # Results are gathered by whichever thread sees the last worker finish
+        _future = concurrent.futures.Future()
+        def _onWorkersDone(workersDone):
+            try:
+                # One list of per-chunk results per worker
+                _results = [_result for _workerResults in workersDone.result() for _result in _workerResults]
+                self._log.log(LogLevel.Info, "Processed %d chunk(s), %d of them stolen by idle workers." % _queue.statistics())
+                self._log.log(LogLevel.Info, "Ray-tracing simulation completed.")
+                _future.set_result(self._joinTracerEngineResults(_results))
+            except Exception as error:
+                _future.set_exception(error)
+        _workersDone.add_done_callback(_onWorkersDone)
+        return _future
+
+
+    def _runWorkersOnBroker(self, work):
+        # Submits the chunks as one job, a thread waits on the broker for it
+        _jobId = self._broker.submit(work, self._remoteScene[1].key(), (self._workerData(),))
+        self._log.log(LogLevel.Info, "Submitted %d chunk(s) to the task broker as job %d." % (len(work), _jobId))
+
+        _future = concurrent.futures.Future()
+        def _waitForJob():
+            try:
+                self._broker.waitJob(_jobId)
+                _results, _nodes = self._broker.jobResults(_jobId)
+                self._log.log(LogLevel.Info, "Job %d completed by %d node worker(s): %s." % (_jobId, len(_nodes), ", ".join(_nodes)))
+                self._log.log(LogLevel.Info, "Ray-tracing simulation completed.")
+                _future.set_result(self._joinTracerEngineResults(_results))
+            except Exception as error:
+                _future.set_exception(error)
+        threading.Thread(target=_waitForJob, daemon=True).start()
+        return _future
+
+
+    def _runWorkersOnQueue(self, queue, rayTracerData):
+        # Create workers
+        self._log.log(LogLevel.Info, "Creating %d worker(s)." % self._rayTracerParameters._parallelThreads)
+        _workers = [Worker(workerId=i, target=RayTracer.tracerEngine, poolSize=self._rayTracerParameters._parallelThreads, reduce=TracerEngineResults.add,
+                           sharedArgs=(rayTracerData,)) for i in range(self._rayTracerParameters._parallelThreads)]
 
-    def _divideWorkInParts(self):
-        _dividedWork = [WorkDefinition(rayTracerData=self) for i in range(self._rayTracerParameters._parallelThreads)]
+        # Assign the queue to workers
+        self._log.log(LogLevel.Info, "Assigning tasks to %d worker(s)." % self._rayTracerParameters._parallelThreads)
+        for i in range(self._rayTracerParameters._parallelThreads):
+            _workers[i].assignQueue(queue)
 
-        # If there are multiple sources, give each worker some
-        if len(self._sources) > 1:
-            # TODO: complete this
-            pass
+        # Start workers, the returned future is resolved when the last one finishes
+        self._log.log(LogLevel.Info, "Starting %d worker(s)." % self._rayTracerParameters._parallelThreads)
+        return startWorkers(_workers)
 
-        # If there are multiple receivers, give each worker some
-        elif len(self._receivers) > 1:
-            # TODO: complete this
-            pass
 
-        # If there's a single source and a single receiver, give each worker a fraction of the total angular range
+    def _joinTracerEngineResults(self, individualResultsArray):
+        # The results of the workers are summed pairwise as a reduction tree,
+        # blocks of the same pairs merging on the way, and the root is added
+        # into a single echogram of all the (source, receiver) pairs
+        _level = list(individualResultsArray)
+        for _results in _level:
+            self._log.log(LogLevel.Info, "Worker results: %s." % str(_results))
+        while len(_level) > 1:
+            _level = [_level[i].add(_level[i + 1]) if i + 1 < len(_level) else _level[i] for i in range(0, len(_level), 2)]
+
+        _joined = TracerEngineResults()
+        _joined.allocateEchogram(len(self._sources), len(self.receiverArrays()[1]), self._rayTracerParameters._frequencyBands,
+                                 self._rayTracerParameters._echogramTimeStep, self._rayTracerParameters._echogramDuration,
+                                 precisionType(self._rayTracerParameters._precision))
+        if len(_level) > 0:
+            _joined.add(_level[0])
+        self._log.log(LogLevel.Info, "Joined results: %s." % str(_joined))
+        return _joined
+
+
+    def _sceneArrays(self):
+        # In the coarser of the precisions of the tracer and the loaded
+        # geometry; the ray packets follow the precision of the scene
+        _triangles = self._environmentGeometry._formedTriangles
+        _dtype = numpy.float64
+        if not (self._rayTracerParameters._precision == 'float64' and _triangles._vertices.dtype == numpy.float64):
+            _dtype = numpy.float32
+        _arrays = {'vertices': _triangles._vertices.astype(_dtype),
+                   'materialIds': _triangles._materialIds}
+        _arrays.update(TriangleArrays(_triangles._vertices, _dtype).toArrays())
+        if self._rayTracerParameters._useAccelerationStructure and len(_triangles) >= BVH_MIN_TRIANGLES:
+            _arrays.update(self._environmentGeometry.getAccelerationStructure().toArrays(_dtype))
+        return _arrays
+
+
+    def _publishScene(self):
+        # Nothing to do if this geometry is already published with the same layout
+        _key = (id(self._environmentGeometry), self._environmentGeometry._precision, self._rayTracerParameters._useAccelerationStructure, self._rayTracerParameters._precision)
+        if self._broker is not None:
+            self._publishRemoteScene(_key)
+            return
+        with self._sharedSceneLock:
+            if self._sharedScene is not None and self._sharedSceneKey == _key:
+                return
+            self._unpublishScene()
+
+            self._sharedScene = SharedScene()
+            self._sharedSceneKey = _key
+            for _name, _array in self._sceneArrays().items():
+                self._sharedScene.publish(_name, _array)
+            self._log.log(LogLevel.Info, "Published scene in shared memory (%d bytes)." % self._sharedScene.nbytes())
+
+
+    def _publishRemoteScene(self, key):
+        # The broker keeps scenes by the hash of their arrays, so the same
+        # scene is only uploaded once whichever tracer sends it
+        with self._sharedSceneLock:
+            if self._remoteScene is not None and self._remoteScene[0] == key:
+                return
+            self._releaseRemoteScene()
+            _arrays = self._sceneArrays()
+            _sceneHash = checkpointKey(*[_part for _name in sorted(_arrays.keys()) for _part in (_name, _arrays[_name])])
+            if not self._broker.acquireScene(_sceneHash):
+                self._broker.publishScene(_sceneHash, _arrays)
+                self._log.log(LogLevel.Info, "Published scene %s to the task broker (%d bytes)." % (_sceneHash, sum([_array.nbytes for _array in _arrays.values()])))
+            self._remoteScene = (key, RemoteSceneHandle(_sceneHash))
+
+
+    def _unpublishScene(self):
+        # A scene shared by another tracer is only let go
+        if self._sceneOwner is not None:
+            self._sharedScene, self._sharedSceneKey, self._remoteScene, self._sceneOwner = None, None, None, None
+            return
+        if self._sharedScene is not None:
+            self._sharedScene.close()
+            self._sharedScene = None
+            self._sharedSceneKey = None
+        self._releaseRemoteScene()
+
+
+    def _releaseRemoteScene(self):
+        # Lets the broker drop the scene once no tracer or job needs it
+        if self._remoteScene is not None and self._sceneOwner is None:
+            self._broker.releaseScene(self._remoteScene[1].key())
+        self._remoteScene = None
+
+
+    def _workerData(self):
+        _data = RayTracerData()
+        if self._broker is not None:
+            _data._sceneHandle = self._remoteScene[1]
         else:
-            # TODO: complete this
-            pass
+            _data._sceneHandle = self._sharedScene.getHandle()
+        _data._sources = self._sources
+        _data._receiverLocations, _data._receiverRadii = self.receiverArrays()
+        _data._materialReflectance = self.materialReflectance()
+        if self._rayTracerParameters._enableHighFrequencyAirAbsorption:
+            _data._airAttenuation = airAttenuationCoefficients(self._rayTracerParameters._frequencyBands, self._environmentParameters._temperature,
+                                                               self._environmentParameters._humidity, self._environmentParameters._pressure)
+        if self._checkpointFilename is not None:
+            _data._checkpointFilename = self._checkpointFilename
+            _data._checkpointKey = self._checkpointKey()
+        if self._pathStoreDirectory is not None:
+            _data._pathStoreDirectory = self._pathStoreDirectory
+            _data._pathStoreKeys = [self._pathStoreKey(_source) for _source in self._sources]
+        _data._environmentParameters = self._environmentParameters
+        _data._rayTracerParameters = self._rayTracerParameters
+        return _data
+
+
+    def _divideWorkInParts(self, imageSources=True, rays=True, rayRound=0, rayRounds=1, enabledPairs=None):
+        # One chunk per (source, receiver set, angular slice), small enough
+        # that there are many more chunks than workers whatever the scene.
+        # The rays of round 'rayRound' of 'rayRounds' are those whose index
+        # modulo 'rayRounds' is the round. 'enabledPairs' (sources x
+        # receivers) restricts the receivers of every source.
+        _rayCount = rayCountForResolution(self._rayTracerParameters._angularResolution)
+        _raysPerChunk = max(1, self._rayTracerParameters._raysPerChunk)
+
+        _receiverCount = len(self.receiverArrays()[1])
+        _receiversPerChunk = self._rayTracerParameters._receiversPerChunk
+        if _receiversPerChunk <= 0:
+            _receiversPerChunk = _receiverCount
+
+        _dividedWork = []
+        for _sourceIndex in range(len(self._sources)):
+            if enabledPairs is None:
+                _receivers = range(_receiverCount)
+            else:
+                _receivers = numpy.nonzero(enabledPairs[_sourceIndex])[0]
+            _receiverSets = [_receivers[i:i + _receiversPerChunk] for i in range(0, len(_receivers), _receiversPerChunk)]
+            for _receiverSet in _receiverSets:
+                _receiverKey = checkpointKey(numpy.asarray(_receiverSet, dtype=numpy.int64))
+                # The early reflections of the pair come from image sources
+                if imageSources and self._rayTracerParameters._imageSourceOrder >= 0:
+                    _work = WorkDefinition()
+                    _work._enabledSources = [_sourceIndex]
+                    _work._enabledReceivers = _receiverSet
+                    _work._angularRange = [0, 0, 1]
+                    _work._imageSources = True
+                    _work._key = "%d|%s|image sources" % (_sourceIndex, _receiverKey)
+                    _dividedWork.append(_work)
+                if not rays:
+                    continue
+                for _start in range(rayRound, _rayCount, _raysPerChunk * rayRounds):
+                    _work = WorkDefinition()
+                    _work._enabledSources = [_sourceIndex]
+                    _work._enabledReceivers = _receiverSet
+                    _work._angularRange = [_start, min(_start + _raysPerChunk * rayRounds, _rayCount), rayRounds]
+                    _work._key = "%d|%s|rays %d:%d:%d" % (_sourceIndex, _receiverKey, _work._angularRange[0], _work._angularRange[1], _work._angularRange[2])
+                    _dividedWork.append(_work)
 
         return _dividedWork
 
 
-    def tracerEngine(self, tasks, workerId):
-        # TODO: complete this. This is the part that actually does the tracing,
-        # from a source to a receiver on a given environment
+    @staticmethod
+    def tracerEngine(tasks, workerId, rayTracerData):
+        # Traces one chunk of work, from its sources to its receivers, with
+        # the data shared by all the chunks of the run
+        _log = getLogger()
         _workerStr = "[Worker %d]:" % workerId
 
-        # print("%s > Started (PID: %d)." % (_workerStr, os.getpid()))
-        self._log.log(LogLevel.Info, "%s > Started (PID: %d)." % (_workerStr, os.getpid()))
+        _log.log(LogLevel.Info, "%s > Started (PID: %d)." % (_workerStr, os.getpid()))
 
-        rayTracerData = tasks._rayTracerData
         enabledSources = tasks._enabledSources
         enabledReceivers = tasks._enabledReceivers
         angularRange = tasks._angularRange
 
-        self._log.log(LogLevel.Info, "%s   Data: " % _workerStr + str(rayTracerData))
-        self._log.log(LogLevel.Info, "%s   Enabled sources: " % _workerStr + str(enabledSources))
-        self._log.log(LogLevel.Info, "%s   Enabled receivers: " % _workerStr + str(enabledReceivers))
-        self._log.log(LogLevel.Info, "%s   Angular range: " % _workerStr + str(angularRange))
-
+        # Read-only views of the scene published by the ray-tracer (or
+        # fetched from the broker on a node)
+        _scene = rayTracerData._sceneHandle.attach()
+
+        _log.log(LogLevel.Info, "%s   Data: " % _workerStr + str(rayTracerData))
+        _log.log(LogLevel.Info, "%s   Scene triangles: %d" % (_workerStr, len(_scene['vertices'])))
+        _log.log(LogLevel.Info, "%s   Enabled sources: " % _workerStr + str(enabledSources))
+        _log.log(LogLevel.Info, "%s   Enabled receivers: " % _workerStr + str(enabledReceivers))
+        _log.log(LogLevel.Info, "%s   Angular range: " % _workerStr + str(angularRange))
+        _log.log(LogLevel.Info, "%s   Image sources: " % _workerStr + str(tasks._imageSources))
+
+        # Only the echogram of the sources and receivers of the chunk, its
+        # receivers are those of the detector
+        _parameters = rayTracerData._rayTracerParameters
+        _receivers = numpy.asarray(enabledReceivers, dtype=numpy.int64)
         _workerResults = TracerEngineResults()
-
-        # for i in range(1000):
-        #     for j in range(2):
-        #         a = numpy.fft.fft([k for k in range(1000)])
-        #         if len(a) == 0:
-        #             print("it's zero")
-
-        _t = 10.0 * numpy.random.random()
-        # print("Waiting %.1f s" % _t)
-        # sys.stdout.flush()
-        time.sleep(_t)
-        # time.sleep(2.0)
-
-        self._log.log(LogLevel.Info, "%s < Finished (PID: %d)." % (_workerStr, os.getpid()))
+        _echogram = _workerResults.allocateBlock(enabledSources, _receivers, _parameters._frequencyBands, _parameters._echogramTimeStep,
+                                                 _parameters._echogramDuration, precisionType(_parameters._precision))
+        _blockReceivers = numpy.arange(len(_receivers))
+        _startTime = time.time()
+
+        _triangles = triangleArraysFromScene(_scene)
+        _accelerator = bvhFromArrays(_scene) if 'bvhNodeChild' in _scene else None
+        _rayCount = rayCountForResolution(_parameters._angularResolution)
+        _detector = receiverDetector(rayTracerData._receiverLocations[_receivers], rayTracerData._receiverRadii[_receivers], _parameters._receiverGridCellSize)
+        _log.log(LogLevel.Info, "%s   Receiver detection: %s" % (_workerStr, str(_detector)))
+        _soundSpeed = rayTracerData._environmentParameters._soundSpeed
+        _energyThreshold = None
+        if _parameters._energyThreshold is not None:
+            _energyThreshold = 10.0 ** (-_parameters._energyThreshold / 10.0)
+
+        # Exact early reflections, from the image sources of every enabled source
+        if tasks._imageSources:
+            _planes = scenePlanes(_triangles, rayTracerData._sceneHandle.key(), _triangles._v0.dtype)
+            for _blockSource, _sourceIndex in enumerate(enabledSources):
+                _tree = imageSourceTree(_planes, rayTracerData._sources[_sourceIndex]._location, _parameters._imageSourceOrder, rayTracerData._sceneHandle.key())
+                _pathReceivers, _pathLengths, _pathFaces, _pathEmissions = _tree.findPaths(rayTracerData._receiverLocations[_receivers], _triangles, _accelerator)
+                _pathEnergies = imageSourceEnergies(_pathFaces, _pathLengths, len(_parameters._frequencyBands), _scene['materialIds'],
+                                                    rayTracerData._materialReflectance, rayTracerData._airAttenuation)
+                _pathEnergies *= rayTracerData._sources[_sourceIndex]._directivity.weights(_pathEmissions)
+                recordImageSourcePaths(_echogram, _blockSource, _blockReceivers, rayTracerData._receiverRadii[_receivers], _pathReceivers, _pathLengths, _pathEnergies,
+                                       _soundSpeed, _parameters._echogramTimeStep)
+                _workerResults._imageSources += len(_tree)
+                _workerResults._imageSourcePaths += len(_pathReceivers)
+
+        # Trace the rays of the angular range in packets, from every enabled source
+        for _blockSource, _sourceIndex in enumerate(enabledSources):
+            _location = numpy.array(rayTracerData._sources[_sourceIndex]._location, dtype=float)
+            _directivity = rayTracerData._sources[_sourceIndex]._directivity
+            _sampled = _parameters._directivityImportanceSampling and not _directivity._type == DirectivityType.Omni
+            _rayIndices = numpy.arange(*angularRange)
+            if len(_rayIndices) == 0:
+                continue
+            _recorder = EchogramRecorder(_echogram, _blockSource, _blockReceivers, _detector, _soundSpeed, _parameters._echogramTimeStep,
+                                         firstBounce=_parameters._imageSourceOrder + 1, airAttenuation=rayTracerData._airAttenuation)
+
+            # Rays already in the path store (or claimed by a worker tracing
+            # them for other receivers) are only detected again, new ones
+            # have their segments stored as they are traced
+            _pathStore = None
+            if rayTracerData._pathStoreDirectory is not None:
+                _pathStore = PathStore(rayTracerData._pathStoreDirectory, rayTracerData._pathStoreKeys[_sourceIndex])
+                if not _pathStore.claim(angularRange):
+                    _workerResults._segmentsReplayed += replaySegments(_pathStore.load(angularRange), _recorder, _recorder._firstBounce)
+                    continue
+                _recorder = SegmentRecorder(_recorder._firstBounce, _soundSpeed * _parameters._echogramDuration, _recorder)
+
+            try:
+                for _packetStart in range(0, len(_rayIndices), _parameters._raysPerPacket):
+                    _packetIndices = _rayIndices[_packetStart:_packetStart + _parameters._raysPerPacket]
+                    # Every source emits a unit of energy per band (times its
+                    # directivity gains), shared by its rays
+                    if _sampled:
+                        _directions, _weights = _directivity.sampleDirections(*fibonacciLattice(_rayCount, _packetIndices))
+                    else:
+                        _directions = sphereDirections(_rayCount, indices=_packetIndices)
+                        _weights = _directivity.weights(_directions)
+                    _origins = numpy.broadcast_to(_location, _directions.shape)
+                    _energies = numpy.empty((len(_directions), len(_parameters._frequencyBands)))
+                    _energies[...] = _weights / _rayCount
+                    traceRayPacket(_origins, _directions, _triangles, _parameters._maxBouncesPerRay, results=_workerResults, onSegment=_recorder, accelerator=_accelerator,
+                                   energies=_energies, materialIds=_scene['materialIds'], materialReflectance=rayTracerData._materialReflectance,
+                                   energyThreshold=_energyThreshold, rouletteSurvival=_parameters._rouletteSurvival, airAttenuation=rayTracerData._airAttenuation,
+                                   rayIndices=_packetIndices, seed=_sourceIndex)
+                if _pathStore is not None:
+                    _pathStore.save(angularRange, _recorder.segments())
+            finally:
+                if _pathStore is not None:
+                    _pathStore.release(angularRange)
+
+        _workerResults._tracingTime = time.time() - _startTime
+        if rayTracerData._checkpointFilename is not None:
+            TracingCheckpoint(rayTracerData._checkpointFilename, rayTracerData._checkpointKey).record(tasks._key, _workerResults,
+                                                                                                     (len(rayTracerData._sources), len(rayTracerData._receiverLocations)))
+        _log.log(LogLevel.Info, "%s   Traced %s." % (_workerStr, str(_workerResults)))
+        _log.log(LogLevel.Info, "%s < Finished (PID: %d)." % (_workerStr, os.getpid()))
         return _workerResults
 
@@ -1,13 +1,56 @@
+import numpy
+
+
 class ReceiverDefinition:
     def __init__(self):
         self._type = ReceiverType.Point
         self._location = [0.0, 0.0, 0.0]
+        self._radius = 0.5
+
+
+# Many point receivers sharing a detection radius, e.g. the points of a
+# listener plane. Their locations are kept as one (R, 3) array.
+class ReceiverArrayDefinition:
+    def __init__(self, locations=None, radius=0.5):
+        self._type = ReceiverType.Point
+        self._locations = numpy.zeros((0, 3)) if locations is None else numpy.array(locations, dtype=float).reshape(-1, 3)
+        self._radius = radius
+
+    def __len__(self):
+        return len(self._locations)
+
+
+def receiverArrays(receivers):
+    # Locations (R, 3) and radii (R,) of all the points of a list of
+    # ReceiverDefinition and ReceiverArrayDefinition, in order
+    _locations = [numpy.zeros((0, 3))]
+    _radii = [numpy.zeros(0)]
+    for _receiver in receivers:
+        if isinstance(_receiver, ReceiverArrayDefinition):
+            _locations.append(_receiver._locations)
+            _radii.append(numpy.full(len(_receiver), float(_receiver._radius)))
+        else:
+            _locations.append(numpy.array(_receiver._location, dtype=float).reshape(1, 3))
+            _radii.append(numpy.array([float(_receiver._radius)]))
+    return numpy.concatenate(_locations), numpy.concatenate(_radii)
+
+
+def listenerPlaneReceivers(minimum, maximum, height, spacing, radius=0.5):
+    # Receivers on a regular grid over the horizontal rectangle between the
+    # (x, y) corners 'minimum' and 'maximum', at the given height
+    _x = numpy.arange(minimum[0], maximum[0] + 0.5 * spacing, spacing)
+    _y = numpy.arange(minimum[1], maximum[1] + 0.5 * spacing, spacing)
+    _xs, _ys = numpy.meshgrid(_x, _y, indexing='ij')
+    _locations = numpy.stack([_xs.ravel(), _ys.ravel(), numpy.full(_xs.size, float(height))], axis=1)
+    return ReceiverArrayDefinition(_locations, radius)
 
 
 class EnvironmentParameters:
     def __init__(self):
         self._soundSpeed = 343.0
         self._temperature = 20.0
+        self._humidity = 50.0
+        self._pressure = 101.325
 
 
 class SourceDefinition:
@@ -19,6 +62,8 @@ class SourceDefinition:
 
 class DirectivityType:
     Omni = 0
+    # Gains interpolated from a balloon table, see Directivity.setBalloon
+    Balloon = 1
 
 
 class Directivity:
@@ -27,19 +72,112 @@ class Directivity:
             self._type = DirectivityType.Omni
         else:
             self._type = type
+        # Balloon grid: elevations (E,) and azimuths (A,) in degrees and
+        # energy gains (E, A, bands)
+        self._elevations = None
+        self._azimuths = None
+        self._gains = None
+        self._sampling = None
+
+    def setBalloon(self, elevations, azimuths, levels):
+        # Levels in dB at every point of the grid, (E, A) for all bands or
+        # (E, A, bands). Elevations go from -90 (down, -z) to 90 (up, +z) and
+        # azimuths from 0 (+x) towards 90 (+y), both in increasing order.
+        _elevations = numpy.asarray(elevations, dtype=float).reshape(-1)
+        _azimuths = numpy.asarray(azimuths, dtype=float).reshape(-1)
+        _levels = numpy.asarray(levels, dtype=float)
+        if _levels.ndim == 2:
+            _levels = _levels[:, :, None]
+        if len(_elevations) < 2 or len(_azimuths) < 1 or not _levels.shape[:2] == (len(_elevations), len(_azimuths)):
+            raise Exception("A directivity balloon needs levels for every elevation (at least two) and azimuth of its grid!")
+        if numpy.any(numpy.diff(_elevations) <= 0.0) or _elevations[0] < -90.0 or _elevations[-1] > 90.0:
+            raise Exception("The elevations of a directivity balloon must increase within -90 and 90 degrees!")
+        if numpy.any(numpy.diff(_azimuths) <= 0.0) or _azimuths[-1] - _azimuths[0] >= 360.0:
+            raise Exception("The azimuths of a directivity balloon must increase within one turn!")
+        self._type = DirectivityType.Balloon
+        self._elevations = _elevations
+        self._azimuths = _azimuths
+        self._gains = 10.0 ** (_levels / 10.0)
+        self._sampling = None
 
-    def __call__(self, *args, **kwargs):
-        if not len(args) == 2:
-            raise Exception("The directivity class must be called with two arguments (the elevation and azimuth).")
+    def bands(self):
+        # Number of bands of the gains, 1 when they are the same for all
+        return 1 if self._gains is None else self._gains.shape[2]
 
+    def __call__(self, elevation, azimuth):
+        # Energy gains for arrays of elevations and azimuths (degrees), with
+        # the shape of the angles plus one axis for the bands
+        _elevation, _azimuth = numpy.broadcast_arrays(numpy.asarray(elevation, dtype=float), numpy.asarray(azimuth, dtype=float))
         if self._type == DirectivityType.Omni:
-            return 1.0
-        else:
-            _elevation = float(args[0])
-            _azimuth = float(args[1])
-            _directivity = 1.0
-            print("The directivity for elevation: %.10f and azimuth %.10f is %.10f." % (_elevation, _azimuth, _directivity))
-            return _directivity
+            return numpy.ones(_elevation.shape + (1,))
+        if not self._type == DirectivityType.Balloon or self._gains is None:
+            raise Exception("Unknown directivity type or balloon not set!")
+
+        # Bilinear between the grid points, clamped in elevation and periodic in azimuth
+        _elevations = self._elevations
+        _azimuths = numpy.append(self._azimuths, self._azimuths[0] + 360.0)
+        _e = numpy.clip(_elevation, _elevations[0], _elevations[-1])
+        _i = numpy.clip(numpy.searchsorted(_elevations, _e, side='right') - 1, 0, len(_elevations) - 2)
+        _fe = ((_e - _elevations[_i]) / (_elevations[_i + 1] - _elevations[_i]))[..., None]
+        _a = numpy.mod(_azimuth - _azimuths[0], 360.0) + _azimuths[0]
+        _j = numpy.clip(numpy.searchsorted(_azimuths, _a, side='right') - 1, 0, len(_azimuths) - 2)
+        _fa = ((_a - _azimuths[_j]) / (_azimuths[_j + 1] - _azimuths[_j]))[..., None]
+        _k = numpy.mod(_j + 1, len(self._azimuths))
+        return ((1.0 - _fe) * ((1.0 - _fa) * self._gains[_i, _j] + _fa * self._gains[_i, _k]) +
+                _fe * ((1.0 - _fa) * self._gains[_i + 1, _j] + _fa * self._gains[_i + 1, _k]))
+
+    def weights(self, directions):
+        # Energy gains (N, bands) of unit directions (N, 3)
+        _directions = numpy.asarray(directions, dtype=float).reshape(-1, 3)
+        if self._type == DirectivityType.Omni:
+            return numpy.ones((len(_directions), 1))
+        _elevation = numpy.degrees(numpy.arcsin(numpy.clip(_directions[:, 2], -1.0, 1.0)))
+        _azimuth = numpy.degrees(numpy.arctan2(_directions[:, 1], _directions[:, 0]))
+        return self(_elevation, _azimuth)
+
+    def _samplingTable(self):
+        # Cells between the grid lines (plus the caps up to the poles) with
+        # the mean gain of their corners, and the cumulative weights (gain x
+        # solid angle) of the rows and of the cells along every row
+        _edgesE = numpy.unique(numpy.concatenate([[-90.0], self._elevations, [90.0]]))
+        _edgesA = numpy.append(self._azimuths, self._azimuths[0] + 360.0)
+        _corners = self(_edgesE[:, None], _edgesA[None, :]).mean(axis=2)
+        _cellGains = 0.25 * (_corners[:-1, :-1] + _corners[1:, :-1] + _corners[:-1, 1:] + _corners[1:, 1:])
+        _heights = numpy.sin(numpy.radians(_edgesE))
+        _cellWeights = _cellGains * numpy.diff(_heights)[:, None] * numpy.radians(numpy.diff(_edgesA))[None, :]
+        _rowCdf = numpy.concatenate([[0.0], numpy.cumsum(_cellWeights.sum(axis=1))])
+        _cellCdf = numpy.concatenate([numpy.zeros((len(_cellWeights), 1)), numpy.cumsum(_cellWeights, axis=1)], axis=1)
+        if not _rowCdf[-1] > 0.0:
+            raise Exception("A directivity balloon cannot be sampled if all its gains are zero!")
+        return _heights, _edgesA, _cellGains, _rowCdf, _cellCdf
+
+    def sampleDirections(self, u, v):
+        # Unit directions with a density proportional to the gain (mean of
+        # the bands) for points (u, v) of the unit square, and their weights
+        # gain / (4 pi density): energies scaled by them keep the estimate of
+        # uniform emission. The square is split into the rows of the table by
+        # u and into the cells of the row by v, so its stratification is kept.
+        if self._sampling is None:
+            self._sampling = self._samplingTable()
+        _heights, _edgesA, _cellGains, _rowCdf, _cellCdf = self._sampling
+        _rows = numpy.diff(_rowCdf)
+        _u = numpy.asarray(u, dtype=float) * _rowCdf[-1]
+        _row = numpy.clip(numpy.searchsorted(_rowCdf, _u, side='right') - 1, 0, numpy.nonzero(_rows > 0.0)[0][-1])
+        _fu = numpy.clip((_u - _rowCdf[_row]) / _rows[_row], 0.0, 1.0)
+        _v = numpy.asarray(v, dtype=float) * _rows[_row]
+        _rowCells = _cellCdf[_row]
+        _cells = numpy.diff(_rowCells, axis=1)
+        _lastCell = _cells.shape[1] - 1 - numpy.argmax((_cells > 0.0)[:, ::-1], axis=1)
+        _cell = numpy.minimum(numpy.count_nonzero(_rowCells[:, 1:] <= _v[:, None], axis=1), _lastCell)
+        _fv = numpy.clip((_v - _rowCells[numpy.arange(len(_v)), _cell]) / _cells[numpy.arange(len(_v)), _cell], 0.0, 1.0)
+
+        # Uniform in solid angle within the cell
+        _z = _heights[_row] + _fu * (_heights[_row + 1] - _heights[_row])
+        _phi = numpy.radians(_edgesA[_cell] + _fv * (_edgesA[_cell + 1] - _edgesA[_cell]))
+        _radius = numpy.sqrt(numpy.maximum(0.0, 1.0 - _z * _z))
+        _directions = numpy.column_stack([_radius * numpy.cos(_phi), _radius * numpy.sin(_phi), _z])
+        _density = _cellGains[_row, _cell] / _rowCdf[-1]
+        return _directions, self.weights(_directions) / (4.0 * numpy.pi * _density[:, None])
 
 
 class SourceType:
@@ -57,16 +195,177 @@ class RayTracerParameters:
         self._cornerScattering = False
         self._parallelThreads = 4
         self._enableHighFrequencyAirAbsorption = True
+        self._raysPerPacket = 4096
+        self._raysPerChunk = 4096
+        self._receiversPerChunk = 0
+        self._useAccelerationStructure = True
+        self._frequencyBands = [125.0, 250.0, 500.0, 1000.0, 2000.0, 4000.0]
+        self._echogramTimeStep = 0.001
+        self._echogramDuration = 1.0
+        # Cell size of the receiver grid, 0 for twice the largest receiver radius
+        self._receiverGridCellSize = 0.0
+        # Reflection orders up to this one come from image sources, the rays
+        # only add the later ones; -1 for rays only. The images grow with the
+        # power of this order of the number of planes, so keep it low (1-3)
+        # and only use it on models with few planes.
+        self._imageSourceOrder = -1
+        # Absorption of the materials without a spectrum set in the ray-tracer
+        self._defaultAbsorption = 0.1
+        # Rays this many dB below their initial energy play Russian roulette,
+        # surviving with the given probability (0 drops them, None disables it)
+        self._energyThreshold = 60.0
+        self._rouletteSurvival = 0.1
+        # Progressive tracing: number of rounds, largest change of the decay
+        # curves (dB) between rounds for a pair to be converged, and range of
+        # the decay curves (dB) that is compared
+        self._progressiveRounds = 8
+        self._convergenceTolerance = 0.5
+        self._convergenceRange = 30.0
+        # Rays of sources with a directivity balloon are emitted more densely
+        # where it is louder, instead of evenly with weighted energies
+        self._directivityImportanceSampling = False
+        # Floating point type of the scene arrays, ray packets and echograms,
+        # 'float64' or 'float32' (half the memory and bandwidth)
+        self._precision = 'float64'
 
 
 class TracerEngineResults:
     def __init__(self):
-        pass
+        self._raysTraced = 0
+        self._segmentsTraced = 0
+        self._intersectionTests = 0
+        self._raysTerminated = 0
+        self._imageSources = 0
+        self._imageSourcePaths = 0
+        self._tracingTime = 0.0
+        self._segmentsReplayed = 0
+        self._frequencyBands = []
+        self._echogramTimeStep = 0.0
+        # Energy per (source, receiver, frequency band, time bin)
+        self._echogram = None
+        # Parts of the echogram kept apart until there is a full one to add
+        # them to: (source indices, receiver indices, energies) by indices
+        self._blocks = {}
+
+    def allocateEchogram(self, sources, receivers, frequencyBands, timeStep, duration, dtype=numpy.float64):
+        self._frequencyBands = list(frequencyBands)
+        self._echogramTimeStep = timeStep
+        _bins = max(1, int(numpy.ceil(duration / timeStep)))
+        self._echogram = numpy.zeros((sources, receivers, len(self._frequencyBands), _bins), dtype=dtype)
+
+    def allocateBlock(self, sources, receivers, frequencyBands, timeStep, duration, dtype=numpy.float64):
+        # Echogram of only the given source and receiver indices, e.g. those
+        # of a chunk of work; returns it
+        self._frequencyBands = list(frequencyBands)
+        self._echogramTimeStep = timeStep
+        _bins = max(1, int(numpy.ceil(duration / timeStep)))
+        _sources = numpy.asarray(sources, dtype=numpy.int64)
+        _receivers = numpy.asarray(receivers, dtype=numpy.int64)
+        _key = (_sources.tobytes(), _receivers.tobytes())
+        if not _key in self._blocks:
+            self._blocks[_key] = (_sources, _receivers, numpy.zeros((len(_sources), len(_receivers), len(self._frequencyBands), _bins), dtype=dtype))
+        return self._blocks[_key][2]
+
+    def add(self, other):
+        # Accumulates the counters and echograms of another result into this one
+        self._raysTraced += other._raysTraced
+        self._segmentsTraced += other._segmentsTraced
+        self._intersectionTests += other._intersectionTests
+        self._raysTerminated += other._raysTerminated
+        self._imageSources += other._imageSources
+        self._imageSourcePaths += other._imageSourcePaths
+        self._tracingTime += other._tracingTime
+        self._segmentsReplayed += other._segmentsReplayed
+        if self._echogram is None and len(self._blocks) == 0:
+            self._frequencyBands = other._frequencyBands
+            self._echogramTimeStep = other._echogramTimeStep
+        # Arrays taken from the other result are copied, so adding to them
+        # later does not change it
+        if self._echogram is None:
+            self._echogram = None if other._echogram is None else other._echogram.copy()
+        elif other._echogram is not None:
+            self._echogram += other._echogram
+
+        # Blocks of the same indices are summed, all go into the full
+        # echogram once there is one
+        for _key, (_sources, _receivers, _block) in other._blocks.items():
+            if _key in self._blocks:
+                self._blocks[_key][2][...] += _block
+            else:
+                self._blocks[_key] = (_sources, _receivers, _block.copy())
+        if self._echogram is not None:
+            for _sources, _receivers, _block in self._blocks.values():
+                self._echogram[numpy.ix_(_sources, _receivers)] += _block
+            self._blocks = {}
+        return self
 
+    def timeAxis(self):
+        return numpy.arange(self._echogram.shape[-1]) * self._echogramTimeStep
 
+    def select(self, sources, receivers):
+        # Results of the given sources and receivers only (indices); the
+        # counters are those of the whole run
+        _selected = TracerEngineResults().add(self)
+        _selected._echogram = self._echogram[numpy.ix_(numpy.asarray(sources, dtype=numpy.int64), numpy.asarray(receivers, dtype=numpy.int64))]
+        return _selected
+
+    def __str__(self):
+        _text = "%d ray(s) (%d terminated), %d segment(s), %d intersection test(s), %d image source path(s), %d stored segment(s) replayed in %.3f s" % (self._raysTraced, self._raysTerminated, self._segmentsTraced, self._intersectionTests, self._imageSourcePaths, self._segmentsReplayed, self._tracingTime)
+        if self._echogram is not None:
+            _text += ", echogram %s with total energy %.6g" % ("x".join(str(n) for n in self._echogram.shape), self._echogram.sum())
+        elif len(self._blocks) > 0:
+            _text += ", %d echogram block(s) of %d pair(s) with total energy %.6g" % (len(self._blocks), sum([len(_sources) * len(_receivers) for _sources, _receivers, _ in self._blocks.values()]),
+                                                                                   sum([_block.sum() for _, _, _block in self._blocks.values()]))
+        return _text
+
+
+# Partial results of a progressive tracing, after 'round' of 'rounds' rounds.
+# '_change' and '_converged' are (sources x receivers) arrays.
+class ProgressiveTracingResults:
+    def __init__(self):
+        self._results = None
+        self._round = 0
+        self._rounds = 0
+        self._change = None
+        self._converged = None
+
+    def __str__(self):
+        return "Round %d of %d, %d of %d pair(s) converged: %s" % (self._round, self._rounds, numpy.count_nonzero(self._converged), self._converged.size, str(self._results))
+
+
+# The part of the ray-tracer a worker needs: the scene travels as a handle to
+# shared memory and the definitions are small, so this pickles cheaply. All
+# receivers, single or in arrays, are flattened into one location array and
+# one radius array.
+class RayTracerData:
+    def __init__(self):
+        self._sceneHandle = None
+        self._sources = []
+        self._receiverLocations = numpy.zeros((0, 3))
+        self._receiverRadii = numpy.zeros(0)
+        # Reflectance (1 - absorption) per material and band, the last row for
+        # faces without material, and the air attenuation per metre and band
+        self._materialReflectance = numpy.ones((1, 1))
+        self._airAttenuation = None
+        self._checkpointFilename = None
+        self._checkpointKey = None
+        # Path store, with the key of every source
+        self._pathStoreDirectory = None
+        self._pathStoreKeys = []
+        self._environmentParameters = None
+        self._rayTracerParameters = None
+
+    def __str__(self):
+        return "%s, %d source(s), %d receiver(s)" % (str(self._sceneHandle), len(self._sources), len(self._receiverLocations))
+
+
+# One chunk of work: only indices, so the work queue stays light. The
+# RayTracerData of the run goes to every worker once, next to the queue.
 class WorkDefinition():
-    def __init__(self, rayTracerData):
-        self._rayTracerData = rayTracerData
+    def __init__(self):
         self._enabledSources = []
         self._enabledReceivers = []
         self._angularRange = []
+        self._imageSources = False
+        # Identifies the chunk within its run, for checkpoints
+        self._key = None
@@ -0,0 +1,293 @@
+'''
+    This module implements the packet tracer used by the workers of the
+    ray-tracer: packets of thousands of rays are emitted from a source and
+    followed through specular reflections, one numpy call per packet and
+    bounce instead of one Python iteration per ray.
+
+    Rays are emitted along the points of a Fibonacci sphere: every direction
+    stands for the same solid angle and they cover the sphere evenly. Ray i
+    of a set of N only depends on i and N, so any slice of the set can be
+    generated on its own and a run traces the same rays whichever way its
+    rays are split among chunks and workers.
+
+    The segments of the packet are handed to an "EchogramRecorder", which
+    detects the spherical receivers they pass through (see receiver_grid)
+    and adds the energy of those rays to preallocated energy-vs-time
+    histograms. The reflections found by the image-source method (see
+    image_source) are added to the same histograms.
+
+    Rays carry their energy in every frequency band at once, so the bands
+    are traced in a single pass: at every bounce the energies of the packet
+    are multiplied by the reflectance of the materials hit, and the air
+    attenuation is applied on detection from the total distance travelled.
+
+    Rays whose energy falls a given number of decibels below their initial
+    energy play Russian roulette at every bounce: they survive with a fixed
+    probability, carrying their energy divided by it, or are dropped. The
+    packet is compacted after every bounce, so dead rays cost nothing. The
+    random draws only depend on the source, the ray index and the bounce.
+
+    Joe Simon 2018.
+'''
+
+
+import numpy as np
+from ray_intersection import *
+from receiver_grid import *
+
+
+def rayCountForResolution(angularResolution):
+    # Number of rays whose solid angle is that of a square of the given side (degrees)
+    _side = np.radians(angularResolution)
+    return max(1, int(round(4.0 * np.pi / (_side * _side))))
+
+
+# 1 / golden ratio, the fraction of a turn between consecutive rays
+GOLDEN_RATIO_CONJUGATE = (np.sqrt(5.0) - 1.0) / 2.0
+
+
+def fibonacciLattice(count, indices):
+    # Points (u, v) of the unit square for the given indices of a Fibonacci
+    # lattice of 'count' points, the layout of the Fibonacci sphere
+    _indices = np.asarray(indices, dtype=np.int64)
+    return (_indices + 0.5) / count, np.mod(_indices * GOLDEN_RATIO_CONJUGATE, 1.0)
+
+
+def sphereDirections(count, start=0, stop=None, indices=None):
+    # Unit directions start..stop-1 (or the given indices) of a Fibonacci
+    # sphere of 'count' points: equally spaced in height (hence in area) and
+    # turning by the golden angle. Every n-th point also covers the sphere
+    # evenly, which progressive tracing relies on.
+    if stop is None:
+        stop = count
+    _indices = np.arange(start, stop, dtype=np.int64) if indices is None else np.asarray(indices, dtype=np.int64)
+    _u, _v = fibonacciLattice(count, _indices)
+    _z = 1.0 - 2.0 * _u
+    _radius = np.sqrt(np.maximum(0.0, 1.0 - _z * _z))
+    _phi = 2.0 * np.pi * _v
+    _directions = np.empty((len(_indices), 3))
+    _directions[:, 0] = _radius * np.cos(_phi)
+    _directions[:, 1] = _radius * np.sin(_phi)
+    _directions[:, 2] = _z
+    return _directions
+
+
+# Energy attenuation of air (ISO 9613-1), at the reference pressure in kPa
+REFERENCE_PRESSURE = 101.325
+REFERENCE_TEMPERATURE = 293.15
+TRIPLE_POINT_TEMPERATURE = 273.16
+
+
+def airAttenuationCoefficients(frequencies, temperature, humidity, pressure=REFERENCE_PRESSURE):
+    # Energy attenuation per metre in every band, for a temperature in
+    # Celsius and a relative humidity in percent: energy * exp(-m * distance)
+    _frequencies = np.asarray(frequencies, dtype=float)
+    _temperature = temperature + 273.15
+    _pressure = pressure / REFERENCE_PRESSURE
+    _relative = _temperature / REFERENCE_TEMPERATURE
+    _saturation = 10.0 ** (-6.8346 * (TRIPLE_POINT_TEMPERATURE / _temperature) ** 1.261 + 4.6151)
+    _h = humidity * _saturation / _pressure
+    _oxygen = _pressure * (24.0 + 4.04e4 * _h * (0.02 + _h) / (0.391 + _h))
+    _nitrogen = _pressure * _relative ** -0.5 * (9.0 + 280.0 * _h * np.exp(-4.170 * (_relative ** (-1.0 / 3.0) - 1.0)))
+    _f2 = _frequencies * _frequencies
+    _decibels = 8.686 * _f2 * (1.84e-11 / _pressure * _relative ** 0.5
+                               + _relative ** -2.5 * (0.01275 * np.exp(-2239.1 / _temperature) / (_oxygen + _f2 / _oxygen)
+                                                      + 0.1068 * np.exp(-3352.0 / _temperature) / (_nitrogen + _f2 / _nitrogen)))
+    return _decibels / (10.0 * np.log10(np.e))
+
+
+def rouletteUniforms(rayIndices, bounce, seed=0):
+    # Uniform numbers in [0, 1) from a hash (splitmix64) of the ray index,
+    # the bounce and the seed, the same whichever packet the ray is in
+    _x = np.asarray(rayIndices, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    _x ^= np.uint64((int(bounce) * 0xBF58476D1CE4E5B9 + int(seed) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF)
+    _x ^= _x >> np.uint64(30)
+    _x *= np.uint64(0xBF58476D1CE4E5B9)
+    _x ^= _x >> np.uint64(27)
+    _x *= np.uint64(0x94D049BB133111EB)
+    _x ^= _x >> np.uint64(31)
+    return (_x >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def traceRayPacket(origins, directions, triangles, maxBounces, results=None, onSegment=None, accelerator=None,
+                   energies=None, materialIds=None, materialReflectance=None,
+                   energyThreshold=None, rouletteSurvival=0.0, airAttenuation=None, rayIndices=None, seed=0):
+    # Follows every ray of the packet through up to 'maxBounces' specular
+    # reflections. Each traced segment is reported through
+    # onSegment(bounce, rayIds, starts, directions, lengths, pathLengths, faces, energies),
+    # where 'pathLengths' is the distance travelled before the segment and
+    # 'energies' the energy per band the ray starts it with. Rays that
+    # escape the geometry are reported once more with an infinite length
+    # and face -1, and then dropped from the packet. At every bounce the
+    # energies (rays x bands, one band of ones by default) are multiplied
+    # by 'materialReflectance[materialIds[face]]'; the last row of the
+    # reflectance applies to faces without material (-1). With an
+    # 'energyThreshold' (a fraction of the initial energy, taking the loudest
+    # band and the air attenuation per metre 'airAttenuation' into account)
+    # rays below it play Russian roulette with 'rouletteSurvival', drawn
+    # from the global 'rayIndices' of the rays and 'seed'; a survival of 0
+    # simply drops them. Counters are added to 'results' (a
+    # TracerEngineResults) when given. With an 'accelerator' (BVH) only the
+    # faces in the visited leaves are tested. The packet (origins, directions
+    # and energies) is kept in the precision of the triangle arrays, the
+    # distances travelled in float64.
+    if results is not None:
+        results._raysTraced += len(origins)
+
+    _dtype = triangles._v0.dtype
+    _origins = np.array(origins, dtype=_dtype)
+    _directions = np.array(directions, dtype=_dtype)
+    _rayIds = np.arange(len(_origins))
+    _pathLengths = np.zeros(len(_origins))
+    _lastFaces = np.full(len(_origins), -1, dtype=np.int64)
+    _energies = np.ones((len(_origins), 1), dtype=_dtype) if energies is None else np.array(energies, dtype=_dtype)
+    _rayIndices = np.arange(len(_origins)) if rayIndices is None else np.asarray(rayIndices)
+    _initialEnergies = _energies.max(axis=1)
+
+    for _bounce in range(maxBounces + 1):
+        if len(_rayIds) == 0:
+            break
+
+        if accelerator is None:
+            _t, _faces, _, _ = intersectRays(_origins, _directions, triangles, ignoreFaces=_lastFaces)
+            _tests = len(_rayIds) * len(triangles)
+        else:
+            _testsBefore = accelerator._testsPerformed
+            _t, _faces, _, _ = accelerator.intersectClosest(_origins, _directions, triangles, ignoreFaces=_lastFaces)
+            _tests = accelerator._testsPerformed - _testsBefore
+        if results is not None:
+            results._intersectionTests += _tests
+
+        if onSegment is not None:
+            onSegment(_bounce, _rayIds, _origins, _directions, _t, _pathLengths, _faces, _energies)
+
+        _hit = _faces >= 0
+        _rayIds = _rayIds[_hit]
+        _origins = _origins[_hit]
+        _directions = _directions[_hit]
+        _pathLengths = _pathLengths[_hit]
+        _t = _t[_hit]
+        _faces = _faces[_hit]
+        _energies = _energies[_hit]
+        if results is not None:
+            results._segmentsTraced += len(_rayIds)
+
+        if materialReflectance is not None:
+            _energies *= materialReflectance[materialIds[_faces]]
+
+        if energyThreshold is not None and _bounce < maxBounces:
+            _levels = _energies
+            if airAttenuation is not None:
+                _levels = _energies * np.exp(-(_pathLengths + _t)[:, None] * airAttenuation[None, :])
+            _low = _levels.max(axis=1) < energyThreshold * _initialEnergies[_rayIds]
+            _survivors = _low & (rouletteUniforms(_rayIndices[_rayIds], _bounce, seed) < rouletteSurvival)
+            _energies[_survivors] /= rouletteSurvival
+            _alive = ~_low | _survivors
+            if results is not None:
+                results._raysTerminated += int(np.count_nonzero(~_alive))
+            _rayIds = _rayIds[_alive]
+            _origins = _origins[_alive]
+            _directions = _directions[_alive]
+            _pathLengths = _pathLengths[_alive]
+            _t = _t[_alive]
+            _faces = _faces[_alive]
+            _energies = _energies[_alive]
+
+        # Move to the hit points and reflect
+        _origins = _origins + _t[:, None] * _directions
+        _directions = reflectDirections(_directions, triangles._normals[_faces])
+        _pathLengths = _pathLengths + _t
+        _lastFaces = _faces
+
+    return results
+
+
+class EchogramRecorder:
+    # Segment callback for traceRayPacket that adds the energy of the rays
+    # crossing the receivers of 'detector' to 'echogram[sourceIndex]'
+    # (receivers x bands x time bins), where detector receiver i is echogram
+    # receiver receiverIndices[i]. A crossing counts in proportion to its
+    # chord over the mean chord of the sphere (4/3 of the radius), so the
+    # expected count is the same for every receiver size. 'airAttenuation'
+    # holds the attenuation per metre of every band. Segments before
+    # 'firstBounce' reflections are left to the image sources.
+    def __init__(self, echogram, sourceIndex, receiverIndices, detector, soundSpeed, timeStep, firstBounce=0, airAttenuation=None):
+        self._echogram = echogram[sourceIndex]
+        self._firstBounce = firstBounce
+        self._receiverIndices = np.asarray(receiverIndices, dtype=np.int64)
+        self._detector = detector
+        self._airAttenuation = airAttenuation
+        self._soundSpeed = soundSpeed
+        self._timeStep = timeStep
+        self._detections = 0
+
+    def __call__(self, bounce, rayIds, starts, directions, lengths, pathLengths, faces, energies):
+        if bounce < self._firstBounce:
+            return
+        _segments, _receivers, _along, _chords = self._detector.detect(starts, directions, lengths)
+        _distances = pathLengths[_segments] + _along
+        _bins = (_distances / (self._soundSpeed * self._timeStep)).astype(np.int64)
+        _kept = _bins < self._echogram.shape[-1]
+        _segments, _receivers, _bins, _chords, _distances = _segments[_kept], _receivers[_kept], _bins[_kept], _chords[_kept], _distances[_kept]
+        _weights = energies[_segments] * (_chords / (4.0 / 3.0 * self._detector._radii[_receivers]))[:, None]
+        if self._airAttenuation is not None:
+            _weights *= np.exp(-_distances[:, None] * self._airAttenuation[None, :])
+        _bands = np.arange(self._echogram.shape[1])
+        np.add.at(self._echogram, (self._receiverIndices[_receivers][:, None], _bands[None, :], _bins[:, None]), _weights)
+        self._detections += len(_segments)
+
+
+def recordImageSourcePaths(echogram, sourceIndex, receiverIndices, receiverRadii, pathReceivers, pathLengths, pathEnergies, soundSpeed, timeStep):
+    # Adds image-source paths to 'echogram[sourceIndex]'. 'pathEnergies' holds
+    # the energy per band leaving the source along every path; the receiver
+    # gets the share of it crossing its section, as the rays would on average;
+    # paths shorter than its radius (e.g. the source inside it) count as that long.
+    _echogram = echogram[sourceIndex]
+    _bins = (pathLengths / (soundSpeed * timeStep)).astype(np.int64)
+    _kept = _bins < _echogram.shape[-1]
+    _receivers, _lengths, _bins = pathReceivers[_kept], pathLengths[_kept], _bins[_kept]
+    _radii = np.asarray(receiverRadii, dtype=float)[_receivers]
+    _lengths = np.maximum(_lengths, _radii)
+    _section = _radii ** 2 / (4.0 * _lengths * _lengths)
+    _weights = pathEnergies[_kept] * _section[:, None]
+    _bands = np.arange(_echogram.shape[1])
+    np.add.at(_echogram, (np.asarray(receiverIndices, dtype=np.int64)[_receivers][:, None], _bands[None, :], _bins[:, None]), _weights)
+
+
+def imageSourceEnergies(pathFaces, pathLengths, bands, materialIds=None, materialReflectance=None, airAttenuation=None):
+    # Energy per band left after the reflections (faces padded with -1) and
+    # the air of every image-source path, for a unit of emitted energy
+    _energies = np.ones((len(pathFaces), bands))
+    if materialReflectance is not None:
+        for _order in range(pathFaces.shape[1]):
+            _reflected = pathFaces[:, _order] >= 0
+            _energies[_reflected] *= materialReflectance[materialIds[pathFaces[_reflected, _order]]]
+    if airAttenuation is not None:
+        _energies *= np.exp(-pathLengths[:, None] * airAttenuation[None, :])
+    return _energies
+
+
+def decayCurves(echogram, decayRange=None):
+    # Schroeder backward integrals of the echograms (... x time bins), in dB
+    # relative to the total energy. With 'decayRange', bins more than that
+    # many dB down are set to NaN.
+    _remaining = np.cumsum(echogram[..., ::-1], axis=-1)[..., ::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        _decay = 10.0 * np.log10(_remaining / _remaining[..., :1])
+    if decayRange is not None:
+        _decay[~(_decay >= -decayRange)] = np.nan
+    return _decay
+
+
+def decayCurveChange(previous, current):
+    # Largest difference (dB) between two sets of decay curves of
+    # (sources x receivers x bands x bins) echograms, per (source, receiver),
+    # over the bins both define. Pairs without energy in either have none.
+    _difference = np.abs(current - previous)
+    _defined = np.isfinite(_difference)
+    _change = np.where(_defined, _difference, 0.0).max(axis=(2, 3))
+    _silent = ~np.isfinite(current[..., 0]).any(axis=2) & ~np.isfinite(previous[..., 0]).any(axis=2)
+    _mismatch = (np.isfinite(current[..., 0]) != np.isfinite(previous[..., 0])).any(axis=2)
+    _change[_mismatch] = np.inf
+    _change[_silent] = 0.0
+    return _change
@@ -0,0 +1,183 @@
+'''
+    This module implements the detection of spherical receivers by the ray
+    segments of a packet. A few receivers are simply tested against every
+    segment at once; for many receivers (a listener plane with thousands of
+    points) a uniform grid is built over them, so every segment only tests
+    the receivers registered in the cells it goes through and the cost per
+    segment stays about the same whatever the number of receivers.
+
+    Segments are sampled at the cell size and every receiver is registered
+    in all the cells within its radius plus half a cell, so some sample of a
+    segment always falls in a cell listing the receivers it passes through.
+
+    Joe Simon 2018.
+'''
+
+
+import numpy as np
+from ray_intersection import *
+
+
+# Below this many receivers testing all of them at once is faster
+RECEIVER_GRID_MIN_RECEIVERS = 64
+
+
+def receiverDetector(locations, radii, cellSize=0.0):
+    # Returns the detector suited to the number of receivers
+    _locations = np.asarray(locations, dtype=float).reshape(-1, 3)
+    if len(_locations) < RECEIVER_GRID_MIN_RECEIVERS:
+        return SphereReceivers(_locations, radii)
+    return ReceiverGrid(_locations, radii, cellSize)
+
+
+def _sphereCrossings(toCentres, directions, lengths, radii):
+    # For segment-receiver pairs: whether the point of the segment closest to
+    # the centre lies inside the sphere, the distance along the segment to
+    # that point and the squared distance from it to the centre
+    _along = np.einsum('...k,...k->...', toCentres, directions)
+    _distances = np.einsum('...k,...k->...', toCentres, toCentres) - _along * _along
+    _inside = (_along >= 0.0) & (_along <= lengths) & (_distances < radii * radii)
+    return _inside, _along, _distances
+
+
+class SphereReceivers:
+    # Tests every segment against every receiver
+    def __init__(self, locations, radii):
+        self._locations = np.asarray(locations, dtype=float).reshape(-1, 3)
+        self._radii = np.array(np.broadcast_to(np.asarray(radii, dtype=float), (len(self._locations),)))
+        self._pairsTested = 0
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __str__(self):
+        return "%d receiver(s) tested directly" % len(self)
+
+    def detect(self, starts, directions, lengths):
+        # Returns the segment and receiver indices of every crossing, the
+        # distance along the segment to the point closest to the centre and
+        # the length of the chord through the sphere
+        _found = ([], [], [], [])
+        _blockSize = max(1, MAX_ELEMENTS_PER_BLOCK // max(1, len(self._locations)))
+        for _start in range(0, len(starts), _blockSize):
+            _stop = min(_start + _blockSize, len(starts))
+            _toCentres = self._locations[None, :, :] - starts[_start:_stop, None, :]
+            _inside, _along, _distances = _sphereCrossings(_toCentres, directions[_start:_stop, None, :], lengths[_start:_stop, None], self._radii[None, :])
+            _segments, _receivers = np.nonzero(_inside)
+            _found[0].append(_segments + _start)
+            _found[1].append(_receivers)
+            _found[2].append(_along[_segments, _receivers])
+            _found[3].append(2.0 * np.sqrt(self._radii[_receivers] ** 2 - _distances[_segments, _receivers]))
+            self._pairsTested += _inside.size
+        if len(_found[0]) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+        return tuple(np.concatenate(_part) for _part in _found)
+
+
+class ReceiverGrid:
+    # Uniform grid over the receivers, stored as sorted keys of the occupied
+    # cells and the receivers of each one in a single flat array:
+    # _cellReceivers[_cellStart[i]:_cellStart[i + 1]] for _cellKeys[i]
+    def __init__(self, locations, radii, cellSize=0.0):
+        self._locations = np.asarray(locations, dtype=float).reshape(-1, 3)
+        self._radii = np.array(np.broadcast_to(np.asarray(radii, dtype=float), (len(self._locations),)))
+        if cellSize is None or cellSize <= 0.0:
+            cellSize = 2.0 * float(self._radii.max())
+        self._cellSize = float(cellSize)
+        self._pairsTested = 0
+        self._build()
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __str__(self):
+        return "Receiver grid of %s cell(s) of %.3f m, %d occupied, over %d receiver(s)" % ("x".join(str(n) for n in self._dims), self._cellSize, len(self._cellKeys), len(self))
+
+    def _build(self):
+        _reach = self._radii + 0.5 * self._cellSize
+        _low = self._locations - _reach[:, None]
+        _high = self._locations + _reach[:, None]
+        self._origin = _low.min(axis=0)
+        self._boundsMax = _high.max(axis=0)
+        self._dims = np.maximum(1, np.ceil((self._boundsMax - self._origin) / self._cellSize)).astype(np.int64)
+
+        # Register every receiver in each cell of its reach box, one offset at a time
+        _first = self._cellsOf(_low)
+        _extent = self._cellsOf(_high) - _first + 1
+        _keys = []
+        _receivers = []
+        for _dx in range(_extent[:, 0].max()):
+            for _dy in range(_extent[:, 1].max()):
+                for _dz in range(_extent[:, 2].max()):
+                    _offset = np.array([_dx, _dy, _dz])
+                    _selected = np.nonzero(np.all(_offset[None, :] < _extent, axis=1))[0]
+                    _keys.append(self._keysOf(_first[_selected] + _offset[None, :]))
+                    _receivers.append(_selected)
+        _keys = np.concatenate(_keys)
+        _order = np.argsort(_keys, kind='stable')
+        self._cellKeys, _starts = np.unique(_keys[_order], return_index=True)
+        self._cellReceivers = np.concatenate(_receivers)[_order]
+        self._cellStart = np.append(_starts, len(_order)).astype(np.int64)
+
+    def _cellsOf(self, points):
+        _cells = np.floor((points - self._origin) / self._cellSize).astype(np.int64)
+        return np.clip(_cells, 0, self._dims - 1)
+
+    def _keysOf(self, cells):
+        return (cells[..., 0] * self._dims[1] + cells[..., 1]) * self._dims[2] + cells[..., 2]
+
+    def _clipSegments(self, starts, directions, lengths):
+        # Part of every segment inside the bounds of the grid (slab test)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _ta = (self._origin - starts) / directions
+            _tb = (self._boundsMax - starts) / directions
+        _parallel = directions == 0.0
+        _within = (starts >= self._origin) & (starts <= self._boundsMax)
+        _near = np.where(_parallel, np.where(_within, -np.inf, np.inf), np.minimum(_ta, _tb))
+        _far = np.where(_parallel, np.where(_within, np.inf, -np.inf), np.maximum(_ta, _tb))
+        return np.maximum(_near.max(axis=1), 0.0), np.minimum(_far.min(axis=1), lengths)
+
+    def _candidates(self, starts, directions, segments, tNear, tFar):
+        # Distinct (segment, receiver) pairs registered in the cells of the samples
+        _counts = np.floor((tFar - tNear) / self._cellSize).astype(np.int64) + 2
+        _sampleSegments = np.repeat(np.arange(len(segments)), _counts)
+        _steps = np.arange(len(_sampleSegments)) - np.repeat(np.cumsum(_counts) - _counts, _counts)
+        _t = np.minimum(tNear[_sampleSegments] + _steps * self._cellSize, tFar[_sampleSegments])
+        _points = starts[segments[_sampleSegments]] + _t[:, None] * directions[segments[_sampleSegments]]
+        _keys = self._keysOf(self._cellsOf(_points))
+
+        _cells = np.minimum(np.searchsorted(self._cellKeys, _keys), len(self._cellKeys) - 1)
+        _occupied = self._cellKeys[_cells] == _keys
+        _sampleSegments = _sampleSegments[_occupied]
+        _cells = _cells[_occupied]
+
+        _sizes = self._cellStart[_cells + 1] - self._cellStart[_cells]
+        _pairSegments = np.repeat(_sampleSegments, _sizes)
+        _positions = np.arange(len(_pairSegments)) - np.repeat(np.cumsum(_sizes) - _sizes, _sizes) + np.repeat(self._cellStart[_cells], _sizes)
+        _pairs = np.unique(segments[_pairSegments] * len(self) + self._cellReceivers[_positions])
+        return _pairs // len(self), _pairs % len(self)
+
+    def detect(self, starts, directions, lengths):
+        # Same results as SphereReceivers.detect
+        _tNear, _tFar = self._clipSegments(starts, directions, lengths)
+        _segments = np.nonzero(_tNear <= _tFar)[0]
+        _found = ([], [], [], [])
+        # Blocks of segments, so the samples of one block stay bounded
+        _samples = np.cumsum(np.floor((_tFar[_segments] - _tNear[_segments]) / self._cellSize) + 2)
+        _start = 0
+        while _start < len(_segments):
+            _base = _samples[_start - 1] if _start > 0 else 0.0
+            _stop = max(_start + 1, int(np.searchsorted(_samples, _base + MAX_ELEMENTS_PER_BLOCK, side='right')))
+            _block = _segments[_start:_stop]
+            _pairSegments, _pairReceivers = self._candidates(starts, directions, _block, _tNear[_block], _tFar[_block])
+            _toCentres = self._locations[_pairReceivers] - starts[_pairSegments]
+            _inside, _along, _distances = _sphereCrossings(_toCentres, directions[_pairSegments], lengths[_pairSegments], self._radii[_pairReceivers])
+            _found[0].append(_pairSegments[_inside])
+            _found[1].append(_pairReceivers[_inside])
+            _found[2].append(_along[_inside])
+            _found[3].append(2.0 * np.sqrt(self._radii[_pairReceivers[_inside]] ** 2 - _distances[_inside]))
+            self._pairsTested += len(_pairSegments)
+            _start = _stop
+        if len(_found[0]) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+        return tuple(np.concatenate(_part) for _part in _found)
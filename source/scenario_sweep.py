@@ -0,0 +1,240 @@
+'''
+    This module runs sweeps of many scenarios (source and receiver layouts,
+    parameter variants) on the same room. The geometry, its material table
+    and its acceleration structure are loaded and published once, and all
+    the scenarios are traced at the same time on the one worker pool.
+
+    Scenarios with the same parameters, environment and absorption form a
+    variant, traced by a single ray-tracer whose sources and receivers are
+    the distinct ones of its scenarios and whose traced pairs are those that
+    some scenario needs. So a source shared by many layouts only has its
+    rays traced once per variant, and its image sources found once per
+    receiver. The results of every scenario are cut out of those of its
+    variant and can be saved keyed by the scenario ID.
+
+    Joe Simon 2018.
+'''
+
+
+import os
+import json
+import time
+import numpy
+from logger import *
+from geometry import *
+from ray_tracing import *
+from checkpoint import checkpointKey
+
+
+class ScenarioDefinition:
+    # One case of a sweep: its sources and receivers and, optionally, its own
+    # parameters, environment and material absorption (those of the sweep
+    # otherwise, the absorption is added to that of the sweep)
+    def __init__(self, id=None):
+        self._id = id
+        self._sources = []
+        self._receivers = []
+        self._rayTracerParameters = None
+        self._environmentParameters = None
+        self._materialAbsorption = {}
+
+    @staticmethod
+    def fromDict(row):
+        # Row of a scenario table, e.g. {'id': 'a', 'sources': [[1, 1, 1]],
+        # 'receivers': [[3, 3, 1.2]], 'receiverRadius': 0.5, 'parameters':
+        # {'maxBouncesPerRay': 20}, 'environment': {'temperature': 25.0},
+        # 'absorption': {'Carpet': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]}}
+        _scenario = ScenarioDefinition(row['id'])
+        for _location in row.get('sources', []):
+            _source = SourceDefinition()
+            _source._location = [float(_value) for _value in _location]
+            _scenario._sources.append(_source)
+        if len(row.get('receivers', [])) > 0:
+            _scenario._receivers.append(ReceiverArrayDefinition(row['receivers'], row.get('receiverRadius', ReceiverDefinition()._radius)))
+        if 'parameters' in row:
+            _scenario._rayTracerParameters = RayTracerParameters()
+            _setAttributes(_scenario._rayTracerParameters, row['parameters'])
+        if 'environment' in row:
+            _scenario._environmentParameters = EnvironmentParameters()
+            _setAttributes(_scenario._environmentParameters, row['environment'])
+        _scenario._materialAbsorption = dict(row.get('absorption', {}))
+        return _scenario
+
+
+def _setAttributes(target, values):
+    # Names without the leading underscore, only existing attributes
+    for _name, _value in values.items():
+        if not hasattr(target, '_' + _name):
+            raise Exception("Unknown setting '%s' for %s!" % (_name, type(target).__name__))
+        setattr(target, '_' + _name, _value)
+
+
+def _sourceKey(source):
+    _directivity = source._directivity
+    return checkpointKey(source._type, [float(_value) for _value in source._location], _directivity._type,
+                         _directivity._elevations, _directivity._azimuths, _directivity._gains)
+
+
+class _Variant:
+    # Scenarios sharing parameters, traced together
+    def __init__(self, parameters, environment, absorption):
+        self._parameters = parameters
+        self._environment = environment
+        self._absorption = absorption
+        self._sources = []
+        self._sourceKeys = {}
+        self._receiverPoints = []
+        self._scenarios = []
+        self._tracer = None
+        self._receivers = None
+        self._pairs = None
+
+    def addScenario(self, scenario):
+        _sources = []
+        for _source in scenario._sources:
+            _key = _sourceKey(_source)
+            if not _key in self._sourceKeys:
+                self._sourceKeys[_key] = len(self._sources)
+                self._sources.append(_source)
+            _sources.append(self._sourceKeys[_key])
+        _locations, _radii = receiverArrays(scenario._receivers)
+        self._receiverPoints.append(numpy.column_stack([_radii, _locations]))
+        self._scenarios.append((scenario, numpy.array(_sources, dtype=numpy.int64)))
+
+    def buildTracer(self, geometry):
+        # Distinct receivers sorted by radius, one receiver array per radius
+        _points, _inverse = numpy.unique(numpy.concatenate(self._receiverPoints), axis=0, return_inverse=True)
+        _inverse = _inverse.reshape(-1)
+        self._tracer = RayTracer()
+        self._tracer.addEnvironmentGeometry(geometry)
+        self._tracer._rayTracerParameters = self._parameters
+        self._tracer._environmentParameters = self._environment
+        for _material, _absorption in self._absorption.items():
+            self._tracer.addMaterialAbsorption(_material, _absorption)
+        for _source in self._sources:
+            self._tracer.addSource(_source)
+        for _radius in numpy.unique(_points[:, 0]):
+            self._tracer.addReceiver(ReceiverArrayDefinition(_points[_points[:, 0] == _radius, 1:], float(_radius)))
+
+        # Receivers of every scenario, and the pairs any of them needs
+        self._receivers = numpy.split(_inverse, numpy.cumsum([len(_points) for _points in self._receiverPoints])[:-1])
+        self._pairs = numpy.zeros((len(self._sources), len(_points)), dtype=bool)
+        for (_scenario, _sources), _receivers in zip(self._scenarios, self._receivers):
+            self._pairs[numpy.ix_(_sources, _receivers)] = True
+        return self._tracer
+
+
+class ScenarioSweep:
+
+    def __init__(self):
+        self._log = getLogger() #Logger()
+        self._environmentGeometry = None
+        self._rayTracerParameters = None
+        self._environmentParameters = None
+        self._materialAbsorption = {}
+        self._scenarios = []
+        self._results = {}
+        self._brokerAddress = None
+
+
+    def addEnvironmentGeometry(self, newEnvironmentGeometry):
+        if not isinstance(newEnvironmentGeometry, LibraryGeometries):
+            raise Exception("The environment geometry of a sweep must be of type LibraryGeometries!")
+        self._environmentGeometry = newEnvironmentGeometry
+
+
+    def addMaterialAbsorption(self, material, absorption):
+        # Absorption of a material for all scenarios, see RayTracer.addMaterialAbsorption
+        self._materialAbsorption[material] = absorption
+
+
+    def addScenario(self, newScenario):
+        if not isinstance(newScenario, ScenarioDefinition):
+            raise Exception("A new scenario of a sweep must be of type ScenarioDefinition!")
+        if newScenario._id is None or newScenario._id in [_scenario._id for _scenario in self._scenarios]:
+            raise Exception("Every scenario of a sweep needs a distinct ID!")
+        if len(newScenario._sources) == 0 or len(newScenario._receivers) == 0:
+            raise Exception("Scenario '%s' needs at least one source and one receiver!" % str(newScenario._id))
+        self._scenarios.append(newScenario)
+
+
+    def addScenarios(self, table):
+        # Rows of ScenarioDefinition or of dicts, see ScenarioDefinition.fromDict
+        for _row in table:
+            self.addScenario(_row if isinstance(_row, ScenarioDefinition) else ScenarioDefinition.fromDict(_row))
+
+
+    def loadScenarios(self, filename):
+        # JSON file with a list of scenario rows
+        with open(filename, 'r') as _file:
+            self.addScenarios(json.load(_file))
+
+
+    def useBroker(self, address, authkey=DEFAULT_BROKER_AUTHKEY):
+        # Runs the sweep on the nodes of a task broker, see RayTracer.useBroker
+        self._brokerAddress = (address, authkey)
+
+
+    def _variants(self):
+        _rayTracerParameters = self._rayTracerParameters if self._rayTracerParameters is not None else RayTracerParameters()
+        _environmentParameters = self._environmentParameters if self._environmentParameters is not None else EnvironmentParameters()
+        _variants = {}
+        for _scenario in self._scenarios:
+            _parameters = _scenario._rayTracerParameters if _scenario._rayTracerParameters is not None else _rayTracerParameters
+            _environment = _scenario._environmentParameters if _scenario._environmentParameters is not None else _environmentParameters
+            _absorption = dict(self._materialAbsorption)
+            _absorption.update(_scenario._materialAbsorption)
+            _key = checkpointKey(sorted(vars(_parameters).items()), sorted(vars(_environment).items()), sorted(_absorption.items(), key=repr))
+            if not _key in _variants:
+                _variants[_key] = _Variant(_parameters, _environment, _absorption)
+            _variants[_key].addScenario(_scenario)
+        return list(_variants.values())
+
+
+    def executeSweep(self):
+        # Traces all scenarios, returns their results by scenario ID
+        if self._environmentGeometry is None:
+            raise Exception("Cannot execute a sweep without an environment geometry definition!")
+        if len(self._scenarios) == 0:
+            raise Exception("Cannot execute a sweep without any scenario!")
+        _startTime = time.time()
+        _variants = self._variants()
+        _tracers = [_variant.buildTracer(self._environmentGeometry) for _variant in _variants]
+        self._log.log(LogLevel.Info, "Sweep of %d scenario(s) in %d variant(s): %d source(s) and %d pair(s) traced instead of %d and %d." % (
+            len(self._scenarios), len(_variants), sum([len(_variant._sources) for _variant in _variants]), sum([numpy.count_nonzero(_variant._pairs) for _variant in _variants]),
+            sum([len(_scenario._sources) for _scenario in self._scenarios]), sum([len(_scenario._sources) * len(receiverArrays(_scenario._receivers)[1]) for _scenario in self._scenarios])))
+
+        # The first tracer publishes the scene, the others trace on it
+        try:
+            if self._brokerAddress is not None:
+                _tracers[0].useBroker(*self._brokerAddress)
+            _tracers[0]._publishScene()
+            for _tracer in _tracers[1:]:
+                _tracer.shareSceneWith(_tracers[0])
+            _futures = [_tracer.startTracing(enabledPairs=_variant._pairs) for _tracer, _variant in zip(_tracers, _variants)]
+
+            self._results = {}
+            for _variant, _future in zip(_variants, _futures):
+                _results = _future.result()
+                for (_scenario, _sources), _receivers in zip(_variant._scenarios, _variant._receivers):
+                    self._results[_scenario._id] = _results.select(_sources, _receivers)
+        finally:
+            for _tracer in reversed(_tracers):
+                _tracer.close()
+        self._log.log(LogLevel.Info, "Sweep of %d scenario(s) completed in %.3f s." % (len(self._scenarios), time.time() - _startTime))
+        return self._results
+
+
+    def saveResults(self, directory):
+        # One file per scenario, named after its ID
+        os.makedirs(directory, exist_ok=True)
+        for _scenario in self._scenarios:
+            if not _scenario._id in self._results:
+                continue
+            _results = self._results[_scenario._id]
+            _receiverLocations, _receiverRadii = receiverArrays(_scenario._receivers)
+            numpy.savez(os.path.join(directory, "%s.npz" % str(_scenario._id)), echogram=_results._echogram,
+                        frequencyBands=numpy.array(_results._frequencyBands), echogramTimeStep=_results._echogramTimeStep,
+                        sourceLocations=numpy.array([_source._location for _source in _scenario._sources], dtype=float),
+                        receiverLocations=_receiverLocations, receiverRadii=_receiverRadii)
+        self._log.log(LogLevel.Info, "Saved the results of %d scenario(s) in '%s'." % (len(self._results), directory))
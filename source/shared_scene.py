@@ -0,0 +1,106 @@
+'''
+    This module publishes the arrays of a compiled scene (triangle vertices,
+    material ids, acceleration structures, ...) once in shared memory
+    segments. Worker processes only receive a small picklable handle and
+    attach read-only numpy views to the same memory, so the scene is never
+    copied or pickled per worker.
+
+    Joe Simon 2018.
+'''
+
+
+import atexit
+import numpy as np
+from multiprocessing import shared_memory
+
+
+# Segments of the last scene attached by this process, kept open so the
+# views stay valid until a handle of another scene arrives
+_attachedSegments = {}
+# Scenes published by this process, closed at exit if still open
+_publishedScenes = []
+
+
+class SharedSceneHandle:
+    def __init__(self):
+        self._segments = {}
+
+    def key(self):
+        # Identifies the published scene, for caches of data derived from it
+        return tuple(sorted([(_name, _segment[0]) for _name, _segment in self._segments.items()]))
+
+    def attach(self):
+        return attachSharedScene(self)
+
+    def __str__(self):
+        return "Shared scene: " + ", ".join(["%s%s" % (_name, tuple(_shape)) for _name, (_, _, _shape) in self._segments.items()])
+
+
+class SharedScene:
+    def __init__(self):
+        self._memory = []
+        self._handle = SharedSceneHandle()
+        _publishedScenes.append(self)
+
+    def publish(self, name, array):
+        _array = np.ascontiguousarray(array)
+        # Zero-sized segments are not allowed, keep at least one byte
+        _memory = shared_memory.SharedMemory(create=True, size=max(_array.nbytes, 1))
+        _view = np.ndarray(_array.shape, dtype=_array.dtype, buffer=_memory.buf)
+        _view[...] = _array
+        self._memory.append(_memory)
+        self._handle._segments[name] = (_memory.name, _array.dtype.str, list(_array.shape))
+        return _view
+
+    def getHandle(self):
+        return self._handle
+
+    def nbytes(self):
+        return sum([_memory.size for _memory in self._memory])
+
+    def close(self):
+        for _memory in self._memory:
+            _detach(_memory.name)
+            try:
+                _memory.close()
+            except BufferError:
+                # Views into the segment are still alive, the mapping goes with them
+                pass
+            _memory.unlink()
+        self._memory = []
+        self._handle = SharedSceneHandle()
+        if self in _publishedScenes:
+            _publishedScenes.remove(self)
+
+
+def attachSharedScene(handle):
+    # Segments of scenes attached before are released, so warm workers do
+    # not keep every scene they have seen mapped after it was unlinked
+    _names = set([_segment[0] for _segment in handle._segments.values()])
+    for _memoryName in [_name for _name in _attachedSegments.keys() if not _name in _names]:
+        _detach(_memoryName)
+
+    _arrays = {}
+    for _name, (_memoryName, _dtype, _shape) in handle._segments.items():
+        if _memoryName not in _attachedSegments:
+            _attachedSegments[_memoryName] = shared_memory.SharedMemory(name=_memoryName)
+        _view = np.ndarray(tuple(_shape), dtype=np.dtype(_dtype), buffer=_attachedSegments[_memoryName].buf)
+        _view.flags.writeable = False
+        _arrays[_name] = _view
+    return _arrays
+
+
+def _closePublishedScenes():
+    for _scene in list(_publishedScenes):
+        _scene.close()
+
+
+atexit.register(_closePublishedScenes)
+
+
+def _detach(memoryName):
+    if memoryName in _attachedSegments:
+        try:
+            _attachedSegments.pop(memoryName).close()
+        except BufferError:
+            pass
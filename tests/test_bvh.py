@@ -0,0 +1,69 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+from ray_intersection import *
+from bvh import *
+
+
+def _randomScene(seed=0, faces=2000, rays=3000):
+    _random = np.random.default_rng(seed)
+    _centres = _random.uniform(-5.0, 5.0, (faces, 1, 3))
+    _vertices = _centres + _random.uniform(-0.5, 0.5, (faces, 3, 3))
+    _origins = _random.uniform(-6.0, 6.0, (rays, 3))
+    _directions = _random.normal(size=(rays, 3))
+    _directions /= np.linalg.norm(_directions, axis=1)[:, None]
+    # Some rays along the axes, with zero direction components
+    _directions[:30] = np.eye(3)[np.arange(30) % 3] * np.where(np.arange(30) % 2, 1.0, -1.0)[:, None]
+    return _vertices, _origins, _directions
+
+
+def _built(vertices, **options):
+    _bvh = BVH()
+    _bvh.build(vertices, **options)
+    return _bvh
+
+
+def test_closest_hits_match_brute_force():
+    _vertices, _origins, _directions = _randomScene()
+    _triangles = TriangleArrays(_vertices)
+    _expectedT, _expectedFaces, _, _ = intersectRays(_origins, _directions, _triangles)
+    assert np.count_nonzero(_expectedFaces >= 0) > 100
+
+    for _bvh in (_built(_vertices), _built(_vertices, leafSize=2), bvhFromArrays(_built(_vertices).toArrays())):
+        _t, _faces, _, _ = _bvh.intersectClosest(_origins, _directions, _triangles)
+        assert np.array_equal(_faces, _expectedFaces)
+        assert np.array_equal(_t, _expectedT)
+        # The traversal tests far fewer pairs than all of them
+        assert _bvh._testsPerformed < len(_origins) * len(_vertices) // 10
+
+    _hit = _expectedFaces >= 0
+    _t, _faces, _, _ = _built(_vertices).intersectClosest(_origins[_hit], _directions[_hit], _triangles, ignoreFaces=_expectedFaces[_hit])
+    _expectedT, _expectedFaces, _, _ = intersectRays(_origins[_hit], _directions[_hit], _triangles, ignoreFaces=_expectedFaces[_hit])
+    assert np.array_equal(_faces, _expectedFaces)
+
+
+def test_any_hits_match_brute_force():
+    _vertices, _origins, _directions = _randomScene(1)
+    _triangles = TriangleArrays(_vertices)
+    _closestT, _, _, _ = intersectRays(_origins, _directions, _triangles)
+    _tMax = np.random.default_rng(2).uniform(0.0, 6.0, len(_origins))
+    _expected = _closestT < _tMax
+    assert 0 < np.count_nonzero(_expected) < len(_expected)
+
+    _bvh = _built(_vertices)
+    assert np.array_equal(_bvh.intersectAny(_origins, _directions, _triangles, _tMax), _expected)
+    assert not np.any(_bvh.intersectAny(_origins, _directions, _triangles, 0.0))
+
+
+def test_float32_bounds_still_contain_their_faces():
+    _vertices, _origins, _directions = _randomScene(3, faces=500, rays=1000)
+    _bvh = bvhFromArrays(_built(_vertices).toArrays(np.float32))
+    _triangles = TriangleArrays(_vertices, np.float32)
+    _origins = _origins.astype(np.float32)
+    _directions = _directions.astype(np.float32)
+    _expectedT, _expectedFaces, _, _ = intersectRays(_origins, _directions, _triangles)
+    _t, _faces, _, _ = _bvh.intersectClosest(_origins, _directions, _triangles)
+    assert np.array_equal(_faces, _expectedFaces)
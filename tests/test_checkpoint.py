@@ -0,0 +1,34 @@
+import os
+import sys
+import socket
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+from checkpoint import *
+from ray_tracing_classes import TracerEngineResults
+
+
+def _chunkResults(value):
+    _results = TracerEngineResults()
+    _block = _results.allocateBlock([0], [1, 2], [500, 1000], 0.01, 0.05)
+    _block[0, 1, :, 3] = value
+    _results._raysTraced = 10
+    return _results
+
+
+def test_hosts_with_the_same_pid_keep_apart(tmp_path, monkeypatch):
+    _checkpoint = TracingCheckpoint(str(tmp_path / 'run'), 'key')
+    assert not _checkpoint.open()
+    for _host, _chunk, _value in (('host-a', 'chunk 0', 1.0), ('host-b', 'chunk 1', 2.0)):
+        monkeypatch.setattr(socket, 'gethostname', lambda: _host)
+        _checkpoint.record(_chunk, _chunkResults(_value), (1, 3))
+    assert len([_name for _name in os.listdir(str(tmp_path / 'run')) if _name.startswith('data-')]) == 2
+
+    _resumed = TracerEngineResults()
+    _resumed.allocateEchogram(1, 3, [500, 1000], 0.01, 0.05)
+    assert TracingCheckpoint(str(tmp_path / 'run'), 'key').open()
+    assert _checkpoint.load(_resumed) == 2
+    assert _resumed._raysTraced == 20
+    assert np.all(_resumed._echogram[0, 2, :, 3] == 3.0)
+    assert _resumed._echogram.sum() == 6.0
@@ -0,0 +1,172 @@
+import os
+import sys
+import numpy as np
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT, 'source'))
+
+import logger
+logger.LOG_TO_TEXT_FILE = False
+logger.LOG_TO_STD_OUTPUT = False
+
+from geometry import *
+
+_EXAMPLE = os.path.join(_ROOT, 'examples', 'boxy_box_materials_colors.dae')
+
+
+def _loaded(filename=_EXAMPLE, **options):
+    _geometry = LibraryGeometries()
+    _geometry.loadGeometryFromFile(filename, **options)
+    return _geometry
+
+
+def test_formed_meshes_are_struct_of_arrays():
+    _geometry = _loaded()
+    _triangles = _geometry._formedTriangles
+    assert len(_triangles) > 0
+    assert _triangles._vertices.shape == (len(_triangles), 3, 3)
+    assert np.array_equal(_triangles._vertices, _triangles._points[_triangles._indices])
+    assert _triangles._materialIds.shape == (len(_triangles),)
+    assert _triangles._colorIds.shape == (len(_triangles),)
+    assert np.all(_triangles._materialIds < len(_triangles._materials))
+
+    # Indexing still gives the old per-triangle objects
+    _first = _triangles[0]
+    assert [_first.p1.x, _first.p1.y, _first.p1.z] == list(_triangles._vertices[0, 0])
+
+    _lines = _geometry._formedLines
+    assert len(_lines) > 0
+    assert np.array_equal(_lines._edges, _lines._points[_lines._indices])
+
+
+def test_tag_index_matches_a_full_scan():
+    _root = xml.etree.ElementTree.parse(_EXAMPLE).getroot()
+    _index = TagIndex(_root)
+    _names = set([_element.tag.split('}')[-1] for _element in _root.iter()])
+    for _element in list(_root.iter())[::7]:
+        for _name in _names:
+            _scanned = [_found for _found in _element.iter() if _found.tag.split('}')[-1] == _name]
+            assert _index.findAll(_element, _name) == _scanned
+
+
+def test_streaming_load_matches_the_tree_load():
+    _tree = _loaded()
+    _streamed = _loaded(streaming=True)
+    for _mesh in ('_formedTriangles', '_formedLines'):
+        for _name, _array in vars(getattr(_tree, _mesh)).items():
+            if isinstance(_array, np.ndarray):
+                assert np.array_equal(getattr(getattr(_streamed, _mesh), _name), _array)
+    assert len(_streamed._materialTable) == len(_tree._materialTable)
+
+
+def _brokenExample(tmp_path, old, new):
+    with open(_EXAMPLE, 'r') as _file:
+        _text = _file.read()
+    assert old in _text
+    _filename = str(tmp_path / 'broken.dae')
+    with open(_filename, 'w') as _file:
+        _file.write(_text.replace(old, new, 1))
+    return _filename
+
+
+def test_streaming_load_rejects_malformed_arrays(tmp_path):
+    for _old, _new in (('<float_array id="ID11" count="42">', '<float_array id="ID11" count="43">'),
+                       ('<float_array id="ID11" count="42">0 196.8504', '<float_array id="ID11" count="42">0 196.85x4')):
+        _filename = _brokenExample(tmp_path, _old, _new)
+        try:
+            _loaded(_filename, streaming=True)
+        except Exception:
+            continue
+        assert False, "'%s' was loaded" % _new
+
+
+def _raises(function, *args, **kwargs):
+    try:
+        function(*args, **kwargs)
+    except Exception:
+        return True
+    return False
+
+
+def test_number_arrays_are_decoded_in_bulk():
+    _geometry = LibraryGeometries()
+    _floats = _geometry._parseNumbersArray("0 1.5\n-2e3  4", expectedCount=4)
+    assert _floats.dtype == np.float64
+    assert np.array_equal(_floats, [0.0, 1.5, -2000.0, 4.0])
+    _ints = _geometry._parseNumbersArray("3 1 2", asInts=True, expectedCount=3)
+    assert _ints.dtype == np.int64
+    assert np.array_equal(_ints, [3, 1, 2])
+
+    _geometry._asset = Asset()
+    _geometry._asset.unitMeter = "0.0254"
+    assert np.allclose(_geometry._parseNumbersArray("1 2", applyScaling=True), [0.0254, 0.0508])
+
+
+def test_malformed_number_arrays_are_errors():
+    _geometry = LibraryGeometries()
+    assert _raises(_geometry._parseNumbersArray, "1 2 3", expectedCount=4)
+    assert _raises(_geometry._parseNumbersArray, "1 2 x3", expectedCount=3)
+    assert _raises(_geometry._parseNumbersArray, "1 2.5 3", asInts=True)
+
+
+def _local(element):
+    return element.tag.split('}')[-1]
+
+
+def _expectedColors():
+    # Color of every triangle of the example model, resolved on the XML:
+    # geometry -> instance material -> material -> effect -> diffuse color
+    _root = xml.etree.ElementTree.parse(_EXAMPLE).getroot()
+    _byId = dict([(_element.attrib['id'], _element) for _element in _root.iter() if 'id' in _element.attrib])
+    _instances = [_element for _element in _root.iter() if _local(_element) == 'instance_geometry']
+    _colors = []
+    for _geometry in [_element for _element in _root.iter() if _local(_element) == 'geometry']:
+        for _triangles in [_element for _element in _geometry.iter() if _local(_element) == 'triangles']:
+            _color = None
+            for _instance in [_instance for _instance in _instances if _instance.attrib['url'] == '#' + _geometry.attrib['id']][:1]:
+                _bound = [_material for _material in _instance.iter() if _local(_material) == 'instance_material' and _material.attrib['symbol'] == _triangles.attrib['material']]
+                if len(_bound) > 0:
+                    _material = _byId[_bound[0].attrib['target'][1:]]
+                    _effect = _byId[[_element for _element in _material.iter() if _local(_element) == 'instance_effect'][0].attrib['url'][1:]]
+                    _color = [float(_c) for _c in [_element for _element in _effect.iter() if _local(_element) == 'color'][0].text.split()]
+            _colors += [_color] * int(_triangles.attrib['count'])
+    return _colors
+
+
+def test_material_table_resolves_the_bindings_of_the_model():
+    _triangles = _loaded()._formedTriangles
+    _expected = _expectedColors()
+    assert len(_expected) == len(_triangles)
+    for i, _color in enumerate(_expected):
+        if _color is None:
+            assert _triangles._colorIds[i] < 0
+        else:
+            assert np.allclose(_triangles._colors[_triangles._colorIds[i]], _color)
+
+
+def test_scene_cache_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    _cacheFilename = sceneCacheFilename(_EXAMPLE)
+    _loaded()
+    assert not os.path.exists(_cacheFilename)
+
+    _parsed = _loaded(useCache=True)
+    assert os.path.isfile(_cacheFilename)
+    _cached = _loaded(useCache=True)
+    assert _cached._restoredFromCache and not _parsed._restoredFromCache
+    for _mesh in ('_formedTriangles', '_formedLines'):
+        for _name, _array in vars(getattr(_parsed, _mesh)).items():
+            if isinstance(_array, np.ndarray):
+                assert np.array_equal(getattr(getattr(_cached, _mesh), _name), _array)
+    assert _cached._materialTable._bindings == _parsed._materialTable._bindings
+    assert _cached._materialTable._colorIndexByMaterial == _parsed._materialTable._colorIndexByMaterial
+    assert vars(_cached._asset) == vars(_parsed._asset)
+    assert _raises(_cached.formTriangles)
+
+    # The BVH is only built when asked for, and then added to the cache
+    assert _cached._bvh is None
+    _built = _cached.getAccelerationStructure().toArrays()
+    _restored = _loaded(useCache=True)
+    assert _restored._bvh is not None
+    for _name, _array in _built.items():
+        assert np.array_equal(_restored._bvh.toArrays()[_name], _array)
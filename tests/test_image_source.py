@@ -0,0 +1,45 @@
+import os
+import sys
+import numpy as np
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT, 'source'))
+
+import logger
+logger.LOG_TO_TEXT_FILE = False
+logger.LOG_TO_STD_OUTPUT = False
+
+from geometry import *
+from image_source import *
+from ray_intersection import TriangleArrays
+
+
+def _boxTriangles():
+    _geometry = LibraryGeometries()
+    _geometry.loadGeometryFromFile(os.path.join(_ROOT, 'examples', 'boxy_box_materials_colors.dae'))
+    return TriangleArrays(_geometry._formedTriangles._vertices)
+
+
+def _sortedPaths(paths):
+    _order = np.lexsort((paths[1], paths[0]))
+    return [_part[_order] for _part in paths]
+
+
+def test_cached_paths_match_a_fresh_validation():
+    _triangles = _boxTriangles()
+    _planes = ScenePlanes(_triangles)
+    _receivers = np.array([[1.5, 3.0, 1.0], [0.5, 4.0, 1.5], [1.5, 2.0, 0.8]])
+    _tree = imageSourceTree(_planes, [1.0, 1.0, 1.0], 2, 'scene')
+    _first = _tree.findPaths(_receivers[:2], _triangles)
+
+    # Same tree for the same scene, source and order; the cached receivers
+    # are mixed with a new one
+    assert imageSourceTree(_planes, [1.0, 1.0, 1.0], 2, 'scene') is _tree
+    _mixed = _tree.findPaths(_receivers[[1, 2, 0]], _triangles)
+    _fresh = ImageSourceTree(_planes, [1.0, 1.0, 1.0], 2).findPaths(_receivers[[1, 2, 0]], _triangles)
+    assert len(_first[0]) > 0
+    for _cachedPart, _freshPart in zip(_sortedPaths(_mixed), _sortedPaths(_fresh)):
+        assert np.array_equal(_cachedPart, _freshPart)
+
+    # Trees of another scene replace those of the last one
+    assert not imageSourceTree(_planes, [1.0, 1.0, 1.0], 2, 'other scene') is _tree
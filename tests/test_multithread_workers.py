@@ -0,0 +1,89 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+import logger
+logger.LOG_TO_TEXT_FILE = False
+logger.LOG_TO_STD_OUTPUT = False
+
+import multithread_workers
+from multithread_workers import *
+
+
+def _processIds(tasks, workerId, offset=0):
+    return [(workerId, _task + offset, os.getpid()) for _task in tasks]
+
+
+def _chunkSum(chunk, workerId, offset=0):
+    return sum(chunk) + offset
+
+
+def _add(accumulated, new):
+    return accumulated + new
+
+
+def _run(workers):
+    return startWorkers(workers).result(timeout=60)
+
+
+def test_pool_is_kept_between_runs_and_grown_on_demand():
+    closeWorkerPool()
+    try:
+        _pool = getWorkerPool(2)
+        assert getWorkerPool(1) is _pool
+        assert getWorkerPool(2) is _pool
+
+        _pids = set()
+        for _round in range(3):
+            _workers = [Worker(i, _processIds, poolSize=2) for i in range(2)]
+            for _worker in _workers:
+                _worker.assignTasks([1, 2])
+            _pids |= set([_pid for _results in _run(_workers) for _, _, _pid in _results])
+        # Every run went to the same two warm processes
+        assert len(_pids) <= 2
+        assert os.getpid() not in _pids
+        assert getWorkerPool(2) is _pool
+
+        assert getWorkerPool(3) is not _pool
+        assert multithread_workers._workerPoolSize == 3
+    finally:
+        closeWorkerPool()
+    assert multithread_workers._workerPool is None
+
+
+def test_queue_workers_share_arguments_and_steal_chunks():
+    closeWorkerPool()
+    try:
+        _queue = getWorkQueueManager().WorkStealingQueue(2)
+        _chunks = [[i, i + 1] for i in range(20)]
+        _queue.distribute(_chunks)
+        _workers = []
+        for i in range(2):
+            _worker = Worker(i, _chunkSum, poolSize=2, reduce=_add, sharedArgs=(100,))
+            _worker.assignQueue(_queue)
+            _workers.append(_worker)
+        _results = _run(_workers)
+        # One reduced result per worker, the shared offset added once per chunk
+        assert sum([len(_result) for _result in _results]) <= 2
+        assert sum([sum(_result) for _result in _results]) == sum(map(sum, _chunks)) + 100 * len(_chunks)
+        assert _queue.statistics()[0] == len(_chunks)
+    finally:
+        closeWorkerPool()
+
+
+def test_work_stealing_takes_from_the_fullest_queue():
+    _queue = WorkStealingQueue(3)
+    _queue.distribute(list(range(9)))
+    _taken = [_queue.take(0) for i in range(3)]
+    assert _taken == [0, 3, 6]
+    # Worker 0 ran dry and steals half of the fullest queue, from its back
+    assert _queue.take(0) == 4
+    assert _queue.statistics() == (4, 2)
+    _rest = set()
+    for _worker in (0, 1, 2, 2, 1, 0, 2, 0):
+        _chunk = _queue.take(_worker)
+        if _chunk is not None:
+            _rest.add(_chunk)
+    assert _rest == set([1, 2, 5, 7, 8])
+    assert _queue.take(1) is None
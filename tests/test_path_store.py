@@ -0,0 +1,86 @@
+import os
+import sys
+import threading
+import numpy as np
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT, 'source'))
+
+import logger
+logger.LOG_TO_TEXT_FILE = False
+logger.LOG_TO_STD_OUTPUT = False
+
+from path_store import *
+from geometry import *
+from ray_tracing import *
+
+
+def _segments():
+    return {'starts': np.zeros((1, 3)), 'directions': np.ones((1, 3), dtype=np.float32), 'lengths': np.ones(1),
+            'pathLengths': np.ones(1), 'energies': np.ones((1, 1), dtype=np.float32)}
+
+
+def test_rays_are_traced_by_the_first_claim_only(tmp_path):
+    _first = PathStore(str(tmp_path), 'source')
+    _second = PathStore(str(tmp_path), 'source')
+    assert _first.claim((0, 10, 1))
+
+    # The second worker waits for the rays of the first one
+    _claimed = []
+    _waiting = threading.Thread(target=lambda: _claimed.append(_second.claim((0, 10, 1))))
+    _waiting.start()
+    _waiting.join(0.2)
+    assert _waiting.is_alive()
+    _first.save((0, 10, 1), _segments())
+    _first.release((0, 10, 1))
+    _waiting.join(5.0)
+    assert _claimed == [False]
+    assert np.array_equal(_second.load((0, 10, 1))['lengths'], np.ones(1))
+
+    # Other ranges are claimed independently
+    assert _second.claim((10, 20, 1))
+
+
+def _trace(receivers, directory=None, **parameters):
+    _geometry = LibraryGeometries()
+    _geometry.loadGeometryFromFile(os.path.join(_ROOT, 'examples', 'boxy_box_materials_colors.dae'))
+    _tracer = RayTracer()
+    _tracer.addEnvironmentGeometry(_geometry)
+    _tracer._rayTracerParameters = RayTracerParameters()
+    _tracer._rayTracerParameters._parallelThreads = 2
+    _tracer._rayTracerParameters._angularResolution = 4.0
+    _tracer._rayTracerParameters._maxBouncesPerRay = 30
+    for _name, _value in parameters.items():
+        setattr(_tracer._rayTracerParameters, _name, _value)
+    _source = SourceDefinition()
+    _source._location = [1.0, 1.0, 1.0]
+    _tracer.addSource(_source)
+    _tracer.addReceiver(ReceiverArrayDefinition(receivers, 0.4))
+    if directory is not None:
+        _tracer.retainPaths(directory)
+    try:
+        return _tracer.executeTracing()
+    finally:
+        _tracer.close()
+
+
+def test_replayed_paths_equal_a_fresh_trace(tmp_path):
+    _first = [[1.5, 3.0, 1.0], [0.5, 4.0, 1.5]]
+    _second = [[1.0, 2.0, 0.5], [1.5, 1.0, 2.0], [0.5, 3.0, 1.0]]
+    _stored = _trace(_first, str(tmp_path))
+    assert _stored._raysTraced > 0 and _stored._segmentsReplayed == 0
+    assert np.allclose(_stored._echogram, _trace(_first)._echogram, rtol=1e-10, atol=0.0)
+
+    # Other receivers only replay the stored segments
+    _fresh = _trace(_second)
+    _replayed = _trace(_second, str(tmp_path))
+    assert _replayed._raysTraced == 0 and _replayed._segmentsReplayed > 0
+    assert np.any(_fresh._echogram > 0.0)
+    # Up to the float32 the segments are stored in
+    assert np.allclose(_replayed._echogram, _fresh._echogram, rtol=1e-4, atol=1e-6 * _fresh._echogram.max())
+
+    # Chunks of the same rays for different receivers trace them once
+    _split = _trace(_first + _second, str(tmp_path / 'split'), _receiversPerChunk=1)
+    assert _split._raysTraced == _stored._raysTraced
+    _fresh = _trace(_first + _second)
+    assert np.allclose(_split._echogram, _fresh._echogram, rtol=1e-4, atol=1e-6 * _fresh._echogram.max())
@@ -0,0 +1,60 @@
+import os
+import sys
+import numpy as np
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT, 'source'))
+
+import logger
+logger.LOG_TO_TEXT_FILE = False
+logger.LOG_TO_STD_OUTPUT = False
+
+from geometry import *
+from ray_tracing import *
+
+
+def _makeTracer(checkpoint=None):
+    _geometry = LibraryGeometries()
+    _geometry.loadGeometryFromFile(os.path.join(_ROOT, 'examples', 'boxy_box_materials_colors.dae'))
+    _tracer = RayTracer()
+    _tracer.addEnvironmentGeometry(_geometry)
+    _parameters = RayTracerParameters()
+    _parameters._parallelThreads = 2
+    _parameters._angularResolution = 4.0
+    _parameters._maxBouncesPerRay = 30
+    _tracer._rayTracerParameters = _parameters
+    _source = SourceDefinition()
+    _source._location = [1.0, 1.0, 1.0]
+    _tracer.addSource(_source)
+    for _location in ([1.5, 3.0, 1.0], [3.0, 3.0, 1.0]):
+        _receiver = ReceiverDefinition()
+        _receiver._location = _location
+        _tracer.addReceiver(_receiver)
+    if checkpoint is not None:
+        _tracer.enableCheckpoint(checkpoint)
+    return _tracer
+
+
+def _trace(checkpoint=None, progressive=True):
+    _tracer = _makeTracer(checkpoint)
+    try:
+        if progressive:
+            return _tracer.executeTracingProgressive(rounds=3, tolerance=-1.0)
+        return _tracer.executeTracing()
+    finally:
+        _tracer.close()
+
+
+def test_progressive_tracing_with_checkpoint(tmp_path):
+    _checkpoint = str(tmp_path / 'run.w3dcheckpoint')
+    _reference = _trace()
+
+    # First run writes every round to the checkpoint, the second one resumes all of them
+    for _run in range(2):
+        _results = _trace(_checkpoint)
+        assert _results._raysTraced == _reference._raysTraced
+        assert np.allclose(_results._echogram, _reference._echogram, rtol=1e-10)
+
+    # A full run on the same checkpoint does not pick up the chunks of the rounds
+    _full = _trace(_checkpoint, progressive=False)
+    assert np.allclose(_full._echogram, _trace(progressive=False)._echogram, rtol=1e-10)
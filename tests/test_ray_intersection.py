@@ -0,0 +1,78 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+import ray_intersection
+from ray_intersection import *
+
+
+def _randomScene(seed=0, faces=40, rays=200):
+    _random = np.random.default_rng(seed)
+    _centres = _random.uniform(-2.0, 2.0, (faces, 1, 3))
+    _vertices = _centres + _random.uniform(-1.0, 1.0, (faces, 3, 3))
+    _origins = _random.uniform(-3.0, 3.0, (rays, 3))
+    # Aim the rays at points of the scene's volume so that many of them hit
+    _directions = _random.uniform(-2.0, 2.0, (rays, 3)) - _origins
+    _directions /= np.linalg.norm(_directions, axis=1)[:, None]
+    return _vertices, _origins, _directions
+
+
+def _scalarClosestHits(vertices, origins, directions):
+    # Moller-Trumbore, one ray and one face at a time
+    _t = np.full(len(origins), np.inf)
+    _faces = np.full(len(origins), -1)
+    for i in range(len(origins)):
+        for j in range(len(vertices)):
+            _e1 = vertices[j, 1] - vertices[j, 0]
+            _e2 = vertices[j, 2] - vertices[j, 0]
+            _p = np.cross(directions[i], _e2)
+            _det = _e1 @ _p
+            if abs(_det) < DETERMINANT_EPSILON:
+                continue
+            _s = origins[i] - vertices[j, 0]
+            _u = (_s @ _p) / _det
+            _q = np.cross(_s, _e1)
+            _v = (directions[i] @ _q) / _det
+            _distance = (_e2 @ _q) / _det
+            if _u >= 0.0 and _v >= 0.0 and _u + _v <= 1.0 and DISTANCE_EPSILON < _distance < _t[i]:
+                _t[i], _faces[i] = _distance, j
+    return _t, _faces
+
+
+def test_packet_kernel_matches_a_scalar_moller_trumbore(monkeypatch):
+    _vertices, _origins, _directions = _randomScene()
+    _expectedT, _expectedFaces = _scalarClosestHits(_vertices, _origins, _directions)
+    assert np.count_nonzero(_expectedFaces >= 0) > 20
+
+    # Also when the faces are split in several blocks
+    for _blockElements in (1 << 20, 1000):
+        monkeypatch.setattr(ray_intersection, 'MAX_ELEMENTS_PER_BLOCK', _blockElements)
+        _t, _faces, _u, _v = intersectRays(_origins, _directions, TriangleArrays(_vertices))
+        assert np.array_equal(_faces, _expectedFaces)
+        assert np.allclose(_t, _expectedT)
+
+    # The hit points are on the faces
+    _hit = _faces >= 0
+    _points = _origins[_hit] + _t[_hit, None] * _directions[_hit]
+    _onFace = _vertices[_faces[_hit], 0] + _u[_hit, None] * (_vertices[_faces[_hit], 1] - _vertices[_faces[_hit], 0]) + _v[_hit, None] * (_vertices[_faces[_hit], 2] - _vertices[_faces[_hit], 0])
+    assert np.allclose(_points, _onFace)
+
+
+def test_ignored_faces_and_maximum_distances():
+    _vertices, _origins, _directions = _randomScene(1)
+    _triangles = TriangleArrays(_vertices)
+    _t, _faces, _, _ = intersectRays(_origins, _directions, _triangles)
+    _hit = np.nonzero(_faces >= 0)[0]
+    _tIgnoring, _facesIgnoring, _, _ = intersectRays(_origins[_hit], _directions[_hit], _triangles, ignoreFaces=_faces[_hit])
+    assert not np.any(_facesIgnoring == _faces[_hit])
+    assert np.all(_tIgnoring >= _t[_hit])
+    _, _facesBefore, _, _ = intersectRays(_origins[_hit], _directions[_hit], _triangles, tMax=0.5 * _t[_hit])
+    assert np.all(_facesBefore < 0)
+
+
+def test_reflected_directions_mirror_the_normal_component():
+    _directions = np.array([[1.0, -1.0, 0.0], [0.0, 0.0, -1.0]]) / np.array([[np.sqrt(2.0)], [1.0]])
+    _normals = np.array([[0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+    assert np.allclose(reflectDirections(_directions, _normals), [[1.0 / np.sqrt(2.0), 1.0 / np.sqrt(2.0), 0.0], [0.0, 0.0, 1.0]])
@@ -0,0 +1,269 @@
+import os
+import sys
+import pickle
+import asyncio
+import concurrent.futures
+import numpy as np
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT, 'source'))
+
+import logger
+logger.LOG_TO_TEXT_FILE = False
+logger.LOG_TO_STD_OUTPUT = False
+
+from geometry import *
+from ray_tracing import *
+
+
+_RECEIVERS = ([1.5, 3.0, 1.0], [0.5, 4.0, 1.5])
+
+
+def _makeTracer(receivers=_RECEIVERS, **parameters):
+    _geometry = LibraryGeometries()
+    _geometry.loadGeometryFromFile(os.path.join(_ROOT, 'examples', 'boxy_box_materials_colors.dae'))
+    _tracer = RayTracer()
+    _tracer.addEnvironmentGeometry(_geometry)
+    _parameters = RayTracerParameters()
+    _parameters._parallelThreads = 2
+    _parameters._angularResolution = 4.0
+    _parameters._maxBouncesPerRay = 30
+    for _name, _value in parameters.items():
+        setattr(_parameters, _name, _value)
+    _tracer._rayTracerParameters = _parameters
+    _source = SourceDefinition()
+    _source._location = [1.0, 1.0, 1.0]
+    _tracer.addSource(_source)
+    for _location in receivers:
+        _receiver = ReceiverDefinition()
+        _receiver._location = _location
+        _tracer.addReceiver(_receiver)
+    return _tracer
+
+
+def _trace(**parameters):
+    _tracer = _makeTracer(**parameters)
+    try:
+        return _tracer.executeTracing()
+    finally:
+        _tracer.close()
+
+
+def _sameResults(results, reference, rtol=1e-10):
+    return results._raysTraced == reference._raysTraced and np.allclose(results._echogram, reference._echogram, rtol=rtol, atol=0.0)
+
+
+def test_tracing_completes_through_futures_and_asyncio():
+    _reference = _trace()
+    assert _reference._raysTraced > 0 and np.any(_reference._echogram > 0.0)
+
+    _tracer = _makeTracer()
+    try:
+        _future = _tracer.startTracing()
+        assert isinstance(_future, concurrent.futures.Future)
+        assert _sameResults(_future.result(timeout=120), _reference)
+    finally:
+        _tracer.close()
+
+    # Several simulations awaited at once on the same worker pool
+    async def _traceConcurrently(tracers):
+        return await asyncio.gather(*[_tracer.executeTracingAsync() for _tracer in tracers])
+    _tracers = [_makeTracer() for i in range(2)]
+    try:
+        for _results in asyncio.run(_traceConcurrently(_tracers)):
+            assert _sameResults(_results, _reference)
+    finally:
+        for _tracer in _tracers:
+            _tracer.close()
+
+
+def _randomBlocks(seed, parts, sources, receivers, shape):
+    # Worker-like results: echogram blocks of random (source, receiver) subsets
+    _random = np.random.default_rng(seed)
+    _parts = []
+    for i in range(parts):
+        _results = TracerEngineResults()
+        _results._raysTraced = 10
+        _sources = np.sort(_random.choice(sources, _random.integers(1, sources + 1), replace=False))
+        _receivers = np.sort(_random.choice(receivers, _random.integers(1, receivers + 1), replace=False))
+        _block = _results.allocateBlock(_sources, _receivers, [1000.0] * shape[0], 0.01, 0.01 * shape[1])
+        _block += _random.random(_block.shape)
+        _parts.append(_results)
+    return _parts
+
+
+def test_joined_worker_results_equal_their_sequential_sum():
+    _tracer = _makeTracer(receivers=[[1.0 + 0.5 * i, 3.0, 1.0] for i in range(5)], _frequencyBands=[500.0, 1000.0], _echogramTimeStep=0.01, _echogramDuration=0.2)
+    try:
+        _expected = np.zeros((1, 5, 2, 20))
+        for _results in _randomBlocks(0, 7, 1, 5, (2, 20)):
+            for _sources, _receivers, _block in _results._blocks.values():
+                _expected[np.ix_(_sources, _receivers)] += _block
+        _joined = _tracer._joinTracerEngineResults(_randomBlocks(0, 7, 1, 5, (2, 20)))
+        assert _joined._raysTraced == 70
+        assert np.allclose(_joined._echogram, _expected, rtol=1e-12)
+    finally:
+        _tracer.close()
+
+
+def test_adding_results_does_not_change_the_added_ones():
+    _other = TracerEngineResults()
+    _other.allocateEchogram(1, 2, [1000.0], 0.01, 0.05)
+    _other._echogram += 1.0
+    _sum = TracerEngineResults().add(_other)
+    _sum.add(_other)
+    assert np.all(_sum._echogram == 2.0)
+    assert np.all(_other._echogram == 1.0)
+
+    _blocks = _randomBlocks(1, 1, 1, 2, (1, 5))[0]
+    _copy = [_block.copy() for _, _, _block in _blocks._blocks.values()]
+    _merged = TracerEngineResults().add(_blocks)
+    _merged.add(_blocks)
+    for (_, _, _block), _original in zip(_blocks._blocks.values(), _copy):
+        assert np.array_equal(_block, _original)
+
+
+def test_results_do_not_depend_on_how_the_rays_are_split():
+    _reference = _trace(_parallelThreads=1, _raysPerChunk=1 << 20)
+    for _threads, _raysPerChunk, _raysPerPacket in ((2, 4096, 4096), (3, 300, 128), (4, 1000, 1000)):
+        assert _sameResults(_trace(_parallelThreads=_threads, _raysPerChunk=_raysPerChunk, _raysPerPacket=_raysPerPacket), _reference)
+
+
+def test_bands_follow_their_absorption_and_air_attenuation():
+    _bands = [500.0, 1000.0, 4000.0]
+    _tracer = _makeTracer(_frequencyBands=_bands, _energyThreshold=None, _enableHighFrequencyAirAbsorption=False)
+    try:
+        _table = _tracer._environmentGeometry._materialTable
+        for _material in _table._materials:
+            _tracer.addMaterialAbsorption(_material._id, [0.1, 0.5, 1.0])
+        _tracer._rayTracerParameters._defaultAbsorption = 0.1
+        _reflectance = _tracer.materialReflectance()
+        assert _reflectance.shape == (len(_table) + 1, 3)
+        assert np.allclose(_reflectance[:-1], [0.9, 0.5, 0.0])
+        _results = _tracer.executeTracing()
+    finally:
+        _tracer.close()
+    _energies = _results._echogram.sum(axis=-1)
+    assert np.all(_energies[..., 0] > _energies[..., 1])
+    # Walls absorbing everything leave only the direct sound, in one or two bins
+    assert np.all(np.count_nonzero(_results._echogram[..., 2, :], axis=-1) <= 2)
+
+    _withAir = _trace(_frequencyBands=_bands, _energyThreshold=None)
+    _withoutAir = _trace(_frequencyBands=_bands, _energyThreshold=None, _enableHighFrequencyAirAbsorption=False)
+    _ratios = _withAir._echogram.sum(axis=-1) / _withoutAir._echogram.sum(axis=-1)
+    assert np.all(_ratios < 1.0)
+    assert np.all(np.diff(_ratios, axis=-1) < 0.0)
+
+    _tracer = _makeTracer()
+    try:
+        for _absorption in (1.5, [0.1, 0.2]):
+            try:
+                _tracer.addMaterialAbsorption(_table._materials[0]._id, _absorption)
+                _tracer.materialReflectance()
+                _raised = False
+            except Exception:
+                _raised = True
+            assert _raised
+    finally:
+        _tracer.close()
+
+
+def test_progressive_rounds_stream_estimates_and_stop_on_convergence():
+    _reference = _trace()
+    _tracer = _makeTracer()
+    try:
+        # Never converged: every round is traced and the last one is the full run
+        _rounds = list(_tracer.traceProgressively(rounds=4, tolerance=-1.0))
+        assert [_progress._round for _progress in _rounds] == [1, 2, 3, 4]
+        assert np.all(np.isinf(_rounds[0]._change))
+        assert not np.any(_rounds[-1]._converged)
+        assert _sameResults(_rounds[-1]._results, _reference)
+        # Every estimate is scaled up to a full run
+        for _progress in _rounds:
+            assert np.allclose(_progress._results._echogram.sum(axis=-1), _reference._echogram.sum(axis=-1), rtol=0.5)
+
+        # Converged as soon as two rounds can be compared
+        _streamed = []
+        _results = _tracer.executeTracingProgressive(callback=_streamed.append, rounds=4, tolerance=1e9)
+        assert [_progress._round for _progress in _streamed] == [1, 2]
+        assert np.all(_streamed[-1]._converged)
+        assert abs(_results._raysTraced - _reference._raysTraced / 2.0) <= 4
+    finally:
+        _tracer.close()
+
+
+def _traceWithDirectivity(levels, **parameters):
+    _tracer = _makeTracer(_angularResolution=2.0, **parameters)
+    try:
+        _directivity = Directivity()
+        _elevations = np.linspace(-90.0, 90.0, 7)
+        _azimuths = np.arange(0.0, 360.0, 30.0)
+        _directivity.setBalloon(_elevations, _azimuths, levels(*np.meshgrid(np.radians(_elevations), np.radians(_azimuths), indexing='ij')))
+        _tracer._sources[0]._directivity = _directivity
+        return _tracer.executeTracing()
+    finally:
+        _tracer.close()
+
+
+def test_directivity_weights_and_importance_sampling():
+    # A flat balloon is an omnidirectional source
+    _flat = _traceWithDirectivity(lambda e, a: np.zeros(e.shape))
+    assert _sameResults(_flat, _trace(_angularResolution=2.0))
+
+    _cardioid = lambda e, a: 10.0 * np.log10(np.maximum(0.5 * (1.0 + np.cos(e) * np.cos(a)), 1e-3))
+    _weighted = _traceWithDirectivity(_cardioid)
+    _sampled = _traceWithDirectivity(_cardioid, _directivityImportanceSampling=True)
+    assert _weighted._raysTraced == _sampled._raysTraced
+    assert np.all(_weighted._echogram.sum(axis=(2, 3)) < _flat._echogram.sum(axis=(2, 3)))
+    assert np.allclose(_sampled._echogram.sum(axis=(2, 3)), _weighted._echogram.sum(axis=(2, 3)), rtol=0.1)
+
+
+def test_chunks_cover_every_ray_once_and_pickle_small():
+    _tracer = _makeTracer(receivers=[[1.0, 1.0 + 0.1 * i, 1.0] for i in range(40)], _raysPerChunk=300, _receiversPerChunk=16, _imageSourceOrder=1)
+    try:
+        _tracer.addSource(SourceDefinition())
+        _rayCount = rayCountForResolution(_tracer._rayTracerParameters._angularResolution)
+        _enabled = np.ones((2, 40), dtype=bool)
+        _enabled[1, 10:] = False
+        for _rounds in (1, 3):
+            # As in progressive tracing: the image sources first, then the rounds of rays
+            _work = _tracer._divideWorkInParts(rays=False, enabledPairs=_enabled)
+            _work += [_chunk for _round in range(_rounds) for _chunk in _tracer._divideWorkInParts(imageSources=False, rayRound=_round, rayRounds=_rounds, enabledPairs=_enabled)]
+            assert len(set([_chunk._key for _chunk in _work])) == len(_work)
+            _traced = np.zeros((2, 40, _rayCount), dtype=np.int64)
+            _imageSources = np.zeros((2, 40), dtype=np.int64)
+            for _chunk in _work:
+                _source = _chunk._enabledSources[0]
+                if _chunk._imageSources:
+                    _imageSources[_source, _chunk._enabledReceivers] += 1
+                    continue
+                _traced[_source, np.asarray(_chunk._enabledReceivers)[:, None], np.arange(*_chunk._angularRange)[None, :]] += 1
+                assert len(range(*_chunk._angularRange)) <= 300
+                assert len(_chunk._enabledReceivers) <= 16
+                # Only indices travel with a chunk, the scene goes once to every worker
+                assert len(pickle.dumps(_chunk)) < 1024
+            assert np.array_equal(_imageSources, _enabled)
+            assert np.array_equal(_traced, np.broadcast_to(_enabled[:, :, None], _traced.shape))
+    finally:
+        _tracer.close()
+
+
+def test_float32_echograms_stay_close_to_float64():
+    _reference = _trace(_angularResolution=2.0)
+    _results = _trace(_angularResolution=2.0, _precision='float32')
+    assert _results._echogram.dtype == np.float32
+    assert _results._raysTraced == _reference._raysTraced
+    _totals = _results._echogram.sum(axis=-1, dtype=np.float64) / _reference._echogram.sum(axis=-1)
+    assert np.allclose(_totals, 1.0, atol=0.01)
+    assert np.all(decayCurveChange(decayCurves(_reference._echogram, 30.0), decayCurves(_results._echogram.astype(float), 30.0)) < 0.5)
+
+    # Also with the geometry itself stored in float32 (the echogram follows
+    # the precision of the parameters)
+    _tracer = _makeTracer(_angularResolution=2.0)
+    try:
+        _tracer._environmentGeometry.setPrecision('float32')
+        _results = _tracer.executeTracing()
+    finally:
+        _tracer.close()
+    assert _results._echogram.dtype == np.float64
+    assert np.allclose(_results._echogram.sum(axis=-1) / _reference._echogram.sum(axis=-1), 1.0, atol=0.01)
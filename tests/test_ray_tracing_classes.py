@@ -0,0 +1,65 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+from ray_tracing_classes import *
+from ray_tracing_engine import sphereDirections, fibonacciLattice
+
+
+def _cardioid(bands=1):
+    # Louder towards +x, 2 dB more per band
+    _elevations = np.linspace(-90.0, 90.0, 7)
+    _azimuths = np.arange(0.0, 360.0, 30.0)
+    _e, _a = np.meshgrid(np.radians(_elevations), np.radians(_azimuths), indexing='ij')
+    _levels = 10.0 * np.log10(np.maximum(0.5 * (1.0 + np.cos(_e) * np.cos(_a)), 1e-3))
+    _directivity = Directivity()
+    _directivity.setBalloon(_elevations, _azimuths, np.stack([_levels + 2.0 * i for i in range(bands)], axis=-1))
+    return _directivity, _elevations, _azimuths
+
+
+def _raises(function, *args):
+    try:
+        function(*args)
+    except Exception:
+        return True
+    return False
+
+
+def test_balloon_gains_are_interpolated_for_whole_arrays():
+    _directivity, _elevations, _azimuths = _cardioid(bands=2)
+    assert _directivity._type == DirectivityType.Balloon and _directivity.bands() == 2
+    _gains = _directivity(_elevations[:, None], _azimuths[None, :])
+    assert _gains.shape == (len(_elevations), len(_azimuths), 2)
+    assert np.allclose(_gains, _directivity._gains)
+    assert np.allclose(_gains[..., 1], _gains[..., 0] * 10.0 ** 0.2)
+
+    # Halfway between grid points, across 0 degrees of azimuth and clamped at the poles
+    assert np.allclose(_directivity(15.0, 45.0), 0.25 * (_directivity(0.0, 30.0) + _directivity(0.0, 60.0) + _directivity(30.0, 30.0) + _directivity(30.0, 60.0)))
+    assert np.allclose(_directivity(0.0, 345.0), 0.5 * (_directivity(0.0, 330.0) + _directivity(0.0, 0.0)))
+    assert np.allclose(_directivity(0.0, -15.0), _directivity(0.0, 345.0))
+
+    _directions = sphereDirections(500)
+    _elevation = np.degrees(np.arcsin(_directions[:, 2]))
+    _azimuth = np.degrees(np.arctan2(_directions[:, 1], _directions[:, 0]))
+    assert np.allclose(_directivity.weights(_directions), _directivity(_elevation, _azimuth))
+    assert np.array_equal(Directivity().weights(_directions), np.ones((500, 1)))
+
+    _balloon = Directivity()
+    assert _raises(_balloon.setBalloon, [0.0], [0.0, 90.0], np.zeros((1, 2)))
+    assert _raises(_balloon.setBalloon, [10.0, -10.0], [0.0], np.zeros((2, 1)))
+    assert _raises(_balloon.setBalloon, [-90.0, 90.0], [0.0, 360.0], np.zeros((2, 2)))
+    assert _raises(Directivity(DirectivityType.Balloon), 0.0, 0.0)
+
+
+def test_importance_sampling_keeps_the_uniform_estimate():
+    _directivity, _, _ = _cardioid()
+    _count = 20000
+    _uniform = _directivity.weights(sphereDirections(_count))
+    _directions, _weights = _directivity.sampleDirections(*fibonacciLattice(_count, np.arange(_count)))
+    assert np.allclose(np.linalg.norm(_directions, axis=1), 1.0)
+    # Denser where the source is louder, with weights that keep the mean energy
+    assert np.count_nonzero(_directions[:, 0] > 0.0) > 0.7 * _count
+    assert np.isclose(_weights.mean(), _uniform.mean(), rtol=0.01)
+    assert _weights.std() < 0.5 * _uniform.std()
@@ -0,0 +1,124 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+from ray_tracing_engine import *
+from ray_tracing_classes import TracerEngineResults
+
+
+def test_slices_of_the_sphere_equal_the_whole_set():
+    _count = rayCountForResolution(2.0)
+    assert _count == 10313
+    _directions = sphereDirections(_count)
+    assert _directions.shape == (_count, 3)
+    assert np.allclose(np.linalg.norm(_directions, axis=1), 1.0)
+
+    # However the rays are split among workers, every slice is the same
+    for _parts in (1, 3, 7, 64):
+        _bounds = np.linspace(0, _count, _parts + 1).astype(int)
+        _slices = [sphereDirections(_count, _start, _stop) for _start, _stop in zip(_bounds[:-1], _bounds[1:])]
+        assert np.array_equal(np.concatenate(_slices), _directions)
+    _indices = np.array([5, 0, 10312, 77])
+    assert np.array_equal(sphereDirections(_count, indices=_indices), _directions[_indices])
+
+
+def test_directions_cover_the_sphere_evenly():
+    _directions = sphereDirections(rayCountForResolution(2.0))
+    assert np.allclose(_directions.mean(axis=0), 0.0, atol=1e-3)
+    # Equal solid angles: as many directions in every octant and in every
+    # band of equal height (hence of equal area)
+    _octants = np.bincount((_directions > 0.0) @ np.array([1, 2, 4]), minlength=8)
+    assert _octants.max() - _octants.min() < 0.01 * len(_directions)
+    _bands = np.histogram(_directions[:, 2], bins=10, range=(-1.0, 1.0))[0]
+    assert _bands.max() - _bands.min() <= 1
+    # Every n-th direction also covers the sphere evenly
+    assert np.allclose(_directions[::8].mean(axis=0), 0.0, atol=1e-2)
+
+
+def test_air_attenuation_grows_with_frequency():
+    _frequencies = [125.0, 250.0, 500.0, 1000.0, 2000.0, 4000.0, 8000.0]
+    _decibelsPerKilometre = airAttenuationCoefficients(_frequencies, 20.0, 50.0) * 10.0 * np.log10(np.e) * 1000.0
+    assert np.all(np.diff(_decibelsPerKilometre) > 0.0)
+    # ISO 9613-1 at 20 C and 50 % relative humidity: about 5 dB/km at 1 kHz
+    # and 50 to 120 dB/km at 8 kHz
+    assert 4.0 < _decibelsPerKilometre[3] < 6.0
+    assert 50.0 < _decibelsPerKilometre[6] < 120.0
+    # Drier air absorbs more at high frequencies
+    assert airAttenuationCoefficients([4000.0], 20.0, 10.0)[0] > airAttenuationCoefficients([4000.0], 20.0, 50.0)[0]
+
+
+def _floor(materialId):
+    # Two triangles covering the floor around the origin, facing up
+    _vertices = np.array([[[-1000.0, -1000.0, 0.0], [1000.0, -1000.0, 0.0], [1000.0, 1000.0, 0.0]],
+                          [[-1000.0, -1000.0, 0.0], [1000.0, 1000.0, 0.0], [-1000.0, 1000.0, 0.0]]])
+    return TriangleArrays(_vertices), np.array([materialId, materialId], dtype=np.int64)
+
+
+def test_every_band_is_reflected_in_the_same_pass():
+    _reflectance = np.array([[0.9, 0.5, 0.2], [0.3, 0.3, 0.3], [1.0, 0.8, 0.6]])
+    _origins = np.tile([[0.0, 0.0, 1.0]], (45, 1))
+    _directions = sphereDirections(100)[55:]
+    _initial = np.tile([[1.0, 2.0, 4.0]], (45, 1))
+    for _materialId, _row in ((0, 0), (1, 1), (-1, 2)):
+        _triangles, _materialIds = _floor(_materialId)
+        _segments = []
+        def _onSegment(bounce, rayIds, starts, directions, lengths, pathLengths, faces, energies):
+            _segments.append((bounce, len(rayIds), energies.copy()))
+        traceRayPacket(_origins, _directions, _triangles, 3, onSegment=_onSegment, energies=_initial,
+                       materialIds=_materialIds, materialReflectance=_reflectance)
+        # Down to the floor, then away from it
+        assert [(_bounce, _rays) for _bounce, _rays, _ in _segments] == [(0, 45), (1, 45)]
+        assert np.allclose(_segments[0][2], _initial)
+        assert np.allclose(_segments[1][2], _initial * _reflectance[_row])
+
+
+def _parallelPlanes():
+    # Floor and ceiling 1 m apart, both reflecting half of the energy
+    _vertices = np.array([[[-1000.0, -1000.0, 0.0], [1000.0, -1000.0, 0.0], [1000.0, 1000.0, 0.0]],
+                          [[-1000.0, -1000.0, 0.0], [1000.0, 1000.0, 0.0], [-1000.0, 1000.0, 0.0]],
+                          [[-1000.0, -1000.0, 1.0], [1000.0, 1000.0, 1.0], [1000.0, -1000.0, 1.0]],
+                          [[-1000.0, -1000.0, 1.0], [-1000.0, 1000.0, 1.0], [1000.0, 1000.0, 1.0]]])
+    return TriangleArrays(_vertices), np.zeros(4, dtype=np.int64), np.array([[0.5], [0.5]])
+
+
+def _energyPerBounce(origins, directions, bounces, **options):
+    _triangles, _materialIds, _reflectance = _parallelPlanes()
+    _energies = np.zeros(bounces + 1)
+    _rays = np.zeros(bounces + 1, dtype=np.int64)
+    def _onSegment(bounce, rayIds, starts, directions, lengths, pathLengths, faces, energies):
+        _energies[bounce] += energies.sum()
+        _rays[bounce] += len(rayIds)
+    _results = TracerEngineResults()
+    traceRayPacket(origins, directions, _triangles, bounces, results=_results, onSegment=_onSegment,
+                   materialIds=_materialIds, materialReflectance=_reflectance, **options)
+    return _energies, _rays, _results
+
+
+def test_russian_roulette_keeps_the_expected_energy():
+    _directions = sphereDirections(50000)
+    _directions = _directions[np.abs(_directions[:, 2]) > 0.3]
+    _origins = np.tile([[0.0, 0.0, 0.5]], (len(_directions), 1))
+    _expected, _allRays, _ = _energyPerBounce(_origins, _directions, 12)
+    assert np.all(_allRays == len(_directions))
+
+    # Rays play roulette once 13 dB below their initial energy (every few bounces)
+    _energies, _rays, _results = _energyPerBounce(_origins, _directions, 12, energyThreshold=0.05, rouletteSurvival=0.1)
+    assert np.allclose(_energies[:11], _expected[:11], rtol=0.1)
+    assert np.allclose(_energies, _expected, rtol=0.25)
+    assert _rays[-1] < 0.01 * len(_directions)
+    assert _results._raysTerminated == len(_directions) - _rays[-1]
+    assert _results._segmentsTraced < 0.5 * len(_directions) * 13
+
+    # Without roulette the rays below the threshold are simply dropped
+    _energies, _rays, _ = _energyPerBounce(_origins, _directions, 12, energyThreshold=0.05, rouletteSurvival=0.0)
+    assert np.all(_rays[5:] == 0)
+
+    # The draws only depend on the ray indices, not on the packets
+    _, _whole, _ = _energyPerBounce(_origins, _directions, 12, energyThreshold=0.05, rouletteSurvival=0.1, seed=3)
+    _half = len(_directions) // 2
+    _, _first, _ = _energyPerBounce(_origins[:_half], _directions[:_half], 12, energyThreshold=0.05, rouletteSurvival=0.1, seed=3)
+    _, _second, _ = _energyPerBounce(_origins[_half:], _directions[_half:], 12, energyThreshold=0.05, rouletteSurvival=0.1, seed=3,
+                                     rayIndices=np.arange(_half, len(_directions)))
+    assert np.array_equal(_first + _second, _whole)
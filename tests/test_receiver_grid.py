@@ -0,0 +1,70 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+import receiver_grid
+from receiver_grid import *
+
+
+def _listenerPlane(seed=0):
+    # 40 x 40 receivers at 1.2 m height, with different radii
+    _random = np.random.default_rng(seed)
+    _x, _y = np.meshgrid(np.linspace(0.0, 8.0, 40), np.linspace(0.0, 6.0, 40))
+    _locations = np.stack([_x.ravel(), _y.ravel(), np.full(_x.size, 1.2)], axis=1)
+    _radii = _random.uniform(0.05, 0.3, len(_locations))
+    return _locations, _radii
+
+
+def _randomSegments(seed, count=4000):
+    _random = np.random.default_rng(seed)
+    _starts = _random.uniform([-1.0, -1.0, 0.0], [9.0, 7.0, 3.0], (count, 3))
+    _directions = _random.normal(size=(count, 3))
+    _directions /= np.linalg.norm(_directions, axis=1)[:, None]
+    _lengths = _random.exponential(3.0, count)
+    # Some segments along the axes and some lying in the plane of the receivers
+    _directions[:20] = np.eye(3)[np.arange(20) % 3]
+    _starts[20:40, 2] = 1.2
+    _directions[20:40, 2] = 0.0
+    _directions[20:40] /= np.linalg.norm(_directions[20:40], axis=1)[:, None]
+    return _starts, _directions, _lengths
+
+
+def _sortedHits(found):
+    _segments, _receivers, _along, _chords = found
+    _order = np.lexsort((_receivers, _segments))
+    return _segments[_order], _receivers[_order], _along[_order], _chords[_order]
+
+
+def test_grid_finds_the_same_hits_as_testing_every_receiver(monkeypatch):
+    _locations, _radii = _listenerPlane()
+    _starts, _directions, _lengths = _randomSegments(1)
+    _expected = _sortedHits(SphereReceivers(_locations, _radii).detect(_starts, _directions, _lengths))
+    assert len(_expected[0]) > 500
+
+    assert isinstance(receiverDetector(_locations, _radii), ReceiverGrid)
+    for _cellSize in (0.0, 0.05, 0.4, 1.0):
+        _grid = ReceiverGrid(_locations, _radii, _cellSize)
+        _found = _sortedHits(_grid.detect(_starts, _directions, _lengths))
+        assert np.array_equal(_found[0], _expected[0])
+        assert np.array_equal(_found[1], _expected[1])
+        assert np.allclose(_found[2], _expected[2])
+        assert np.allclose(_found[3], _expected[3])
+
+    # The grid tests far fewer pairs than all of them
+    _grid = ReceiverGrid(_locations, _radii)
+    _grid.detect(_starts, _directions, _lengths)
+    assert _grid._pairsTested < len(_starts) * len(_locations) // 10
+
+    # Also when the segments are split in several blocks
+    monkeypatch.setattr(receiver_grid, 'MAX_ELEMENTS_PER_BLOCK', 5000)
+    _found = _sortedHits(ReceiverGrid(_locations, _radii, 0.2).detect(_starts, _directions, _lengths))
+    assert np.array_equal(_found[1], _expected[1])
+
+
+def test_few_receivers_are_tested_directly():
+    _locations, _radii = _listenerPlane()
+    assert isinstance(receiverDetector(_locations[:10], _radii[:10]), SphereReceivers)
+    _segments, _, _, _ = ReceiverGrid(_locations, _radii).detect(np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0))
+    assert len(_segments) == 0
@@ -0,0 +1,78 @@
+import os
+import sys
+import numpy as np
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT, 'source'))
+
+import logger
+logger.LOG_TO_TEXT_FILE = False
+logger.LOG_TO_STD_OUTPUT = False
+
+from geometry import *
+from ray_tracing import *
+from scenario_sweep import *
+
+
+_PARAMETERS = {'parallelThreads': 2, 'angularResolution': 4.0, 'maxBouncesPerRay': 30}
+_SCENARIOS = [{'id': 'a', 'sources': [[1.0, 1.0, 1.0]], 'receivers': [[1.5, 3.0, 1.0], [0.5, 4.0, 1.5]]},
+              {'id': 'b', 'sources': [[1.0, 1.0, 1.0], [1.0, 4.0, 2.0]], 'receivers': [[0.5, 4.0, 1.5], [1.0, 2.0, 0.5]], 'receiverRadius': 0.3},
+              {'id': 'c', 'sources': [[1.0, 4.0, 2.0]], 'receivers': [[1.5, 3.0, 1.0]], 'parameters': dict(_PARAMETERS, maxBouncesPerRay=10)}]
+
+
+def _loadGeometry():
+    _geometry = LibraryGeometries()
+    _geometry.loadGeometryFromFile(os.path.join(_ROOT, 'examples', 'boxy_box_materials_colors.dae'))
+    return _geometry
+
+
+def _separateRun(geometry, row):
+    _tracer = RayTracer()
+    _tracer.addEnvironmentGeometry(geometry)
+    _tracer._rayTracerParameters = RayTracerParameters()
+    for _name, _value in row.get('parameters', _PARAMETERS).items():
+        setattr(_tracer._rayTracerParameters, '_' + _name, _value)
+    for _location in row['sources']:
+        _source = SourceDefinition()
+        _source._location = _location
+        _tracer.addSource(_source)
+    _tracer.addReceiver(ReceiverArrayDefinition(row['receivers'], row.get('receiverRadius', ReceiverDefinition()._radius)))
+    try:
+        return _tracer.executeTracing()
+    finally:
+        _tracer.close()
+
+
+def test_sweep_results_equal_separate_runs(tmp_path):
+    _geometry = _loadGeometry()
+    _sweep = ScenarioSweep()
+    _sweep.addEnvironmentGeometry(_geometry)
+    _sweep._rayTracerParameters = RayTracerParameters()
+    for _name, _value in _PARAMETERS.items():
+        setattr(_sweep._rayTracerParameters, '_' + _name, _value)
+    _sweep.addScenarios(_SCENARIOS)
+    # 'a' and 'b' share a variant and their first source, 'c' has its own parameters
+    _variants = _sweep._variants()
+    assert sorted([len(_variant._sources) for _variant in _variants]) == [1, 2]
+
+    _results = _sweep.executeSweep()
+    assert sorted(_results.keys()) == ['a', 'b', 'c']
+    for _row in _SCENARIOS:
+        _expected = _separateRun(_geometry, _row)
+        assert _results[_row['id']]._echogram.shape == _expected._echogram.shape
+        assert np.allclose(_results[_row['id']]._echogram, _expected._echogram, rtol=1e-10, atol=0.0)
+        assert np.any(_expected._echogram > 0.0)
+
+    _sweep.saveResults(str(tmp_path))
+    with np.load(str(tmp_path / 'b.npz')) as _saved:
+        assert np.array_equal(_saved['echogram'], _results['b']._echogram)
+        assert np.allclose(_saved['receiverRadii'], 0.3)
+
+    for _row in ({'id': 'a', 'sources': [[0.0, 0.0, 0.0]], 'receivers': [[1.0, 1.0, 1.0]]}, {'id': 'd', 'sources': [[0.0, 0.0, 0.0]]},
+                 {'id': 'e', 'sources': [[0.0, 0.0, 0.0]], 'receivers': [[1.0, 1.0, 1.0]], 'parameters': {'unknown': 1}}):
+        try:
+            _sweep.addScenarios([_row])
+            _raised = False
+        except Exception:
+            _raised = True
+        assert _raised
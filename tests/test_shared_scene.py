@@ -0,0 +1,40 @@
+import os
+import sys
+import pickle
+import multiprocessing as mp
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+from shared_scene import *
+
+
+def _readInChild(handle):
+    _arrays = handle.attach()
+    try:
+        _arrays['vertices'][0, 0] = -1.0
+        _writable = True
+    except ValueError:
+        _writable = False
+    return dict([(_name, _array.copy()) for _name, _array in _arrays.items()]), _writable
+
+
+def test_workers_see_the_published_arrays_read_only():
+    _vertices = np.arange(36, dtype=np.float64).reshape(4, 3, 3)
+    _materialIds = np.array([0, 1, -1, 2], dtype=np.int32)
+    _scene = SharedScene()
+    try:
+        _scene.publish('vertices', _vertices)
+        _scene.publish('materialIds', _materialIds)
+        _scene.publish('empty', np.zeros((0, 3)))
+        # The handle holds names, not arrays
+        assert len(pickle.dumps(_scene.getHandle())) < _vertices.nbytes
+
+        with mp.get_context('spawn').Pool(1) as _pool:
+            _arrays, _writable = _pool.apply(_readInChild, (_scene.getHandle(),))
+        assert not _writable
+        assert np.array_equal(_arrays['vertices'], _vertices)
+        assert np.array_equal(_arrays['materialIds'], _materialIds)
+        assert _arrays['empty'].shape == (0, 3)
+    finally:
+        _scene.close()
@@ -0,0 +1,44 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+import logger
+logger.LOG_TO_TEXT_FILE = False
+logger.LOG_TO_STD_OUTPUT = False
+
+import distributed_tracing
+from distributed_tracing import TaskBroker
+
+
+def test_scene_is_dropped_after_release_and_last_job():
+    _broker = TaskBroker()
+    assert not _broker.acquireScene('scene')
+    _broker.publishScene('scene', {'vertices': [0.0]})
+    _jobId = _broker.submit(['chunk'], 'scene')
+    _broker.releaseScene('scene')
+    assert _broker.hasScene('scene')
+
+    _jobId, _chunk, _queued = _broker.take('node', 0)
+    _broker.pushResults(_jobId, ['result'], 1, 'node')
+    assert _broker.waitJob(_jobId, 0)
+    assert _broker.jobResults(_jobId) == (['result'], ['node'])
+    assert not _broker.hasScene('scene')
+
+
+def test_chunks_of_a_silent_node_are_requeued(monkeypatch):
+    _broker = TaskBroker()
+    _jobId = _broker.submit(['chunk 0', 'chunk 1'])
+    assert _broker.take('dead', 0)[1] == 'chunk 0'
+    assert _broker.take('alive', 0)[1] == 'chunk 1'
+    _broker.pushResults(_jobId, ['result 1'], 1, 'alive')
+    assert _broker.take('alive', 0) is None
+
+    # The dead node is not heard of within the lease
+    monkeypatch.setattr(distributed_tracing, 'CHUNK_LEASE_TIMEOUT', 0.0)
+    assert _broker.take('alive', 0)[1] == 'chunk 0'
+    _broker.pushResults(_jobId, ['result 0'], 1, 'alive')
+    # Late results of the dead node are dropped
+    _broker.pushResults(_jobId, ['late'], 1, 'dead')
+    assert _broker.waitJob(_jobId, 0)
+    assert sorted(_broker.jobResults(_jobId)[0]) == ['result 0', 'result 1']